@@ -1,5 +1,16 @@
 # -*- mode: python ; coding: utf-8 -*-
 
+# pyinstaller "HM-TM5X Thermal Camera Programmer.spec" builds the single-file
+# executable. pyinstaller "HM-TM5X Thermal Camera Programmer.spec" -- --onedir
+# builds a folder instead, which starts much faster because nothing has to be
+# unpacked to a temporary directory on every launch.
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--onedir", action="store_true", help="build a folder instead of a single file")
+options = parser.parse_args()
+
+name = 'HM-TM5X Thermal Camera Programmer'
 
 a = Analysis(
     ['main.py'],
@@ -10,30 +21,61 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    # Tk is picked up from the standard library but never used
+    excludes=['tkinter'],
     noarchive=False,
     optimize=0,
 )
 pyz = PYZ(a.pure)
 
-exe = EXE(
-    pyz,
-    a.scripts,
-    a.binaries,
-    a.datas,
-    [],
-    name='HM-TM5X Thermal Camera Programmer',
-    debug=False,
-    bootloader_ignore_signals=False,
-    strip=False,
-    upx=True,
-    upx_exclude=[],
-    runtime_tmpdir=None,
-    console=False,
-    disable_windowed_traceback=False,
-    argv_emulation=False,
-    target_arch=None,
-    codesign_identity=None,
-    entitlements_file=None,
-    icon=['favicon.ico'],
-)
+if options.onedir:
+    # UPX-compressed libraries would be decompressed on every launch
+    exe = EXE(
+        pyz,
+        a.scripts,
+        [],
+        exclude_binaries=True,
+        name=name,
+        debug=False,
+        bootloader_ignore_signals=False,
+        strip=False,
+        upx=False,
+        console=False,
+        disable_windowed_traceback=False,
+        argv_emulation=False,
+        target_arch=None,
+        codesign_identity=None,
+        entitlements_file=None,
+        icon=['favicon.ico'],
+    )
+    coll = COLLECT(
+        exe,
+        a.binaries,
+        a.datas,
+        strip=False,
+        upx=False,
+        upx_exclude=[],
+        name=name,
+    )
+else:
+    exe = EXE(
+        pyz,
+        a.scripts,
+        a.binaries,
+        a.datas,
+        [],
+        name=name,
+        debug=False,
+        bootloader_ignore_signals=False,
+        strip=False,
+        upx=True,
+        upx_exclude=[],
+        runtime_tmpdir=None,
+        console=False,
+        disable_windowed_traceback=False,
+        argv_emulation=False,
+        target_arch=None,
+        codesign_identity=None,
+        entitlements_file=None,
+        icon=['favicon.ico'],
+    )
@@ -0,0 +1,60 @@
+"""Write batching
+
+Frames queued with add() are joined and handed to the underlying write in
+one call when flush() runs, so a burst of commands costs one syscall and one
+USB transfer instead of one per frame. A batch never holds more than
+maxFrames frames, the most the camera has been seen to take in one go
+without losing bytes; linkbench.py --batching measures this for a link.
+
+Given an inflight() callable returning how many written frames are still
+unanswered, the cap covers those too: a flush only writes as many frames as
+there is room for and the rest wait for the next flush, which the owner
+runs as replies arrive.
+"""
+
+MAX_BATCH_FRAMES = 4
+
+
+class FrameBatcher:
+    def __init__(self, write, maxFrames=MAX_BATCH_FRAMES, inflight=None):
+        self.write = write
+        self.maxFrames = maxFrames
+        self.inflight = inflight
+        self.queue = []
+        self.writes = 0
+        self.frames = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    # frames that may be written now
+    def room(self):
+        if self.inflight is None:
+            return self.maxFrames
+        return max(0, self.maxFrames - self.inflight())
+
+    # returns True when the batch filled up and was written straight away
+    def add(self, frame):
+        self.queue.append(frame)
+        if len(self.queue) >= self.maxFrames and self.room():
+            self.flush()
+            return True
+        return False
+
+    def clear(self):
+        self.queue = []
+
+    def flush(self):
+        queue = self.queue
+        if not queue:
+            return
+        if self.inflight is not None:
+            room = self.room()
+            queue, self.queue = queue[:room], queue[room:]
+        else:
+            self.queue = []
+        for i in range(0, len(queue), self.maxFrames):
+            chunk = queue[i : i + self.maxFrames]
+            self.write(b"".join(chunk))
+            self.writes += 1
+            self.frames += len(chunk)
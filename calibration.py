@@ -0,0 +1,284 @@
+"""Staggered shutter calibration across several cameras
+
+A manual shutter calibration freezes the image while it runs. In an
+installation where cameras cover for each other, no more than K of them
+should be frozen at once, and cameras that are neighbours should never be
+frozen together. The scheduler dispatches manualShutterCalibration to every
+camera under those rules and starts the next eligible camera as soon as one
+finishes, so that calibrations are packed as tightly as the rules allow.
+
+A camera counts as frozen from the moment the command is sent until SETTLE
+seconds after its acknowledgement. Cameras with more neighbours are placed
+first because they have the fewest slots to fit into.
+
+Every calibration runs on a thread of its own, and QSerialPort must only be
+used from the thread that created it. Where the low-latency backend from
+lowlatency.py exists (Linux), every port is opened once with it and shared
+by the threads; elsewhere each calibration opens its port on its own
+thread, a QThread, and closes it when done.
+
+Usage:
+    python calibration.py /dev/ttyUSB0 /dev/ttyUSB1 /dev/ttyUSB2 --max-concurrent 1
+    python calibration.py sim:a sim:b sim:c sim:d --max-concurrent 2 --adjacent --cycles 3
+    python calibration.py sim:a sim:b sim:c --neighbours sim:a,sim:c
+"""
+
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+
+import HM_TM5X
+import tracing
+
+SETTLE = 0.2  # seconds the image is treated as frozen after the ack
+ACK_TIMEOUT = 2.0
+
+
+# "A,B" or "A:B" -> (A, B). Port names may hold colons themselves ("sim:a"),
+# so A:B is split on the colon that leaves a scheduled port on both sides.
+def parsePair(text, ports):
+    if "," in text:
+        a, b = text.split(",", 1)
+        return a.strip(), b.strip()
+    for i, c in enumerate(text):
+        if c == ":" and text[:i] in ports and text[i + 1 :] in ports:
+            return text[:i], text[i + 1 :]
+    raise ValueError(f"neighbour pair {text} does not name two scheduled ports")
+
+
+# pairs of port names -> {port: set of neighbouring ports}
+def neighbourMap(ports, pairs=(), adjacent=False):
+    neighbours = {port: set() for port in ports}
+    if adjacent:
+        pairs = list(pairs) + list(zip(ports, ports[1:]))
+    for a, b in pairs:
+        if a not in neighbours or b not in neighbours:
+            raise ValueError(f"neighbour pair {a}:{b} names a port that is not scheduled")
+        neighbours[a].add(b)
+        neighbours[b].add(a)
+    return neighbours
+
+
+# Always posts a result, also when the port fails, so that runSchedule
+# never waits for a calibration that is gone. A transport of None means the
+# port is opened here, on the calibration's own thread, and closed after.
+def calibrate(transport, port, results, settle=SETTLE):
+    from transport import openTransport
+
+    request = bytes.fromhex(HM_TM5X.manualShutterCalibration())
+    ack = bytes.fromhex(HM_TM5X.ackReply(request.hex().upper()))
+    span = tracing.begin("manualShutterCalibration", port, bytes=request)
+    start = acked = time.monotonic()
+    ok = False
+    own = transport is None
+    try:
+        if own:
+            transport = openTransport(port, timeout=ACK_TIMEOUT)
+            if transport is None:
+                raise OSError(f"could not open {port}")
+        transport.resetInput()
+        transport.write(request)
+        reply = HM_TM5X.readFrame(transport)
+        acked = time.monotonic()
+        ok = reply == ack
+        tracing.end(span, "ok" if ok else "no ack", reply=reply)
+        if ok:
+            time.sleep(settle)
+    except OSError as e:
+        acked = time.monotonic()
+        tracing.end(span, "error", error=str(e))
+    finally:
+        if own and transport is not None:
+            transport.close()
+        results.put((port, start, acked, time.monotonic(), ok))
+
+
+# transports: {port: transport or None}. Every camera is calibrated once per cycle and
+# not again until `interval` seconds after its previous calibration ended.
+# Returns a report dict with one entry per calibration.
+def runSchedule(
+    transports,
+    maxConcurrent=1,
+    neighbours=None,
+    cycles=1,
+    interval=0.0,
+    settle=SETTLE,
+    log=print,
+):
+    ports = list(transports)
+    neighbours = neighbours or {port: set() for port in ports}
+    order = sorted(ports, key=lambda port: -len(neighbours[port]))
+    pending = [(cycle, port) for cycle in range(cycles) for port in order]
+    running = {}
+    readyAt = {port: 0.0 for port in ports}
+    results = queue.Queue()
+    threads = []
+    entries = []
+    start = time.monotonic()
+
+    def eligible(port, now):
+        return (
+            port not in running
+            and readyAt[port] <= now
+            and not neighbours[port] & running.keys()
+        )
+
+    while pending or running:
+        now = time.monotonic()
+        for item in list(pending):
+            if len(running) >= maxConcurrent:
+                break
+            cycle, port = item
+            if not eligible(port, now):
+                continue
+            pending.remove(item)
+            if transports[port] is not None:
+                transports[port].timeout = ACK_TIMEOUT
+            running[port] = cycle
+            args = (transports[port], port, results, settle)
+            if transports[port] is None:
+                from transport import PortThread
+
+                thread = PortThread(calibrate, args)
+            else:
+                thread = threading.Thread(target=calibrate, args=args)
+            thread.start()
+            threads.append(thread)
+        # sleep until something finishes or a camera's interval runs out
+        waits = [readyAt[port] - now for cycle, port in pending if readyAt[port] > now]
+        try:
+            port, began, acked, ended, ok = results.get(
+                timeout=min(waits) if waits and len(running) < maxConcurrent else None
+            )
+        except queue.Empty:
+            continue
+        cycle = running.pop(port)
+        readyAt[port] = ended + interval
+        entries.append(
+            {
+                "port": port,
+                "cycle": cycle,
+                "start": began - start,
+                "ack": acked - began,
+                "end": ended - start,
+                "ok": ok,
+            }
+        )
+        if not ok:
+            log(f"{port}: no acknowledgement for shutter calibration")
+    for thread in threads:
+        thread.join()
+    entries.sort(key=lambda e: e["start"])
+    return {
+        "max_concurrent": maxConcurrent,
+        "peak_concurrent": peakConcurrency(entries),
+        "neighbour_overlaps": neighbourOverlaps(entries, neighbours),
+        "makespan": max((e["end"] for e in entries), default=0.0),
+        "failed": sum(not e["ok"] for e in entries),
+        "calibrations": entries,
+    }
+
+
+# the most calibrations that were frozen at the same moment
+def peakConcurrency(entries):
+    events = sorted(
+        [(e["start"], 1) for e in entries] + [(e["end"], -1) for e in entries],
+        key=lambda event: (event[0], event[1]),
+    )
+    peak = current = 0
+    for t, change in events:
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+def neighbourOverlaps(entries, neighbours):
+    overlaps = 0
+    for i, a in enumerate(entries):
+        for b in entries[i + 1 :]:
+            if b["start"] >= a["end"]:
+                break
+            if b["port"] in neighbours.get(a["port"], ()):
+                overlaps += 1
+    return overlaps
+
+
+def formatReport(report):
+    lines = [
+        f"{e['start'] * 1000:9.1f} - {e['end'] * 1000:9.1f} ms  cycle {e['cycle']}  "
+        f"{e['port']}  ack {e['ack'] * 1000:.1f} ms" + ("" if e["ok"] else "  FAILED")
+        for e in report["calibrations"]
+    ]
+    lines.append(
+        f"{len(report['calibrations'])} calibrations in {report['makespan']:.2f} s, "
+        f"at most {report['peak_concurrent']} at once (limit {report['max_concurrent']}), "
+        f"{report['neighbour_overlaps']} neighbour overlaps, {report['failed']} failed"
+    )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("ports", nargs="+")
+    parser.add_argument("--max-concurrent", type=int, default=1, metavar="K")
+    parser.add_argument("--neighbours", nargs="*", default=[], metavar="A,B", help="ports that must not calibrate together, A:B also works")
+    parser.add_argument("--adjacent", action="store_true", help="ports given next to each other are neighbours")
+    parser.add_argument("--cycles", type=int, default=1)
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds between calibrations of one camera")
+    parser.add_argument("--disable-auto", action="store_true", help="turn off automatic shutter control first")
+    parser.add_argument("--report", metavar="FILE", help="write the achieved schedule as JSON")
+    parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace of the run")
+    args = parser.parse_args(argv)
+
+    try:
+        pairs = [parsePair(pair, args.ports) for pair in args.neighbours]
+        neighbours = neighbourMap(args.ports, pairs, args.adjacent)
+    except ValueError as e:
+        print(e)
+        return 1
+
+    from transport import lowLatencyAvailable, openTransport
+
+    shared = lowLatencyAvailable()
+    transports = {}
+    for port in args.ports:
+        transport = openTransport(port, lowLatency=shared)
+        if transport is None:
+            print(f"{port}: could not open port")
+            for transport in transports.values():
+                transport.close()
+            return 1
+        transports[port] = transport
+    if args.disable_auto:
+        request = bytes.fromhex(HM_TM5X.autoShutterControl(0, True))
+        for port, transport in transports.items():
+            transport.write(request)
+            if HM_TM5X.readFrame(transport) != bytes.fromhex(HM_TM5X.ackReply(request.hex().upper())):
+                print(f"{port}: could not turn off automatic shutter control")
+    if not shared:
+        # opened again by every calibration on its own thread
+        for transport in transports.values():
+            transport.close()
+        transports = dict.fromkeys(transports)
+    if args.trace:
+        tracing.enable()
+    report = runSchedule(
+        transports, args.max_concurrent, neighbours, args.cycles, args.interval
+    )
+    for transport in transports.values():
+        if transport is not None:
+            transport.close()
+    print(formatReport(report))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.trace:
+        tracing.save(args.trace)
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
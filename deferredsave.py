@@ -0,0 +1,121 @@
+"""Deferred saving of device settings
+
+saveCurrentSettings is slow, blocks the camera while it runs and wears its
+flash, so during tuning it is better to save once after the operator has
+stopped changing things than after every tweak. While deferred saving is on,
+every acknowledged setting write marks the camera dirty and restarts a quiet
+period; when the quiet period runs out without another change a single save
+is sent. A save only counts once the camera acknowledged it and no further
+write was confirmed in between.
+
+The last confirmed value of every setting written since the last save is
+kept, so that when the link drops and comes back, possibly after the camera
+lost power and its unsaved settings with it, they are written again and
+saved straight away. MainWindow also saves a dirty camera before closing the
+port or the window.
+"""
+
+from PyQt5 import QtCore
+
+import HM_TM5X
+
+DEFAULT_QUIET_PERIOD = 5.0  # seconds
+SAVE_FUNCTION = 3  # handleReply number of saveCurrentSettings
+SETTING_FUNCTIONS = {function for builder, function, max_val in HM_TM5X.SETTINGS.values()}
+
+
+class DeferredSaver(QtCore.QObject):
+    # send(function, text) writes a command the way MainWindow.writeCommand
+    # does and canSend() tells whether the link is up
+    def __init__(self, send, canSend, log=print, quietPeriod=DEFAULT_QUIET_PERIOD, parent=None):
+        super().__init__(parent)
+        self.send = send
+        self.canSend = canSend
+        self.log = log
+        self.enabled = False
+        self.unsaved = {}  # function -> write confirmed since the last save
+        self.generation = 0  # confirmed writes so far
+        self.savedGeneration = 0
+        self.sentGeneration = None  # generation covered by the save in flight
+        self.requests = 0  # saves asked for since the last one was sent
+        self.savesSent = 0
+        self.savesRequested = 0
+        self.timer = QtCore.QTimer(
+            self, singleShot=True, interval=int(quietPeriod * 1000), timeout=self.commit
+        )
+
+    @property
+    def dirty(self):
+        return self.generation != self.savedGeneration
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            self.timer.stop()
+
+    def setQuietPeriod(self, seconds):
+        self.timer.setInterval(int(seconds * 1000))
+
+    def writeConfirmed(self, function, text):
+        # writing the value that is already waiting to be saved changes
+        # nothing, as when the unsaved settings are written again
+        if function not in SETTING_FUNCTIONS or self.unsaved.get(function) == text:
+            return
+        self.unsaved[function] = text
+        self.generation += 1
+        if self.enabled:
+            self.timer.start()
+
+    # the operator clicked save; with deferred saving on it is folded into
+    # the save at the end of the quiet period
+    def saveRequested(self):
+        self.savesRequested += 1
+        self.requests += 1
+        if self.dirty:
+            self.timer.start()
+
+    def commit(self):
+        if not self.dirty or not self.canSend():
+            return
+        self.log(
+            f"saving {len(self.unsaved)} changed settings "
+            f"({self.requests} save requests since the last save)"
+        )
+        self.requests = 0
+        self.saveSent()
+        self.send(SAVE_FUNCTION, HM_TM5X.saveCurrentSettings())
+
+    # called for every save sent, including ones the operator sent directly
+    def saveSent(self):
+        self.sentGeneration = self.generation
+        self.savesSent += 1
+
+    def saveConfirmed(self):
+        generation = self.sentGeneration
+        self.sentGeneration = None
+        if generation is None:
+            return
+        self.savedGeneration = max(self.savedGeneration, generation)
+        if not self.dirty:
+            self.unsaved.clear()
+        elif self.enabled:
+            self.timer.start()
+
+    def linkLost(self):
+        self.timer.stop()
+        self.sentGeneration = None
+
+    # writes the unsaved settings again and saves them at once
+    def linkRecovered(self):
+        if not self.enabled or not self.dirty:
+            return
+        self.log(f"writing {len(self.unsaved)} unsaved settings again after the reconnect")
+        for function, text in self.unsaved.items():
+            self.send(function, text)
+        self.commit()
+
+    def summary(self):
+        return (
+            f"{self.savesSent} saves sent for {self.savesRequested} save requests "
+            f"and {self.generation} setting changes"
+        )
@@ -0,0 +1,376 @@
+"""Virtual camera farm for scale testing
+
+Runs large numbers of simulated HM-TM5X cameras in one process on asyncio.
+Every camera sits behind its own pseudo-terminal, so anything that opens a
+serial port (the GUI, the fleet view, provisioning, macro, linkbench) can
+talk to it unchanged. Cameras answer the full command set through
+simulator.VirtualCamera. Each one gets its own random base latency, with
+jitter per reply, and its own drop and corrupt rates, drawn so that they
+average out to the given rates over the farm; some cameras are flaky and
+others clean, as in a real rig. With
+--hub-size the cameras are put behind virtual USB hubs of that many ports,
+each passing at most --hub-capacity frames per second: frames queue behind
+each other there and are lost once HUB_DEPTH of them are waiting.
+
+serve keeps a farm running and writes its port names to a file. bench
+provisions every camera of a farm in the same process from a thread pool,
+for one or more farm sizes. It reports throughput, CPU time, peak memory
+and how late the farm's event loop ran, so that scaling runs show where our
+own code runs out of CPU, memory or scheduling headroom.
+
+Usage:
+    python farm.py serve --devices 1000 --ports-file ports.txt
+    python provisioning.py replay golden.hmtp $(cat ports.txt) --processes 8
+    python farm.py bench --sweep 100,500,1000 --workers 32 --drop 0.01
+    python farm.py bench --hub-size 16 --hub-capacity 800 --hub-budget 600
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tty
+from concurrent.futures import ThreadPoolExecutor
+
+import HM_TM5X
+from simulator import VirtualCamera
+
+DEFAULT_LATENCY = (0.002, 0.02)  # seconds, range of per-camera base latency
+JITTER = 0.2  # each reply takes base latency * (1 +- JITTER)
+LAG_INTERVAL = 0.01  # seconds between event loop lag samples
+FDS_PER_DEVICE = 3  # pty master and slave here, plus one for whoever opens it
+DEFAULT_HUB_CAPACITY = 800  # frames per second through one virtual hub
+HUB_DEPTH = 8  # frames a virtual hub holds before it drops
+
+
+# A per-camera rate in [0, 1] drawn uniformly around mean, averaging mean
+def spreadRate(rng, mean):
+    if mean <= 0.5:
+        return rng.uniform(0.0, 2 * mean)
+    return rng.uniform(2 * mean - 1, 1.0)
+
+
+# A USB hub shared by several cameras, a queue served at `capacity` frames/s
+class VirtualHub:
+    def __init__(self, name, capacity, depth=HUB_DEPTH):
+        self.name = name
+        self.interval = 1 / capacity
+        self.depth = depth
+        self.freeAt = 0.0
+        self.dropped = 0
+
+    # returns how long a frame arriving now is held up, None if it is lost
+    def admit(self, now):
+        start = max(now, self.freeAt)
+        if start - now > self.depth * self.interval:
+            self.dropped += 1
+            return None
+        self.freeAt = start + self.interval
+        return self.freeAt - now
+
+
+class FarmDevice:
+    def __init__(self, farm, latency, drop, corrupt, hub=None):
+        self.farm = farm
+        self.hub = hub
+        self.camera = VirtualCamera("sim:farm", latency=0)
+        self.latency = latency
+        self.drop = drop
+        self.corrupt = corrupt
+        # the slave end stays open here so that the master never reports EIO
+        # while no client has the port open
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        self.received = b""
+        self.busyUntil = 0.0
+        farm.loop.add_reader(self.master, self.onReadable)
+
+    def onReadable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            return
+        frames, self.received = HM_TM5X.splitFrames(self.received + data)
+        farm = self.farm
+        for frame in frames:
+            farm.requests += 1
+            if farm.rng.random() < self.drop:
+                farm.dropped += 1
+                continue
+            now = farm.loop.time()
+            if self.hub is not None:
+                delay = self.hub.admit(now)
+                if delay is None:
+                    farm.dropped += 1
+                    continue
+                now += delay
+            reply = self.camera.respond(frame)
+            if farm.rng.random() < self.corrupt:
+                farm.corrupted += 1
+                i = farm.rng.randrange(2, len(reply) - 1)
+                reply = reply[:i] + bytes((reply[i] ^ 0x5A,)) + reply[i + 1 :]
+            # a camera answers one frame at a time
+            took = self.latency * (1 + farm.rng.uniform(-JITTER, JITTER))
+            self.busyUntil = max(self.busyUntil, now) + took
+            farm.loop.call_at(self.busyUntil, self.send, reply)
+
+    def send(self, reply):
+        try:
+            os.write(self.master, reply)
+            self.farm.replies += 1
+        except OSError:
+            self.farm.dropped += 1
+
+    def close(self):
+        self.farm.loop.remove_reader(self.master)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class Farm:
+    def __init__(self, loop, seed=None):
+        self.loop = loop
+        self.rng = random.Random(seed)
+        self.devices = []
+        self.hubs = []
+        self.topology = {}  # port -> hub name, for hubscheduler
+        self.requests = self.replies = self.dropped = self.corrupted = 0
+        self.lags = []
+
+    # drop and corrupt are the mean rates, every camera draws its own around
+    # them; hubSize cameras share each virtual hub, none if 0
+    def addDevices(
+        self, count, latency=DEFAULT_LATENCY, drop=0.0, corrupt=0.0, hubSize=0, hubCapacity=DEFAULT_HUB_CAPACITY
+    ):
+        hub = None
+        for i in range(count):
+            if hubSize and i % hubSize == 0:
+                hub = VirtualHub(f"farm-hub-{len(self.hubs)}", hubCapacity)
+                self.hubs.append(hub)
+            base = self.rng.uniform(*latency)
+            device = FarmDevice(self, base, spreadRate(self.rng, drop), spreadRate(self.rng, corrupt), hub)
+            self.devices.append(device)
+            if hub is not None:
+                self.topology[device.path] = hub.name
+        return [device.path for device in self.devices[-count:]]
+
+    # how late a timer fires tells how busy the event loop is
+    async def watchLag(self):
+        while True:
+            expected = self.loop.time() + LAG_INTERVAL
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lags.append(self.loop.time() - expected)
+
+    def lagStats(self):
+        lags = sorted(self.lags)
+        if not lags:
+            return 0.0, 0.0
+        return lags[int(len(lags) * 0.99)], lags[-1]
+
+    def close(self):
+        for device in self.devices:
+            device.close()
+        self.devices = []
+
+
+def raiseFileLimit(devices):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = devices * FDS_PER_DEVICE + 64
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        if hard != resource.RLIM_INFINITY:
+            needed = min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+# Runs a farm's event loop on a background thread for in-process benchmarks
+class FarmThread:
+    def __init__(self, seed=None):
+        self.loop = asyncio.new_event_loop()
+        self.farm = Farm(self.loop, seed)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.lagTask = self.call(lambda: self.loop.create_task(self.farm.watchLag()))
+
+    def call(self, fn, *args):
+        async def run():
+            return fn(*args)
+
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def stop(self):
+        self.call(self.lagTask.cancel)
+        self.call(self.farm.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+# hubBudget puts the provisioning threads under a HubScheduler with the
+# farm's hubs as its topology
+def benchOnce(
+    devices, workers, steps, latency, drop, corrupt, seed=None,
+    hubSize=0, hubCapacity=DEFAULT_HUB_CAPACITY, hubBudget=None,
+):
+    from provisioning import replayPort
+
+    farm_thread = FarmThread(seed)
+    farm = farm_thread.farm
+    paths = farm_thread.call(farm.addDevices, devices, latency, drop, corrupt, hubSize, hubCapacity)
+    scheduler = None
+    if hubBudget:
+        from hubscheduler import HubScheduler
+
+        scheduler = HubScheduler(hubBudget, farm.topology)
+    farm.lags.clear()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        results = list(pool.map(lambda path: replayPort(path, steps, lowLatency=True, scheduler=scheduler), paths))
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    lag_p99, lag_max = farm.lagStats()
+    farm_thread.stop()
+    return {
+        "devices": devices,
+        "ok": sum(bool(r and r["ok"]) for r in results),
+        "reconnects": sum(r["reconnects"] for r in results if r),
+        "retries": sum(r["retries"] for r in results if r),
+        "elapsed": elapsed,
+        "rate": devices / elapsed,
+        "cpu": (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime),
+        "maxrss": after.ru_maxrss / 1024,  # MiB, ru_maxrss is in KiB on Linux
+        "lag_p99": lag_p99,
+        "lag_max": lag_max,
+        "dropped": farm.dropped,
+        "hub_dropped": sum(hub.dropped for hub in farm.hubs),
+        "corrupted": farm.corrupted,
+        "scheduled": scheduler is not None,
+    }
+
+
+def formatBench(result):
+    label = " (hub scheduler)" if result["scheduled"] else ""
+    return (
+        f"{result['devices']} devices{label}: {result['ok']} ok, {result['reconnects']} reconnects, "
+        f"{result['retries']} retries, "
+        f"{result['elapsed']:.1f} s, {result['rate']:.1f} devices/s, "
+        f"cpu {result['cpu']:.1f} s ({result['cpu'] / result['elapsed'] * 100:.0f}%), "
+        f"peak rss {result['maxrss']:.0f} MiB, loop lag p99 {result['lag_p99'] * 1000:.1f} ms "
+        f"max {result['lag_max'] * 1000:.1f} ms, {result['dropped']} dropped "
+        f"({result['hub_dropped']} by hubs), "
+        f"{result['corrupted']} corrupted"
+    )
+
+
+async def serve(
+    devices, latency, drop, corrupt, portsFile=None, seed=None, interval=5.0,
+    hubSize=0, hubCapacity=DEFAULT_HUB_CAPACITY, topologyFile=None,
+):
+    farm = Farm(asyncio.get_running_loop(), seed)
+    paths = farm.addDevices(devices, latency, drop, corrupt, hubSize, hubCapacity)
+    if portsFile:
+        with open(portsFile, "w") as f:
+            f.write("\n".join(paths) + "\n")
+        print(f"{devices} cameras, port names written to {portsFile}")
+    else:
+        print("\n".join(paths))
+    if topologyFile:
+        from hubscheduler import writeTopology
+
+        writeTopology(topologyFile, farm.topology)
+        print(f"{len(farm.hubs)} hubs, topology written to {topologyFile}")
+    lag = asyncio.get_running_loop().create_task(farm.watchLag())
+    try:
+        while True:
+            before = farm.requests
+            await asyncio.sleep(interval)
+            lag_p99, lag_max = farm.lagStats()
+            farm.lags.clear()
+            print(
+                f"{(farm.requests - before) / interval:.0f} requests/s, "
+                f"{farm.dropped} dropped, {farm.corrupted} corrupted, "
+                f"loop lag p99 {lag_p99 * 1000:.1f} ms max {lag_max * 1000:.1f} ms",
+                flush=True,
+            )
+    finally:
+        lag.cancel()
+        farm.close()
+
+
+def parseRange(text):
+    lo, _, hi = text.partition("-")
+    return float(lo) / 1000, float(hi or lo) / 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, help in (("serve", "run a farm until interrupted"), ("bench", "provision a farm in-process")):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("--latency", default="2-20", metavar="MS[-MS]", help="range of per-camera latency")
+        p.add_argument("--drop", type=float, default=0.0, help="mean fraction of replies never sent")
+        p.add_argument("--corrupt", type=float, default=0.0, help="mean fraction of replies with a flipped byte")
+        p.add_argument("--seed", type=int)
+        p.add_argument("--hub-size", type=int, default=0, metavar="PORTS", help="cameras per virtual USB hub")
+        p.add_argument(
+            "--hub-capacity", type=float, default=DEFAULT_HUB_CAPACITY, metavar="FRAMES",
+            help="frames per second through a hub",
+        )
+    s = sub.choices["serve"]
+    s.add_argument("--devices", type=int, default=100)
+    s.add_argument("--ports-file", metavar="FILE", help="write the port names here instead of printing them")
+    s.add_argument("--topology-file", metavar="FILE", help="write PORT HUB pairs here for --topology")
+    b = sub.choices["bench"]
+    b.add_argument("--sweep", default="100,250,500,1000", metavar="N,N,...", help="farm sizes to run")
+    b.add_argument("--workers", type=int, default=32, help="threads provisioning at once")
+    b.add_argument("--profile", metavar="JSON", help="settings profile, a small default if not given")
+    b.add_argument("--hub-budget", type=float, metavar="FRAMES", help="also run every size under a hub scheduler")
+    args = parser.parse_args(argv)
+
+    latency = parseRange(args.latency)
+    if args.command == "serve":
+        raiseFileLimit(args.devices)
+        try:
+            asyncio.run(
+                serve(
+                    args.devices, latency, args.drop, args.corrupt, args.ports_file, args.seed,
+                    hubSize=args.hub_size, hubCapacity=args.hub_capacity, topologyFile=args.topology_file,
+                )
+            )
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    import json
+
+    from provisioning import compileProfile, loadScript
+
+    profile = {"palette": 3, "brightness": 60, "contrast": 40}
+    if args.profile:
+        with open(args.profile) as f:
+            profile = json.load(f)
+    steps = loadScript(compileProfile(profile))
+    sizes = [int(n) for n in args.sweep.split(",")]
+    limit = raiseFileLimit(max(sizes))
+    for devices in sizes:
+        if devices * FDS_PER_DEVICE + 64 > limit:
+            print(f"{devices} devices: needs more file descriptors than the limit of {limit}")
+            continue
+        for hubBudget in (None, args.hub_budget) if args.hub_budget else (None,):
+            result = benchOnce(
+                devices, args.workers, steps, latency, args.drop, args.corrupt, args.seed,
+                args.hub_size, args.hub_capacity, hubBudget,
+            )
+            print(formatBench(result), flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
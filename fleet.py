@@ -0,0 +1,362 @@
+"""Multi-station provisioning
+
+A coordinator hands provisioning jobs to worker agents, one per station,
+over TCP and collects the results. A worker connects with the serial ports
+its station drives. The coordinator sends it one job (port, profile) per
+free port, and the worker replays the compiled script on that port and
+reports back.
+
+Each job goes to the station expected to finish it first, judged by how
+long that station has been taking per camera. Jobs from an order manifest
+belong to one unit each and only go to the port (and station, if given)
+the manifest connects that unit to. A slow station therefore does
+not pick up the last jobs while a fast one is about to free up. Jobs running
+on a station that disconnects go back into the queue.
+
+Protocol, one JSON object per line:
+    worker -> coordinator  {"type": "hello", "station": NAME, "ports": [PORT, ...]}
+    coordinator -> worker  {"type": "job", "id": N, "port": PORT, "profile": NAME, "script": HEX}
+    worker -> coordinator  {"type": "result", "id": N, "port": PORT, "ok": true, "elapsed": S, ...}
+    coordinator -> worker  {"type": "done"}
+
+Usage:
+    python fleet.py serve golden.json --count 200 --listen 0.0.0.0:5050
+    python fleet.py serve --manifest order.csv
+    python fleet.py work 192.168.1.10:5050 /dev/ttyUSB0 /dev/ttyUSB1 --station bench-1
+    python fleet.py work localhost:5050 sim:a sim:b sim:c@20 --station sim-1
+    python fleet.py work localhost:5050 /dev/ttyUSB* --hub-budget 400
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+import provisioning
+
+DEFAULT_ADDRESS = "localhost:5050"
+SPEED_WEIGHT = 0.3  # weight of the newest job in a station's running average
+OVERDUE = 3  # a job running this many times the average is not counted on
+SCHEDULE_INTERVAL = 0.1  # seconds
+DISCONNECT_TIMEOUT = 5.0
+
+
+def parseAddress(address):
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def encode(msg):
+    return (json.dumps(msg) + "\n").encode()
+
+
+class Station:
+    def __init__(self, name, ports, writer):
+        self.name = name
+        self.ports = ports
+        self.writer = writer
+        self.free = list(ports)
+        self.running = {}  # job id -> (job, port, start time)
+        self.jobTime = None  # running average seconds per job
+        self.done = 0
+        self.failed = 0
+
+    # expected time from now until this station could finish one more job;
+    # a station that has not finished a job yet is tried straight away
+    def estimate(self, now):
+        if self.jobTime is None:
+            return 0.0 if self.free else float("inf")
+        if self.free:
+            return self.jobTime
+        ends = [
+            start + self.jobTime
+            for job, port, start in self.running.values()
+            if now - start < OVERDUE * self.jobTime
+        ]
+        if not ends:
+            return float("inf")
+        return max(min(ends) - now, 0.0) + self.jobTime
+
+    def send(self, msg):
+        self.writer.write(encode(msg))
+
+
+class Coordinator:
+    # jobs are (job id, profile name, station, port); a job with a port only
+    # runs on that port, of the given station or of any station if None
+    def __init__(self, jobs, scripts, log=print):
+        self.queue = deque(job for job in jobs if not job[3])
+        self.pinned = {}  # (station, port) -> deque of jobs waiting for that port
+        for job in jobs:
+            if job[3]:
+                self.pinned.setdefault((job[2], job[3]), deque()).append(job)
+        self.total = len(jobs)
+        self.scripts = scripts  # profile name -> script hex
+        self.log = log
+        self.stations = []
+        self.handlers = set()
+        self.results = []
+        self.finished = asyncio.Event()
+        self.start = None
+
+    def schedule(self):
+        now = time.monotonic()
+        if self.pinned:
+            for station in self.stations:
+                for port in list(station.free):
+                    for key in ((station.name, port), (None, port)):
+                        waiting = self.pinned.get(key)
+                        if waiting:
+                            job = waiting.popleft()
+                            if not waiting:
+                                del self.pinned[key]
+                            station.free.remove(port)
+                            self.dispatch(station, job, port, now)
+                            break
+        while self.queue and self.stations:
+            best = min(self.stations, key=lambda s: (s.estimate(now), -len(s.free)))
+            if not best.free:
+                return
+            self.dispatch(best, self.queue.popleft(), best.free.pop(0), now)
+
+    def dispatch(self, station, job, port, now):
+        station.running[job[0]] = (job, port, now)
+        station.send(
+            {
+                "type": "job",
+                "id": job[0],
+                "port": port,
+                "profile": job[1],
+                "script": self.scripts[job[1]],
+            }
+        )
+
+    def requeue(self, job):
+        if job[3]:
+            self.pinned.setdefault((job[2], job[3]), deque()).appendleft(job)
+        else:
+            self.queue.appendleft(job)
+
+    def finishJob(self, station, msg):
+        entry = station.running.pop(msg["id"], None)
+        if entry is None:
+            return
+        job, port, start = entry
+        took = time.monotonic() - start
+        station.free.append(port)
+        if station.jobTime is None:
+            station.jobTime = took
+        else:
+            station.jobTime += SPEED_WEIGHT * (took - station.jobTime)
+        station.done += 1
+        if not msg.get("ok"):
+            station.failed += 1
+            self.log(f"{station.name} {port}: job {job[0]} failed: {msg.get('error') or msg}")
+        result = dict(msg, station=station.name, profile=job[1], took=took)
+        del result["type"]
+        self.results.append(result)
+        if len(self.results) == self.total:
+            self.finished.set()
+
+    async def handle(self, reader, writer):
+        station = None
+        self.handlers.add(asyncio.current_task())
+        try:
+            hello = json.loads(await reader.readline() or "{}")
+            if hello.get("type") != "hello" or not hello.get("ports"):
+                return
+            station = Station(hello["station"], hello["ports"], writer)
+            self.stations.append(station)
+            if self.start is None:
+                self.start = time.monotonic()
+            self.log(f"{station.name} joined with {len(station.ports)} ports")
+            self.schedule()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line)
+                if msg.get("type") == "result":
+                    self.finishJob(station, msg)
+                    self.schedule()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            if station is not None:
+                self.stations.remove(station)
+                if station.running:
+                    self.log(f"{station.name} left, requeueing {len(station.running)} jobs")
+                for job, port, start in station.running.values():
+                    self.requeue(job)
+                self.schedule()
+            writer.close()
+            self.handlers.discard(asyncio.current_task())
+
+    async def tick(self):
+        while not self.finished.is_set():
+            await asyncio.sleep(SCHEDULE_INTERVAL)
+            self.schedule()
+
+    async def run(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        ticker = asyncio.create_task(self.tick())
+        if self.total:
+            await self.finished.wait()
+        ticker.cancel()
+        for station in self.stations:
+            station.send({"type": "done"})
+            await station.writer.drain()
+        # workers hang up once their last job is reported
+        if self.handlers:
+            await asyncio.wait(self.handlers, timeout=DISCONNECT_TIMEOUT)
+        server.close()
+        await server.wait_closed()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start if self.start else 0.0
+        stations = {}
+        for result in self.results:
+            stats = stations.setdefault(result["station"], [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += not result.get("ok")
+            stats[2] += result["took"]
+        lines = [
+            f"{name}: {jobs} jobs, {failed} failed, {took / jobs:.2f} s/job"
+            for name, (jobs, failed, took) in sorted(stations.items())
+        ]
+        rate = len(self.results) / elapsed * 60 if elapsed else 0.0
+        lines.append(f"{len(self.results)} jobs in {elapsed:.1f} s, {rate:.1f} cameras/min")
+        return "\n".join(lines)
+
+
+# Always answers the job with a result, also when the port cannot be opened
+# or the replay fails, so that neither side is left waiting for it
+def runJob(msg, send, lowLatency=False, scheduler=None):
+    from transport import openTransport
+
+    result = {"type": "result", "id": msg["id"], "port": msg["port"]}
+    transport = None
+    try:
+        transport = openTransport(msg["port"], lowLatency=lowLatency)
+        if transport is None:
+            result.update(ok=False, error="could not open port")
+            return
+        if scheduler is not None:
+            transport = scheduler.wrap(transport, msg["port"])
+        steps = provisioning.loadScript(bytes.fromhex(msg["script"]))
+        result.update(provisioning.replayWithRecovery(transport, steps))
+    except Exception as e:
+        result.update(ok=False, error=f"{type(e).__name__}: {e}")
+    finally:
+        if transport is not None:
+            transport.close()
+        send(result)
+
+
+# Connects to the coordinator and runs jobs until it says done. Each job runs
+# in its own thread; the coordinator never sends two jobs for the same port.
+# Frames wait for their hub's budget if a HubScheduler is given.
+def work(address, ports, station, lowLatency=False, scheduler=None):
+    sock = socket.create_connection(parseAddress(address))
+    lock = threading.Lock()
+
+    def send(msg):
+        with lock:
+            sock.sendall(encode(msg))
+
+    send({"type": "hello", "station": station, "ports": ports})
+    jobs = 0
+    threads = []
+    for line in sock.makefile("r"):
+        msg = json.loads(line)
+        if msg["type"] == "done":
+            break
+        if msg["type"] == "job":
+            thread = threading.Thread(target=runJob, args=(msg, send, lowLatency, scheduler))
+            thread.start()
+            threads.append(thread)
+            jobs += 1
+    for thread in threads:
+        thread.join()
+    sock.close()
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    s = sub.add_parser("serve", help="hand out jobs to workers and collect results")
+    s.add_argument("profiles", nargs="*", help="JSON profiles, each provisioned --count times")
+    s.add_argument("--count", type=int, default=1)
+    s.add_argument("--manifest", metavar="FILE", help="CSV or JSON-lines file with one job per unit and its port")
+    s.add_argument("--listen", default=DEFAULT_ADDRESS, metavar="HOST:PORT")
+    s.add_argument("--results", metavar="FILE", help="write one JSON line per job")
+    w = sub.add_parser("work", help="run jobs on this station's ports")
+    w.add_argument("coordinator", metavar="HOST:PORT")
+    w.add_argument("ports", nargs="+")
+    w.add_argument("--station", default=socket.gethostname())
+    w.add_argument("--low-latency", action="store_true", help="use the Linux low-latency serial backend")
+    w.add_argument("--hub-budget", type=float, metavar="FRAMES", help="request frames per second per USB hub")
+    w.add_argument("--topology", metavar="FILE", help="PORT HUB pairs for ports sysfs does not know")
+    args = parser.parse_args(argv)
+
+    if args.command == "work":
+        scheduler = None
+        if args.hub_budget:
+            from hubscheduler import HubScheduler, loadTopology
+
+            scheduler = HubScheduler(args.hub_budget, loadTopology(args.topology) if args.topology else None)
+        jobs = work(args.coordinator, args.ports, args.station, args.low_latency, scheduler)
+        print(f"{args.station}: ran {jobs} jobs")
+        if scheduler is not None:
+            print(scheduler.report())
+        return 0
+
+    if not args.profiles and not args.manifest:
+        s.error("give profiles or --manifest")
+    scripts = {}
+    jobs = []
+    if args.manifest:
+        from manifest import formatError, loadManifest
+
+        units, errors, count = loadManifest(args.manifest, placed=True)
+        if count:
+            for error in errors:
+                print(f"{args.manifest}: {formatError(error)}")
+            print(f"{args.manifest}: {count} errors, nothing provisioned")
+            return 1
+        hexes = {}  # units with the same settings share one script
+        for unit in units:
+            if unit.script not in hexes:
+                hexes[unit.script] = unit.script.hex()
+            scripts[unit.key] = hexes[unit.script]
+        jobs = [(unit.key, unit.station or None, unit.port) for unit in units]
+    names = []
+    for path in args.profiles:
+        with open(path) as f:
+            profile = json.load(f)
+        try:
+            scripts[os.path.basename(path)] = provisioning.compileProfile(profile).hex()
+            names.append(os.path.basename(path))
+        except ValueError as e:
+            print(f"{path}: compile error: {e}")
+            return 1
+    jobs += [(name, None, None) for name in names for _ in range(args.count)]
+    jobs = [(i, *job) for i, job in enumerate(jobs)]
+    coordinator = Coordinator(jobs, scripts)
+    asyncio.run(coordinator.run(*parseAddress(args.listen)))
+    print(coordinator.summary())
+    if args.results:
+        with open(args.results, "w") as f:
+            for result in coordinator.results:
+                f.write(json.dumps(result) + "\n")
+    return 1 if any(not r.get("ok") for r in coordinator.results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,437 @@
+"""Fleet view
+
+A table with one row per camera showing its model, FPGA version, every
+writable setting, link status and last round-trip time. Settings are edited
+in place and read back once the camera acknowledges the write.
+
+Replies only touch the cells whose value actually changed. Changed cells are
+collected and reported to the view in one pass per display frame, so that a
+hundred cameras answering at once cost a handful of repaints rather than one
+per reply.
+
+Usage:
+    python fleetview.py /dev/ttyUSB0 /dev/ttyUSB1 ...
+    python fleetview.py sim:a sim:b sim:c@20 --poll
+"""
+
+import argparse
+import sys
+import time
+from collections import deque
+
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtSerialPort import QSerialPort, QSerialPortInfo
+
+import HM_TM5X
+from batching import MAX_BATCH_FRAMES
+from linkwatchdog import replyTimeout
+from simulator import SIM_PREFIX, VirtualCamera
+from statestore import ONLINE, DeviceStore
+from transport import DEFAULT_BAUD_RATE
+
+SETTING_TITLES = {
+    "autoShutterControl": "Auto Shutter",
+    "brightness": "Brightness",
+    "contrast": "Contrast",
+    "imageDetailDigitalEnhancement": "Detail Enh.",
+    "staticDenoisingLevel": "Static Denoise",
+    "dynamicDenoisingLevel": "Dynamic Denoise",
+    "palette": "Palette",
+    "imageMirroring": "Mirroring",
+}
+SETTING_NAMES = list(HM_TM5X.SETTINGS)
+HEADERS = ["Port", "Model", "FPGA", *(SETTING_TITLES[n] for n in SETTING_NAMES), "Link", "Latency"]
+PORT, MODEL, FPGA = 0, 1, 2
+FIRST_SETTING = 3
+LINK = FIRST_SETTING + len(SETTING_NAMES)
+LATENCY = LINK + 1
+
+# handleReply function number -> column, and the reads sent on refresh
+COLUMNS = {1: MODEL, 2: FPGA}
+READS = {1: HM_TM5X.readModel, 2: HM_TM5X.FPGAVersionNumber}
+for i, name in enumerate(SETTING_NAMES):
+    builder, function, max_val = HM_TM5X.SETTINGS[name]
+    COLUMNS[function] = FIRST_SETTING + i
+    READS[function] = builder
+
+# settings whose values have names are edited with a list of those names
+CHOICES = {}
+for function, replies in HM_TM5X.REPLY_TABLE.items():
+    names = [text for frame, text in sorted(replies.items(), key=lambda item: item[0][6])]
+    if function in COLUMNS and names and not names[0].isdigit():
+        CHOICES[function] = names
+
+POLL_INTERVAL = 5000  # ms
+CHECK_INTERVAL = 100  # ms
+
+
+# Stands in for a QSerialPort in front of a simulated camera, so "sim:" ports
+# can be watched without hardware
+class SimulatedPort(QtCore.QObject):
+    readyRead = pyqtSignal()
+    errorOccurred = pyqtSignal(int)
+
+    def __init__(self, portName, parent=None):
+        super().__init__(parent)
+        self.camera = VirtualCamera(portName, timeout=0)
+        self.timer = QtCore.QTimer(self, singleShot=True, timeout=self.deliver)
+
+    def open(self, mode):
+        return self.camera.open()
+
+    def close(self):
+        self.camera.close()
+
+    def isOpen(self):
+        return self.camera.isOpen()
+
+    def portName(self):
+        return self.camera.portName
+
+    def write(self, data):
+        self.camera.write(data)
+        self.schedule()
+        return len(data)
+
+    def readAll(self):
+        return self.camera.read(1 << 16)
+
+    def schedule(self):
+        if self.camera.outbox and not self.timer.isActive():
+            wait = self.camera.outbox[0][0] - time.monotonic()
+            self.timer.start(max(int(wait * 1000), 0))
+
+    def deliver(self):
+        self.readyRead.emit()
+        self.schedule()
+
+
+# One camera of the fleet. Requests are pipelined, at most MAX_BATCH_FRAMES
+# unanswered at a time, and each decoded reply is reported as
+# changed(column, display text, raw DATA byte or None).
+class FleetDevice(QtCore.QObject):
+    changed = pyqtSignal(int, object, object)
+
+    def __init__(self, portName, baudRate=DEFAULT_BAUD_RATE, parent=None):
+        super().__init__(parent)
+        if portName.startswith(SIM_PREFIX):
+            self.port = SimulatedPort(portName, self)
+        else:
+            self.port = QSerialPort(portName, self, baudRate=baudRate)
+        self.port.readyRead.connect(self.receive)
+        self.port.errorOccurred.connect(self.onError)
+        self.name = portName
+        self.queue = deque()  # (function, frame) waiting to be sent
+        self.inflight = deque()  # (function, frame, sent at)
+        self.incoming = b""
+
+    def open(self):
+        if not self.port.open(QtCore.QIODevice.ReadWrite):
+            self.changed.emit(LINK, "cannot open", None)
+            return False
+        self.changed.emit(LINK, "connected", None)
+        self.refresh()
+        return True
+
+    def close(self):
+        self.queue.clear()
+        self.inflight.clear()
+        self.port.close()
+        self.changed.emit(LINK, "closed", None)
+
+    def isOpen(self):
+        return self.port.isOpen()
+
+    def onError(self, error):
+        if error != QSerialPort.NoError:
+            self.changed.emit(LINK, f"error {error}", None)
+
+    def refresh(self):
+        for function, builder in READS.items():
+            self.request(function, bytes.fromhex(builder()))
+
+    def writeSetting(self, name, value):
+        builder, function, max_val = HM_TM5X.SETTINGS[name]
+        text = builder(value, True)
+        if text[:2] == "-1" or not self.port.isOpen():
+            return False
+        self.request(function, bytes.fromhex(text))
+        return True
+
+    def request(self, function, frame):
+        self.queue.append((function, frame))
+        self.pump()
+
+    def pump(self):
+        frames = []
+        while self.queue and len(self.inflight) + len(frames) < MAX_BATCH_FRAMES:
+            frames.append(self.queue.popleft())
+        if not frames:
+            return
+        now = time.monotonic()
+        self.inflight.extend((function, frame, now) for function, frame in frames)
+        self.port.write(b"".join(frame for function, frame in frames))
+
+    def take(self, reply):
+        for i, entry in enumerate(self.inflight):
+            if entry[1][3:5] == reply[3:5]:
+                del self.inflight[i]
+                return entry
+        return None
+
+    def receive(self):
+        self.incoming += bytes(self.port.readAll())
+        frames, self.incoming = HM_TM5X.splitFrames(self.incoming)
+        now = time.monotonic()
+        for reply in frames:
+            entry = self.take(reply)
+            if entry is None:
+                continue
+            function, request, sentAt = entry
+            self.changed.emit(LATENCY, f"{(now - sentAt) * 1000:.1f} ms", None)
+            self.changed.emit(LINK, "connected", None)
+            if request[5] == HM_TM5X.WRITE_FLAG:
+                # read the setting back so the table shows what the camera holds
+                if reply.hex().upper() == HM_TM5X.ackReply(request.hex().upper()):
+                    self.request(function, bytes.fromhex(READS[function]()))
+                else:
+                    self.changed.emit(LINK, "write rejected", None)
+                continue
+            data = HM_TM5X.decodeReply(reply, function)
+            if data[:2] != "-1":
+                raw = reply[6] if len(reply) == 9 else None
+                self.changed.emit(COLUMNS[function], data, raw)
+        self.pump()
+
+    # drops requests that went unanswered for longer than their reply timeout
+    def check(self, now):
+        while self.inflight:
+            function, frame, sentAt = self.inflight[0]
+            if now - sentAt < replyTimeout(function):
+                break
+            self.inflight.popleft()
+            self.changed.emit(LINK, "no reply", None)
+        self.pump()
+
+
+class FleetModel(QtCore.QAbstractTableModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.devices = []
+        self.cells = []  # per row: display text of every column
+        self.raw = []  # per row: raw DATA byte of every column
+        self.store = DeviceStore()  # settings and link state by row, for fleet-wide queries
+        self.dirty = set()
+        self.signalsEmitted = 0
+        screen = QtGui.QGuiApplication.primaryScreen()
+        rate = screen.refreshRate() if screen is not None else 0
+        self.flushTimer = QtCore.QTimer(
+            self,
+            singleShot=True,
+            interval=int(1000 / (rate if rate > 0 else 60)),
+            timeout=self.flushChanges,
+        )
+
+    def addDevice(self, device):
+        row = len(self.devices)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self.devices.append(device)
+        self.cells.append([device.name] + [""] * (len(HEADERS) - 1))
+        self.raw.append([None] * len(HEADERS))
+        self.store.add(device.name)
+        self.endInsertRows()
+        device.changed.connect(
+            lambda column, display, raw, row=row: self.setCell(row, column, display, raw)
+        )
+
+    def setCell(self, row, column, display, raw=None):
+        if self.cells[row][column] == display and self.raw[row][column] == raw:
+            return
+        self.cells[row][column] = display
+        self.raw[row][column] = raw
+        if FIRST_SETTING <= column < LINK and raw is not None:
+            self.store.set(row, SETTING_NAMES[column - FIRST_SETTING], raw)
+        elif column == LINK:
+            self.store.setFlag(row, ONLINE, display == "connected")
+        self.dirty.add((row, column))
+        if not self.flushTimer.isActive():
+            self.flushTimer.start()
+
+    # one dataChanged per run of neighbouring changed cells in a row
+    def flushChanges(self):
+        dirty = sorted(self.dirty)
+        self.dirty.clear()
+        i = 0
+        while i < len(dirty):
+            row, first = dirty[i]
+            last = first
+            while i + 1 < len(dirty) and dirty[i + 1] == (row, last + 1):
+                i += 1
+                last += 1
+            self.dataChanged.emit(
+                self.index(row, first), self.index(row, last), [Qt.DisplayRole, Qt.EditRole]
+            )
+            self.signalsEmitted += 1
+            i += 1
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.devices)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return self.cells[index.row()][index.column()]
+        if role == Qt.EditRole:
+            return self.raw[index.row()][index.column()]
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if FIRST_SETTING <= index.column() < LINK and self.devices[index.row()].isOpen():
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not FIRST_SETTING <= index.column() < LINK:
+            return False
+        name = SETTING_NAMES[index.column() - FIRST_SETTING]
+        return self.devices[index.row()].writeSetting(name, int(value))
+
+
+# settings with named values get a combo box, the rest a spin box
+class SettingDelegate(QtWidgets.QStyledItemDelegate):
+    def createEditor(self, parent, option, index):
+        builder, function, max_val = HM_TM5X.SETTINGS[SETTING_NAMES[index.column() - FIRST_SETTING]]
+        if function in CHOICES:
+            editor = QtWidgets.QComboBox(parent)
+            editor.addItems(CHOICES[function])
+            return editor
+        return QtWidgets.QSpinBox(parent, maximum=max_val)
+
+    def setEditorData(self, editor, index):
+        value = index.data(Qt.EditRole) or 0
+        if isinstance(editor, QtWidgets.QComboBox):
+            editor.setCurrentIndex(value)
+        else:
+            editor.setValue(value)
+
+    def setModelData(self, editor, model, index):
+        if isinstance(editor, QtWidgets.QComboBox):
+            model.setData(index, editor.currentIndex(), Qt.EditRole)
+        else:
+            model.setData(index, editor.value(), Qt.EditRole)
+
+
+class FleetWindow(QtWidgets.QWidget):
+    def __init__(self, baudRate=DEFAULT_BAUD_RATE, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Fleet View")
+        self.baudRate = baudRate
+        self.model = FleetModel(self)
+        self.table = QtWidgets.QTableView()
+        self.table.setModel(self.model)
+        delegate = SettingDelegate(self.table)
+        for column in range(FIRST_SETTING, LINK):
+            self.table.setItemDelegateForColumn(column, delegate)
+        self.table.verticalHeader().setDefaultSectionSize(self.fontMetrics().height() + 4)
+
+        self.portsLE = QtWidgets.QLineEdit(placeholderText="Ports to add, e.g. COM3 COM4 or sim:a")
+        addButton = QtWidgets.QPushButton(text="Add", clicked=self.addFromText)
+        self.portsLE.returnPressed.connect(addButton.click)
+        addAllButton = QtWidgets.QPushButton(text="Add All Ports", clicked=self.addAllPorts)
+        refreshButton = QtWidgets.QPushButton(text="Refresh All", clicked=self.refreshAll)
+        self.pollBox = QtWidgets.QCheckBox(
+            f"Poll every {POLL_INTERVAL // 1000} s", toggled=self.togglePolling
+        )
+        self.statusLabel = QtWidgets.QLabel()
+
+        hlay = QtWidgets.QHBoxLayout()
+        hlay.addWidget(self.portsLE)
+        hlay.addWidget(addButton)
+        hlay.addWidget(addAllButton)
+        hlay.addWidget(refreshButton)
+        hlay.addWidget(self.pollBox)
+        lay = QtWidgets.QVBoxLayout(self)
+        lay.addLayout(hlay)
+        lay.addWidget(self.table)
+        lay.addWidget(self.statusLabel)
+
+        self.checkTimer = QtCore.QTimer(self, interval=CHECK_INTERVAL, timeout=self.checkDevices)
+        self.checkTimer.start()
+        self.pollTimer = QtCore.QTimer(self, interval=POLL_INTERVAL, timeout=self.refreshAll)
+        self.resize(1100, 600)
+
+    def addPorts(self, ports):
+        known = {device.name for device in self.model.devices}
+        for port in ports:
+            if port in known:
+                continue
+            device = FleetDevice(port, self.baudRate, self)
+            self.model.addDevice(device)
+            device.open()
+        self.updateStatus()
+
+    def addFromText(self):
+        self.addPorts(self.portsLE.text().split())
+        self.portsLE.clear()
+
+    def addAllPorts(self):
+        self.addPorts(sorted(info.portName() for info in QSerialPortInfo.availablePorts()))
+
+    def refreshAll(self):
+        for device in self.model.devices:
+            if device.isOpen():
+                device.refresh()
+
+    def togglePolling(self, checked):
+        if checked:
+            self.pollTimer.start()
+        else:
+            self.pollTimer.stop()
+
+    def checkDevices(self):
+        now = time.monotonic()
+        for device in self.model.devices:
+            device.check(now)
+        self.updateStatus()
+
+    def updateStatus(self):
+        store = self.model.store
+        palettes = ", ".join(f"{n} {name}" for name, n in store.histogram("palette").items())
+        self.statusLabel.setText(
+            f"{len(store)} cameras, {store.countFlag(ONLINE)} connected, "
+            f"{self.model.signalsEmitted} cell updates" + (f"; {palettes}" if palettes else "")
+        )
+
+    def closeEvent(self, event):
+        for device in self.model.devices:
+            device.close()
+        super().closeEvent(event)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("ports", nargs="*")
+    parser.add_argument("--baud", type=int, default=DEFAULT_BAUD_RATE)
+    parser.add_argument("--poll", action="store_true", help="re-read every camera periodically")
+    args, qt_args = parser.parse_known_args(argv)
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    window = FleetWindow(args.baud)
+    window.addPorts(args.ports)
+    window.pollBox.setChecked(args.poll)
+    window.show()
+    return app.exec_()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
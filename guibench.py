@@ -0,0 +1,298 @@
+"""GUI responsiveness under a serial flood
+
+Runs MainWindow on the Qt offscreen platform against a stand-in device that
+floods its port: a mix of well-formed reply frames nobody asked for, line
+noise and frames cut short, at a fixed byte rate. The stand-in runs in its
+own process behind a pseudo-terminal and still answers the window's own
+requests, so connecting and reading the device state work as usual.
+
+While the flood runs the benchmark measures
+  - event loop stalls, from how late a PROBE_INTERVAL timer fires,
+  - input-to-paint latency, from posting a key press to the line edit until
+    the line edit has painted it, every INPUT_INTERVAL,
+  - memory growth, resident set size after the warm-up against the end.
+It exits with 1 when a threshold is exceeded, so that a change to receive()
+or updateText() that makes the window choke on a busy port is noticed.
+
+The default rate saturates a 115200 baud line, the most a real adapter at
+the default baud rate can deliver.
+
+Usage:
+    python guibench.py run --seconds 10
+    python guibench.py run --rate 46080 --garbage 0.5 --max-stall 250
+    python guibench.py flood --seconds 60     stand-in device only, prints its port
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tty
+
+import HM_TM5X
+
+DEFAULT_RATE = 11520  # bytes per second, 115200 baud with 8N1 framing
+DEFAULT_GARBAGE = 0.3  # share of the flood that is line noise
+TICK = 0.002  # seconds between writes of the stand-in
+POOL_SIZE = 1 << 16  # bytes of flood generated up front and sent round robin
+PROBE_INTERVAL = 1  # ms
+INPUT_INTERVAL = 100  # ms
+WARMUP = 1.0  # seconds before memory is first measured
+MAX_STALL = 100.0  # ms, longest the event loop may stall
+MAX_P99_STALL = 20.0  # ms
+MAX_INPUT_LATENCY = 100.0  # ms, worst input-to-paint latency
+MAX_MEMORY_GROWTH = 64.0  # MiB
+
+
+# Builds the flood: reply frames of every setting, random bytes and frames
+# cut short, garbage being the share of random bytes
+def floodPool(garbage, seed=0, size=POOL_SIZE):
+    from simulator import VirtualCamera
+
+    rng = random.Random(seed)
+    camera = VirtualCamera("sim:flood")
+    replies = [
+        camera.respond(bytes.fromhex(builder()))
+        for builder, function, max_val in HM_TM5X.SETTINGS.values()
+    ]
+    pool = bytearray()
+    while len(pool) < size:
+        r = rng.random()
+        if r < garbage:
+            pool += rng.randbytes(rng.randrange(1, 32))
+        elif r < garbage + (1 - garbage) / 10:
+            reply = rng.choice(replies)
+            pool += reply[: rng.randrange(1, len(reply))]
+        else:
+            pool += rng.choice(replies)
+    return bytes(pool[:size])
+
+
+# The stand-in device. Prints the port name, floods for `seconds` while
+# answering whatever the other side sends, then prints bytes written and
+# bytes dropped because the other side did not keep up.
+def flood(rate, garbage, seconds, seed=0):
+    from simulator import VirtualCamera
+
+    pool = floodPool(garbage, seed)
+    camera = VirtualCamera("sim:flood")
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    os.set_blocking(master, False)
+    print(os.ttyname(slave), flush=True)
+    received = b""
+    written = dropped = offset = 0
+    start = time.monotonic()
+    while (now := time.monotonic()) - start < seconds:
+        try:
+            received += os.read(master, 4096)
+        except (BlockingIOError, OSError):
+            pass
+        frames, received = HM_TM5X.splitFrames(received)
+        out = b"".join(camera.respond(frame) for frame in frames)
+        due = int((now - start) * rate) - written - dropped
+        while due > 0:
+            chunk = pool[offset : offset + due]
+            out += chunk
+            due -= len(chunk)
+            offset = (offset + len(chunk)) % len(pool)
+        if out:
+            try:
+                n = os.write(master, out)
+            except (BlockingIOError, OSError):
+                n = 0
+            written += n
+            dropped += len(out) - n
+        time.sleep(TICK)
+    print(f"{written} {dropped}", flush=True)
+    os.close(master)
+    os.close(slave)
+
+
+def residentMiB():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0.0
+
+
+# Floods a MainWindow for `seconds` and returns the measurements
+def runBench(seconds, rate, garbage, seed=0):
+    import subprocess
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    device = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "flood", "--rate", str(rate),
+         "--garbage", str(garbage), "--seconds", str(seconds + WARMUP + 1), "--seed", str(seed)],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    port = device.stdout.readline().strip()
+    try:
+        return measure(port, seconds, rate, garbage, device)
+    finally:
+        if device.poll() is None:
+            device.kill()
+            device.wait()
+
+
+# Runs the window against the stand-in device on `port` and measures it
+def measure(port, seconds, rate, garbage, device):
+    from PyQt5 import QtCore, QtGui
+    from PyQt5.QtWidgets import QApplication
+
+    import main
+
+    app = QApplication.instance() or QApplication([])
+    w = main.MainWindow()
+    w.show()
+    w.chooseCOMPort(port)
+    w.connectPortButton.setChecked(True)
+
+    stalls = []
+    latencies = []
+    posted = []  # time the key press waiting to be painted was posted
+    memory = []
+    last = [time.perf_counter()]
+
+    def probe():
+        now = time.perf_counter()
+        stalls.append(max(0.0, now - last[0] - PROBE_INTERVAL / 1000))
+        last[0] = now
+
+    class PaintWatch(QtCore.QObject):
+        def eventFilter(self, obj, event):
+            if event.type() == QtCore.QEvent.Paint and posted:
+                latencies.append(time.perf_counter() - posted.pop())
+            return False
+
+    def press():
+        if posted:  # the last press has not been painted yet
+            return
+        if len(w.sendLE.text()) > 40:
+            w.sendLE.clear()
+        posted.append(time.perf_counter())
+        QApplication.postEvent(
+            w.sendLE, QtGui.QKeyEvent(QtCore.QEvent.KeyPress, QtCore.Qt.Key_A, QtCore.Qt.NoModifier, "a")
+        )
+
+    watch = PaintWatch()
+    w.sendLE.installEventFilter(watch)
+    probeTimer = QtCore.QTimer(interval=PROBE_INTERVAL, timeout=probe)
+    probeTimer.setTimerType(QtCore.Qt.PreciseTimer)
+    inputTimer = QtCore.QTimer(interval=INPUT_INTERVAL, timeout=press)
+
+    def startMeasuring():
+        stalls.clear()
+        latencies.clear()
+        memory.append(residentMiB())
+        last[0] = time.perf_counter()
+        probeTimer.start()
+        inputTimer.start()
+
+    def stop():
+        probeTimer.stop()
+        inputTimer.stop()
+        memory.append(residentMiB())
+        app.quit()
+
+    QtCore.QTimer.singleShot(int(WARMUP * 1000), startMeasuring)
+    QtCore.QTimer.singleShot(int((WARMUP + seconds) * 1000), stop)
+    app.exec_()
+    unanswered = len(posted)
+    w.connectPortButton.setChecked(False)
+    w.close()
+    written, dropped = (int(n) for n in device.stdout.readline().split() or (0, 0))
+    device.wait()
+    return {
+        "seconds": seconds,
+        "rate": rate,
+        "garbage": garbage,
+        "flood_written": written,
+        "flood_dropped": dropped,
+        "stall_p99": percentile(stalls, 0.99) * 1000,
+        "stall_max": max(stalls, default=0.0) * 1000,
+        "input_median": percentile(latencies, 0.5) * 1000,
+        "input_max": max(latencies, default=0.0) * 1000,
+        "inputs": len(latencies),
+        "inputs_unpainted": unanswered,
+        "memory_start": memory[0],
+        "memory_growth": memory[-1] - memory[0],
+    }
+
+
+def formatBench(result):
+    return "\n".join(
+        [
+            f"flood of {result['rate']} bytes/s, {result['garbage'] * 100:.0f}% noise, "
+            f"for {result['seconds']:g} s: {result['flood_written']} bytes sent, "
+            f"{result['flood_dropped']} of them not taken in time",
+            f"event loop stalls: p99 {result['stall_p99']:.1f} ms, max {result['stall_max']:.1f} ms",
+            f"input to paint: median {result['input_median']:.1f} ms, max {result['input_max']:.1f} ms "
+            f"over {result['inputs']} key presses, {result['inputs_unpainted']} never painted",
+            f"memory: {result['memory_start']:.0f} MiB after warm-up, grew {result['memory_growth']:.1f} MiB",
+        ]
+    )
+
+
+# Returns a line for every threshold the result exceeds
+def checkThresholds(result, maxStall, maxP99Stall, maxInputLatency, maxMemoryGrowth):
+    failures = []
+    if result["stall_max"] > maxStall:
+        failures.append(f"event loop stalled {result['stall_max']:.1f} ms, more than {maxStall:g} ms")
+    if result["stall_p99"] > maxP99Stall:
+        failures.append(f"p99 stall {result['stall_p99']:.1f} ms, more than {maxP99Stall:g} ms")
+    if result["input_max"] > maxInputLatency or result["inputs_unpainted"] or not result["inputs"]:
+        failures.append(f"input to paint took up to {result['input_max']:.1f} ms, more than {maxInputLatency:g} ms")
+    if result["memory_growth"] > maxMemoryGrowth:
+        failures.append(f"memory grew {result['memory_growth']:.1f} MiB, more than {maxMemoryGrowth:g} MiB")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, help in (("run", "flood the window and check it stays usable"), ("flood", "run the stand-in device")):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("--rate", type=int, default=DEFAULT_RATE, help="bytes per second")
+        p.add_argument("--garbage", type=float, default=DEFAULT_GARBAGE, help="share of line noise")
+        p.add_argument("--seconds", type=float, default=10.0)
+        p.add_argument("--seed", type=int, default=0)
+    r = sub.choices["run"]
+    r.add_argument("--max-stall", type=float, default=MAX_STALL, metavar="MS")
+    r.add_argument("--max-p99-stall", type=float, default=MAX_P99_STALL, metavar="MS")
+    r.add_argument("--max-input-latency", type=float, default=MAX_INPUT_LATENCY, metavar="MS")
+    r.add_argument("--max-memory-growth", type=float, default=MAX_MEMORY_GROWTH, metavar="MIB")
+    r.add_argument("--json", metavar="FILE", help="also write the measurements as JSON")
+    args = parser.parse_args(argv)
+
+    if args.command == "flood":
+        flood(args.rate, args.garbage, args.seconds, args.seed)
+        return 0
+
+    result = runBench(args.seconds, args.rate, args.garbage, args.seed)
+    print(formatBench(result))
+    if args.json:
+        import json
+
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    failures = checkThresholds(
+        result, args.max_stall, args.max_p99_stall, args.max_input_latency, args.max_memory_growth
+    )
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
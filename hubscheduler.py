@@ -0,0 +1,238 @@
+"""USB-hub-aware transmit scheduling
+
+Dozens of USB-TTL adapters behind one hub share its bandwidth and its
+transaction translator. When all of them transmit freely the hub queues and
+drops frames, which shows up as latency spikes and missing replies, and
+every missing reply costs a step timeout and a reconnect. The scheduler
+groups ports by the hub they hang off, found from sysfs on Linux, and gives
+every hub a budget of request frames per second, enforced with a token
+bucket. Reservations are served first come, first served; as every port
+has at most one request outstanding, the ports of a hub share its budget
+evenly.
+
+The budget adapts to what the hub can take: every on-time reply raises the
+rate a little up to the configured budget, and a reply that is lost or
+takes more than RTT_FACTOR times the port's best time for that command
+lowers it by DECREASE, at most once per DECREASE_HOLDOFF.
+
+Ports that are not on a USB hub, such as built-in UARTs, pseudo-terminals
+and simulated cameras, each get a bucket of their own unless a topology
+file names their hub, one "PORT HUB" pair per line.
+
+Usage:
+    python hubscheduler.py topology /dev/ttyUSB*
+    python provisioning.py replay golden.hmtp PORT... --processes 8 --hub-budget 400
+    python fleet.py work HOST:PORT PORT... --hub-budget 400
+    python farm.py bench --hub-size 16 --hub-capacity 800 --hub-budget 600
+"""
+
+import argparse
+import os
+import re
+import sys
+import threading
+import time
+
+SYSFS_TTY = "/sys/class/tty/{}/device"
+USB_DEVICE = re.compile(r"^\d+-\d+(\.\d+)*$")  # e.g. 1-1.4, interfaces are 1-1.4:1.0
+DEFAULT_BUDGET = 500.0  # request frames per second per hub
+BURST = 4  # frames a quiet hub may send back to back
+MIN_RATE = 0.1  # the rate never drops below this share of the budget
+INCREASE = 0.05  # frames/s added per on-time reply
+DECREASE = 0.7  # the rate is multiplied by this on congestion
+DECREASE_HOLDOFF = 0.1  # seconds between two decreases
+RTT_FACTOR = 2.0  # a reply this many times slower than the port's best is late
+RTT_SLACK = 0.003  # seconds of jitter that never count as late
+
+
+# Returns the sysfs name of the hub a USB serial port hangs off, e.g. "1-1"
+# or "usb1" for a root hub, or None if the port is not a USB device
+def hubOf(portName):
+    try:
+        path = os.path.realpath(SYSFS_TTY.format(os.path.basename(portName)))
+    except OSError:
+        return None
+    while path != os.path.dirname(path):
+        parent = os.path.dirname(path)
+        if USB_DEVICE.match(os.path.basename(path)):
+            return os.path.basename(parent)
+        path = parent
+    return None
+
+
+# Reads "PORT HUB" lines, for ports sysfs knows nothing about
+def loadTopology(path):
+    topology = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2 and not fields[0].startswith("#"):
+                topology[fields[0]] = fields[1]
+    return topology
+
+
+def writeTopology(path, topology):
+    with open(path, "w") as f:
+        for port, hub in topology.items():
+            f.write(f"{port} {hub}\n")
+
+
+# {hub: [port, ...]}; a port without a known hub is a group of its own
+def groupPorts(ports, topology=None):
+    groups = {}
+    for port in ports:
+        hub = (topology or {}).get(port) or hubOf(port) or port
+        groups.setdefault(hub, []).append(port)
+    return groups
+
+
+# Token bucket of one hub with additive increase, multiplicative decrease
+class HubBudget:
+    def __init__(self, name, budget, burst=BURST, adaptive=True):
+        self.name = name
+        self.budget = budget
+        self.rate = budget
+        self.burst = burst
+        self.adaptive = adaptive
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+        self.lastDecrease = 0.0
+        self.frames = self.waited = self.late = self.lost = self.decreases = 0
+        self.waitTime = 0.0
+
+    # Takes a token and returns how long the caller has to wait before
+    # sending; tokens go negative so that waiting callers queue in order
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            self.frames += 1
+            if self.tokens >= 0:
+                return 0.0
+            wait = -self.tokens / self.rate
+            self.waited += 1
+            self.waitTime += wait
+            return wait
+
+    # ok is False for a lost reply, late for one well over the port's best time
+    def observe(self, ok, late):
+        if not self.adaptive:
+            return
+        with self.lock:
+            self.lost += not ok
+            self.late += late
+            if ok and not late:
+                self.rate = min(self.budget, self.rate + INCREASE)
+                return
+            now = time.monotonic()
+            if now - self.lastDecrease >= DECREASE_HOLDOFF:
+                self.lastDecrease = now
+                self.rate = max(self.budget * MIN_RATE, self.rate * DECREASE)
+                self.decreases += 1
+
+    def describe(self):
+        return (
+            f"hub {self.name}: {self.frames} frames, {self.waited} waited "
+            f"{self.waitTime:.2f} s in all, rate {self.rate:.0f}/{self.budget:.0f} frames/s, "
+            f"{self.late} late, {self.lost} lost, {self.decreases} decreases"
+        )
+
+
+# Hands out transports that go through the budget of their port's hub.
+# Shared by all threads of a process.
+class HubScheduler:
+    def __init__(self, budget=DEFAULT_BUDGET, topology=None, adaptive=True):
+        self.budget = budget
+        self.topology = topology or {}
+        self.adaptive = adaptive
+        self.hubs = {}
+        self.lock = threading.Lock()
+
+    def hubFor(self, port):
+        name = self.topology.get(port) or hubOf(port) or port
+        with self.lock:
+            hub = self.hubs.get(name)
+            if hub is None:
+                hub = self.hubs[name] = HubBudget(name, self.budget, adaptive=self.adaptive)
+            return hub
+
+    def wrap(self, transport, port):
+        return ScheduledTransport(transport, self.hubFor(port))
+
+    def report(self):
+        return "\n".join(hub.describe() for name, hub in sorted(self.hubs.items()))
+
+
+# A transport whose writes wait for the hub's budget and whose first read
+# after each write reports the round trip back to it
+class ScheduledTransport:
+    def __init__(self, transport, hub):
+        self.transport = transport
+        self.hub = hub
+        self.portName = getattr(transport, "portName", "")
+        self.best = {}  # class and subclass -> best round trip
+        self.sent = None
+
+    @property
+    def timeout(self):
+        return self.transport.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.transport.timeout = value
+
+    def open(self):
+        return self.transport.open()
+
+    def close(self):
+        self.transport.close()
+
+    def isOpen(self):
+        return self.transport.isOpen()
+
+    def resetInput(self):
+        self.transport.resetInput()
+
+    def write(self, data):
+        wait = self.hub.reserve()
+        if wait:
+            time.sleep(wait)
+        self.sent = (data[3:5], time.perf_counter())
+        return self.transport.write(data)
+
+    def read(self, size):
+        got = self.transport.read(size)
+        if self.sent is not None:
+            command, sent = self.sent
+            self.sent = None
+            rtt = time.perf_counter() - sent
+            best = self.best.get(command)
+            if got:
+                self.best[command] = rtt if best is None else min(best, rtt)
+            late = bool(got) and best is not None and rtt > best * RTT_FACTOR + RTT_SLACK
+            self.hub.observe(bool(got), late)
+        return got
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    t = sub.add_parser("topology", help="show which hub every port is on")
+    t.add_argument("ports", nargs="+")
+    t.add_argument("--topology", metavar="FILE", help="PORT HUB pairs for ports sysfs does not know")
+    args = parser.parse_args(argv)
+
+    topology = loadTopology(args.topology) if args.topology else None
+    groups = groupPorts(args.ports, topology)
+    for hub, ports in sorted(groups.items()):
+        known = hub not in ports
+        print(f"{hub if known else 'no hub'}: {' '.join(ports)}")
+    print(f"{len(args.ports)} ports on {sum(hub not in ports for hub, ports in groups.items())} hubs")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""Crash-safe provisioning journal
+
+An append-only file recording, per camera, every step of a provisioning
+script as it is confirmed: the port opening, each acknowledged write, the
+acknowledged saveCurrentSettings and the end of the script. After a crash or
+an interrupted run the journal tells which cameras are finished, which got
+their settings saved and where every other camera stopped, so a rerun skips
+the finished ones and resumes the rest after their last saved step. Writes
+after the last save are volatile, lost if the camera was power cycled, so
+they are sent again; a camera that never saved starts over.
+
+Records are collected in memory and written with one write() and one
+fsync() every FSYNC_INTERVAL, so the disk is touched a few times a second
+however many cameras are running. A crash loses at most the records of the
+last interval; those steps are simply sent again, which is harmless because
+every step writes a fixed value. The file is opened with O_APPEND and each
+batch is a single write, so the worker processes of replay --processes can
+share one journal. Every record carries a CRC32; a record torn by the crash
+ends the journal and is cut off before appending.
+
+Journal layout (little endian):
+    |MAGIC "HMJN"|VERSION|SCRIPT DIGEST (16)|RECORD| ... |RECORD|
+    RECORD: |CRC32 (4)|EVENT|PORT LEN|STEP (2)|PORT|
+
+Usage:
+    python provisioning.py replay golden.hmtp PORT... --journal run.hmjn
+    python journal.py show run.hmjn
+"""
+
+import argparse
+import hashlib
+import os
+import struct
+import sys
+import threading
+import zlib
+
+MAGIC = b"HMJN"
+VERSION = 1
+HEADER = struct.Struct("<4sB16s")
+RECORD = struct.Struct("<IBBH")
+FSYNC_INTERVAL = 0.2  # seconds
+
+CONNECTED = 1
+ACKED = 2  # STEP was acknowledged
+SAVED = 3  # STEP, a saveCurrentSettings, was acknowledged
+DONE = 4  # every step was acknowledged as expected
+FAILED = 5  # STEP got an unexpected reply or the link was lost
+
+
+def scriptDigest(blob):
+    return hashlib.sha256(blob).digest()[:16]
+
+
+def packRecord(event, port, step=0):
+    name = port.encode()[:255]
+    body = RECORD.pack(0, event, len(name), step)[4:] + name
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+# What the journal says about one camera. `next` is the first step that has
+# not been confirmed, `resume` the step after the last confirmed save, where
+# a rerun starts.
+class PortState:
+    __slots__ = ("next", "resume", "saved", "done", "failures")
+
+    def __init__(self):
+        self.next = 0
+        self.resume = 0
+        self.saved = False
+        self.done = False
+        self.failures = 0
+
+    def describe(self):
+        if self.done:
+            return "done"
+        text = f"confirmed up to step {self.next}" if self.next else "not started"
+        if self.saved:
+            text += f", settings saved up to step {self.resume}"
+        if self.failures:
+            text += f", {self.failures} failures"
+        return text
+
+
+# Reads a journal. Returns (digest, {port: PortState}, length of the valid
+# part); everything after that length is a torn record.
+def readJournal(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f"{path} is not a provisioning journal")
+    magic, version, digest = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a provisioning journal")
+    if version != VERSION:
+        raise ValueError(f"unsupported journal version {version}")
+    states = {}
+    offset = HEADER.size
+    while offset + RECORD.size <= len(data):
+        crc, event, length, step = RECORD.unpack_from(data, offset)
+        end = offset + RECORD.size + length
+        if end > len(data) or zlib.crc32(data[offset + 4 : end]) != crc:
+            break
+        port = data[end - length : end].decode()
+        state = states.get(port)
+        if state is None:
+            state = states[port] = PortState()
+        if event in (ACKED, SAVED):
+            state.next = max(state.next, step + 1)
+            if event == SAVED:
+                state.saved = True
+                state.resume = max(state.resume, step + 1)
+        elif event == DONE:
+            state.done = True
+        elif event == FAILED:
+            state.failures += 1
+        offset = end
+    return digest, states, offset
+
+
+class Journal:
+    def __init__(self, path, interval=FSYNC_INTERVAL):
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        self.interval = interval
+        self.pending = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.records = 0
+        self.syncs = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Creates the journal for a script, or checks that the existing one
+    # belongs to it and cuts off a torn last record. Returns {port: PortState}.
+    @staticmethod
+    def prepare(path, blob):
+        digest = scriptDigest(blob)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, VERSION, digest))
+                f.flush()
+                os.fsync(f.fileno())
+            return {}
+        found, states, length = readJournal(path)
+        if found != digest:
+            raise ValueError(f"{path} was written for a different script")
+        if length != os.path.getsize(path):
+            os.truncate(path, length)
+        return states
+
+    def record(self, event, port, step=0):
+        record = packRecord(event, port, step)
+        with self.lock:
+            self.pending.append(record)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            os.write(self.fd, b"".join(pending))
+            os.fsync(self.fd)
+            self.records += len(pending)
+            self.syncs += 1
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        os.close(self.fd)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    s = sub.add_parser("show", help="print what a journal says about every camera")
+    s.add_argument("journal")
+    args = parser.parse_args(argv)
+
+    try:
+        digest, states, length = readJournal(args.journal)
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+    for port, state in sorted(states.items()):
+        print(f"{port}: {state.describe()}")
+    done = sum(state.done for state in states.values())
+    saved = sum(state.saved for state in states.values())
+    print(f"{len(states)} cameras, {done} done, {saved} with settings saved")
+    if length != os.path.getsize(args.journal):
+        print(f"torn record after byte {length}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""Link quality and baud rate benchmark
+
+Bursts of harmless reads (readModel and brightness reads, alternating) are
+sent at increasing rates. For each rate the round-trip time, achieved
+throughput and the number of corrupted and dropped replies are measured.
+A sweep repeats a full-speed burst at every baud rate to find which rates
+the adapter and camera handle reliably.
+
+The HM-TM5X answers at its own UART rate, so a sweep mostly finds out which
+host-side rates still line up with it and how hard the adapter can be driven.
+
+Usage:
+    python linkbench.py /dev/ttyUSB0 --rates 10,50,100,0 --count 200
+    python linkbench.py /dev/ttyUSB0 --sweep 57600,115200,230400
+    python linkbench.py /dev/ttyUSB0 --batching
+"""
+
+import argparse
+import sys
+import time
+from collections import deque
+
+import HM_TM5X
+from batching import FrameBatcher
+
+DEFAULT_RATES = (10, 20, 50, 100, 200, 0)  # frames per second, 0 = as fast as possible
+BAUD_RATES = (9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600)
+
+
+def probeFrames():
+    return [
+        bytes.fromhex(HM_TM5X.readModel()),
+        bytes.fromhex(HM_TM5X.brightness()),
+    ]
+
+
+def burst(transport, count=100, rate=0, window=4):
+    frames = probeFrames()
+    interval = 1 / rate if rate else 0.0
+    inflight = deque()
+    rtts = []
+    corrupt = dropped = sent = 0
+    next_send = start = time.perf_counter()
+
+    def collect():
+        nonlocal corrupt, dropped
+        reply = HM_TM5X.readFrame(transport)
+        now = time.perf_counter()
+        if not reply:
+            inflight.popleft()
+            dropped += 1
+            return
+        if not HM_TM5X.isValidFrame(reply):
+            inflight.popleft()
+            corrupt += 1
+            return
+        # replies carry the class/subclass of their request, anything before
+        # the matching request was lost on the way
+        while inflight and inflight[0][0][3:5] != reply[3:5]:
+            inflight.popleft()
+            dropped += 1
+        if inflight:
+            rtts.append(now - inflight.popleft()[1])
+
+    while sent < count or inflight:
+        now = time.perf_counter()
+        if sent < count and len(inflight) < window and now >= next_send:
+            frame = frames[sent % len(frames)]
+            transport.write(frame)
+            inflight.append((frame, time.perf_counter()))
+            sent += 1
+            next_send = max(next_send + interval, now)
+        elif inflight:
+            collect()
+        else:
+            time.sleep(next_send - now)
+
+    elapsed = time.perf_counter() - start
+    rtts.sort()
+    return {
+        "rate": rate,
+        "sent": sent,
+        "received": len(rtts),
+        "corrupt": corrupt,
+        "dropped": dropped,
+        "elapsed": elapsed,
+        "throughput": len(rtts) / elapsed if elapsed else 0.0,
+        "rtt_avg": sum(rtts) / len(rtts) if rtts else 0.0,
+        "rtt_p95": rtts[int(len(rtts) * 0.95)] if rtts else 0.0,
+        "rtt_max": rtts[-1] if rtts else 0.0,
+    }
+
+
+def rateSweep(transport, rates=DEFAULT_RATES, count=100, window=4):
+    results = []
+    for rate in rates:
+        transport.resetInput()
+        results.append(burst(transport, count, rate, window))
+    return results
+
+
+# openTransport(baudRate) must return an open transport or None
+def baudSweep(openTransport, baudRates=BAUD_RATES, count=100, window=4):
+    results = []
+    for baudRate in baudRates:
+        transport = openTransport(baudRate)
+        if transport is None:
+            results.append({"baud": baudRate, "reliable": False, "error": "could not open"})
+            continue
+        transport.resetInput()
+        result = burst(transport, count, 0, window)
+        transport.close()
+        result["baud"] = baudRate
+        result["reliable"] = result["received"] == count
+        results.append(result)
+    return results
+
+
+# Throughput of writing frames one by one (batch size 1) against coalescing
+# them into single writes. Every batch is answered before the next is sent.
+def batchingBenchmark(transport, count=200, batchSizes=(1, 2, 4, 8)):
+    frames = probeFrames()
+    results = []
+    for size in batchSizes:
+        transport.resetInput()
+        batcher = FrameBatcher(transport.write, size)
+        received = 0
+        start = time.perf_counter()
+        for i in range(0, count, size):
+            n = min(size, count - i)
+            for j in range(i, i + n):
+                batcher.add(frames[j % len(frames)])
+            batcher.flush()
+            for _ in range(n):
+                if HM_TM5X.isValidFrame(HM_TM5X.readFrame(transport)):
+                    received += 1
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "batch": size,
+                "sent": count,
+                "received": received,
+                "writes": batcher.writes,
+                "elapsed": elapsed,
+                "throughput": received / elapsed if elapsed else 0.0,
+            }
+        )
+    return results
+
+
+def formatBatchResult(result):
+    return (
+        f"batch {result['batch']}: {result['received']}/{result['sent']} ok in "
+        f"{result['writes']} writes, {result['throughput']:.0f} frames/s"
+    )
+
+
+def fastestReliable(results):
+    reliable = [r["baud"] for r in results if r["reliable"]]
+    return max(reliable) if reliable else None
+
+
+def formatResult(result):
+    rate = f"{result['rate']}/s" if result.get("rate") else "max"
+    head = f"{result['baud']} baud" if "baud" in result else f"rate {rate}"
+    if "error" in result:
+        return f"{head}: {result['error']}"
+    return (
+        f"{head}: {result['received']}/{result['sent']} ok, "
+        f"{result['corrupt']} corrupt, {result['dropped']} dropped, "
+        f"{result['throughput']:.0f} frames/s, rtt avg "
+        f"{result['rtt_avg'] * 1000:.2f} ms p95 {result['rtt_p95'] * 1000:.2f} ms "
+        f"max {result['rtt_max'] * 1000:.2f} ms"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("port")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--rates", default=",".join(map(str, DEFAULT_RATES)))
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--window", type=int, default=4)
+    parser.add_argument("--sweep", metavar="RATES", help="comma separated baud rates")
+    parser.add_argument("--batching", action="store_true", help="compare batched and single writes")
+    parser.add_argument("--low-latency", action="store_true", help="use the Linux low-latency serial backend")
+    args = parser.parse_args(argv)
+
+    from transport import openTransport
+
+    def openAt(baudRate):
+        return openTransport(args.port, baudRate, lowLatency=args.low_latency)
+
+    if args.sweep:
+        results = baudSweep(
+            openAt, [int(r) for r in args.sweep.split(",")], args.count, args.window
+        )
+        for result in results:
+            print(formatResult(result))
+        print(f"fastest reliable baud rate: {fastestReliable(results)}")
+        return 0 if fastestReliable(results) else 1
+
+    transport = openAt(args.baud)
+    if transport is None:
+        print(f"{args.port}: could not open port")
+        return 1
+    if args.batching:
+        for result in batchingBenchmark(transport, args.count):
+            print(formatBatchResult(result))
+        transport.close()
+        return 0
+    for result in rateSweep(
+        transport, [int(r) for r in args.rates.split(",")], args.count, args.window
+    ):
+        print(formatResult(result))
+    transport.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Link watchdog with automatic reconnect
+
+Notices a dead link from port errors, the device node disappearing or
+replies that stop arriving. It then reopens the port with
+exponential backoff, checks that a camera answers readModel and hands back
+so that unconfirmed commands can be sent again.
+"""
+
+import os
+import time
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtSerialPort import QSerialPort
+
+import HM_TM5X
+import tracing
+from pacing import BACKOFF_MAX, BACKOFF_START, DEFAULT_PACING, PACING
+from transport import SerialTransport
+
+CHECK_INTERVAL = 100  # ms
+PRESENCE_INTERVAL = 1.0  # seconds between checks that the device still exists
+MAX_MISSED = 2  # missed replies in a row before the link counts as dead
+VERIFY_TIMEOUT = 0.3
+
+FATAL_ERRORS = (
+    QSerialPort.DeviceNotFoundError,
+    QSerialPort.PermissionError,
+    QSerialPort.ResourceError,
+    QSerialPort.WriteError,
+    QSerialPort.ReadError,
+    QSerialPort.UnknownError,
+)
+
+
+def replyTimeout(function):
+    name = HM_TM5X.FUNCTION_NAMES.get(function)
+    return PACING.get(name, DEFAULT_PACING)[1] / 1000
+
+
+# The device node of a port, or None where ports have none (COM ports on
+# Windows); the watchdog then relies on the port's errors
+def devicePath(portName):
+    if os.name != "posix":
+        return None
+    return portName if portName.startswith("/") else os.path.join("/dev", portName)
+
+
+class LinkWatchdog(QtCore.QObject):
+    lost = pyqtSignal(str)
+    recovered = pyqtSignal(float)
+    unanswered = pyqtSignal()  # a raw frame was given up on
+
+    # pending is the deque of (function, text, span, sent at) kept by
+    # MainWindow and resend() sends its contents again
+    def __init__(self, serial, pending, resend, parent=None):
+        super().__init__(parent)
+        self.serial = serial
+        self.pending = pending
+        self.resend = resend
+        self.armed = False
+        self.recovering = False
+        self.missed = 0
+        self.backoff = BACKOFF_START
+        self.lostAt = 0.0
+        self.lastPresenceCheck = 0.0
+        self.path = None
+        self.timer = QtCore.QTimer(self, interval=CHECK_INTERVAL, timeout=self.check)
+        self.retryTimer = QtCore.QTimer(self, singleShot=True, timeout=self.reconnect)
+        serial.errorOccurred.connect(self.onError)
+
+    def arm(self):
+        self.armed = True
+        self.recovering = False
+        self.missed = 0
+        # checking the device node is cheap, unlike enumerating every port
+        path = devicePath(self.serial.portName())
+        self.path = path if path is not None and os.path.exists(path) else None
+        self.timer.start()
+
+    def disarm(self):
+        self.armed = False
+        self.recovering = False
+        self.timer.stop()
+        self.retryTimer.stop()
+
+    def replyReceived(self):
+        self.missed = 0
+
+    def onError(self, error):
+        if self.armed and not self.recovering and error in FATAL_ERRORS:
+            self.linkLost(self.serial.errorString())
+
+    def check(self):
+        if not self.armed or self.recovering:
+            return
+        now = time.monotonic()
+        if self.pending:
+            function, text, span, sentAt = self.pending[0]
+            if now - sentAt > replyTimeout(function):
+                if function is None:
+                    # raw frames from the send box may legitimately go unanswered
+                    tracing.end(span, "unanswered")
+                    self.pending.popleft()
+                    self.unanswered.emit()
+                else:
+                    # the command stays queued so that it is replayed later
+                    self.pending[0] = (function, text, span, now)
+                    self.missed += 1
+                    if self.missed >= MAX_MISSED:
+                        self.linkLost("no reply from camera")
+                        return
+        if self.path is not None and now - self.lastPresenceCheck > PRESENCE_INTERVAL:
+            self.lastPresenceCheck = now
+            if not os.path.exists(self.path):
+                self.linkLost("device disappeared")
+
+    def linkLost(self, reason):
+        self.recovering = True
+        self.lostAt = time.monotonic()
+        self.backoff = BACKOFF_START
+        self.serial.close()
+        self.lost.emit(reason)
+        self.retryTimer.start(0)
+
+    def reconnect(self):
+        if not self.armed:
+            return
+        if self.serial.open(QtCore.QIODevice.ReadWrite) and self.verify():
+            self.recovering = False
+            self.missed = 0
+            self.resend()
+            self.recovered.emit(time.monotonic() - self.lostAt)
+            return
+        self.serial.close()
+        self.retryTimer.start(int(self.backoff * 1000))
+        self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+
+    # readModel must come back as a well-formed reply before the link is used
+    def verify(self):
+        transport = SerialTransport.wrap(self.serial, VERIFY_TIMEOUT)
+        self.serial.blockSignals(True)
+        try:
+            transport.resetInput()
+            request = HM_TM5X.readModel()
+            transport.write(bytes.fromhex(request))
+            reply = HM_TM5X.readFrame(transport)
+        finally:
+            self.serial.blockSignals(False)
+        frames, rest = HM_TM5X.splitFrames(reply)
+        return len(frames) == 1 and frames[0][3:5] == bytes.fromhex(request[6:10])
@@ -0,0 +1,188 @@
+"""Low-latency serial backend for USB-TTL adapters on Linux
+
+USB-serial adapters, FTDI ones especially, hold received bytes for up to
+16 ms before handing them to the host, which is most of the round trip for
+a 9 byte frame. tunePort() lowers the adapter's latency timer where sysfs
+exposes it and sets ASYNC_LOW_LATENCY on the tty. LowLatencySerial also
+configures the termios read thresholds so that a read wakes up once per
+frame instead of once per byte.
+
+Usage:
+    python lowlatency.py /dev/ttyUSB0    measure round trip before/after tuning
+"""
+
+import argparse
+import array
+import fcntl
+import os
+import select
+import sys
+import termios
+import time
+
+import HM_TM5X
+
+TIOCGSERIAL = 0x541E
+TIOCSSERIAL = 0x541F
+ASYNC_LOW_LATENCY = 1 << 13
+SERIAL_FLAGS = 4  # index of flags in struct serial_struct, counted in ints
+LATENCY_TIMER = "/sys/bus/usb-serial/devices/{}/latency_timer"
+LOW_LATENCY_TIMER = 1  # ms
+FRAME_SIZE = 9  # single DATA byte frame
+INTER_BYTE_TIMEOUT = 1  # tenths of a second, VTIME
+
+
+def devicePath(portName):
+    return portName if portName.startswith("/") else os.path.join("/dev", portName)
+
+
+def readLatencyTimer(portName):
+    try:
+        with open(LATENCY_TIMER.format(os.path.basename(portName))) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def setLatencyTimer(portName, ms):
+    try:
+        with open(LATENCY_TIMER.format(os.path.basename(portName)), "w") as f:
+            f.write(str(ms))
+        return True
+    except OSError:
+        return False
+
+
+def setLowLatencyFlag(fd):
+    serial = array.array("i", [0] * 32)  # larger than struct serial_struct
+    try:
+        fcntl.ioctl(fd, TIOCGSERIAL, serial, True)
+        serial[SERIAL_FLAGS] |= ASYNC_LOW_LATENCY
+        fcntl.ioctl(fd, TIOCSSERIAL, serial)
+        return True
+    except OSError:
+        return False
+
+
+# Applies what this process is allowed to change and returns what was done.
+# Both settings outlive the file descriptor, so a port tuned here can then be
+# opened by QSerialPort.
+def tunePort(portName, fd=None):
+    report = {"latency_timer_before": readLatencyTimer(portName)}
+    report["latency_timer_set"] = setLatencyTimer(portName, LOW_LATENCY_TIMER)
+    report["latency_timer_after"] = readLatencyTimer(portName)
+    own_fd = fd is None
+    if own_fd:
+        try:
+            fd = os.open(devicePath(portName), os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        except OSError:
+            report["low_latency_flag"] = False
+            return report
+    try:
+        report["low_latency_flag"] = setLowLatencyFlag(fd)
+    finally:
+        if own_fd:
+            os.close(fd)
+    return report
+
+
+class LowLatencySerial:
+    def __init__(self, portName, baudRate=115200, timeout=0.5, frameSize=FRAME_SIZE):
+        self.portName = devicePath(portName)
+        self.baudRate = baudRate
+        self.timeout = timeout
+        self.frameSize = frameSize
+        self.fd = None
+        self.poller = None
+        self.tuning = None
+
+    def open(self, tune=True):
+        try:
+            self.fd = os.open(self.portName, os.O_RDWR | os.O_NOCTTY)
+        except OSError:
+            return False
+        # termios.error is not an OSError; it is what a file that is not a
+        # tty, such as /dev/null, gives
+        try:
+            attrs = termios.tcgetattr(self.fd)
+            speed = getattr(termios, f"B{self.baudRate}")
+            attrs[0] = 0  # iflag: no translation, no software flow control
+            attrs[1] = 0  # oflag: raw output
+            attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+            attrs[3] = 0  # lflag: non-canonical, no echo, no signals
+            attrs[4] = attrs[5] = speed
+            # a read returns once a whole frame is in, or when the line goes quiet
+            attrs[6][termios.VMIN] = self.frameSize
+            attrs[6][termios.VTIME] = INTER_BYTE_TIMEOUT
+            termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+        except termios.error:
+            self.close()
+            return False
+        # poll() rather than select(), which cannot wait on descriptors >= 1024
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+        if tune:
+            self.tuning = tunePort(self.portName, self.fd)
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def isOpen(self):
+        return self.fd is not None
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    # returns up to size bytes, fewer if the timeout runs out first
+    def read(self, size):
+        buf = b""
+        deadline = time.monotonic() + self.timeout
+        while len(buf) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.poller.poll(remaining * 1000):
+                break
+            buf += os.read(self.fd, size - len(buf))
+        return buf
+
+    def resetInput(self):
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+
+def measureRtt(transport, count=20):
+    request = bytes.fromhex(HM_TM5X.readModel())
+    rtts = []
+    transport.resetInput()
+    for _ in range(count):
+        start = time.perf_counter()
+        transport.write(request)
+        if HM_TM5X.readFrame(transport):
+            rtts.append(time.perf_counter() - start)
+    return sum(rtts) / len(rtts) if rtts else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("port")
+    parser.add_argument("--baud", type=int, default=115200)
+    args = parser.parse_args(argv)
+    port = args.port
+    transport = LowLatencySerial(port, args.baud)
+    if not transport.open(tune=False):
+        print(f"{port}: could not open port")
+        return 1
+    before = measureRtt(transport)
+    report = tunePort(transport.portName, transport.fd)
+    after = measureRtt(transport)
+    transport.close()
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    for label, rtt in (("before", before), ("after", after)):
+        print(f"rtt {label}: " + (f"{rtt * 1000:.2f} ms" if rtt else "no reply"))
+    return 0 if after else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""Hex macro runner
+
+A macro is a text file with one entry per line:
+
+    # comment
+    F005367802006414FF      raw frame, the 0x prefix is optional
+    brightness 60           named HM_TM5X command, writes when a value is given
+    palette                 ... and reads when it is not
+    frame 74 02 01 00       CLASS SUBCLASS FLAG DATA..., SIZE and CHECK are added
+    expect F0053678020301B4FF
+    expect ack              the write acknowledgement for the previous frame
+    delay 250               wait for outstanding replies, then pause (ms)
+
+An expect line asserts the reply to the frame right above it. Frames are
+pipelined: up to `window` frames are written before the oldest reply is
+read. Every frame is expected to get exactly one reply frame.
+
+Usage:
+    python macro.py bench.txt /dev/ttyUSB0 --window 4
+"""
+
+import argparse
+import sys
+import time
+from collections import deque
+
+import HM_TM5X
+import tracing
+
+COMMANDS = {
+    "readModel": HM_TM5X.readModel,
+    "FPGAVersionNumber": HM_TM5X.FPGAVersionNumber,
+    "saveCurrentSettings": HM_TM5X.saveCurrentSettings,
+    "factoryReset": HM_TM5X.factoryReset,
+    "manualShutterCalibration": HM_TM5X.manualShutterCalibration,
+    "manualBackgroundCorrection": HM_TM5X.manualBackgroundCorrection,
+    "vignettingCorrection": HM_TM5X.vignettingCorrection,
+}
+
+
+def parseHex(text):
+    if text[:2].lower() == "0x":
+        text = text[2:]
+    if len(text) % 2 != 0:
+        raise ValueError(f"odd number of hex digits: {text}")
+    return bytes.fromhex(text)
+
+
+def parseCommand(words):
+    name = words[0]
+    if name == "frame":
+        if len(words) < 5:
+            raise ValueError("frame takes CLASS SUBCLASS FLAG and at least one DATA byte")
+        fields = parseHex("".join(words[1:]))
+        return HM_TM5X.buildFrame(fields[0], fields[1], fields[2], fields[3:]).hex().upper()
+    if name in COMMANDS:
+        if len(words) != 1:
+            raise ValueError(f"{name} takes no value")
+        return COMMANDS[name]()
+    if name in HM_TM5X.SETTINGS:
+        builder = HM_TM5X.SETTINGS[name][0]
+        if len(words) == 1:
+            return builder()
+        if len(words) != 2:
+            raise ValueError(f"{name} takes at most one value")
+        text = builder(int(words[1], 0), True)
+        if text[:2] == "-1":
+            raise ValueError(text[3:])
+        return text
+    return None
+
+
+# Yields ("send", lineno, frame, expected) and ("delay", lineno, seconds) one
+# entry at a time so that large macros are never held in memory. A send is held
+# back by one line to pick up the expect line that may follow it.
+def parseMacro(lines):
+    pending = None
+    for lineno, line in enumerate(lines, 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        words = line.split()
+        keyword = words[0].lower()
+        try:
+            if keyword == "expect":
+                if pending is None or pending[3] is not None:
+                    raise ValueError("expect must follow a frame")
+                if len(words) != 2:
+                    raise ValueError("expect takes one reply frame")
+                if words[1].lower() == "ack":
+                    expected = bytes.fromhex(HM_TM5X.ackReply(pending[2].hex().upper()))
+                else:
+                    expected = parseHex(words[1])
+                pending = (pending[0], pending[1], pending[2], expected)
+                continue
+            if pending is not None:
+                yield pending
+                pending = None
+            if keyword == "delay":
+                yield ("delay", lineno, int(words[1]) / 1000)
+                continue
+            text = parseCommand(words)
+            frame = parseHex(text) if text is not None else parseHex("".join(words))
+        except (ValueError, IndexError) as e:
+            raise ValueError(f"line {lineno}: {e}") from None
+        pending = ("send", lineno, frame, None)
+    if pending is not None:
+        yield pending
+
+
+def runMacro(transport, entries, window=4, gap=0.0, log=print):
+    summary = {"sent": 0, "passed": 0, "failed": 0, "unchecked": 0, "rtt_max": 0.0}
+    rtt_total = 0.0
+    inflight = deque()
+    last_write = 0.0
+    port = getattr(transport, "portName", "")
+    start = time.perf_counter()
+
+    def collect():
+        nonlocal rtt_total
+        lineno, frame, expected, sent_at, span = inflight.popleft()
+        reply = HM_TM5X.readFrame(transport)
+        rtt = time.perf_counter() - sent_at
+        if not reply:
+            tracing.end(span, "no reply")
+            summary["failed"] += 1
+            log(f"line {lineno}: no reply to {frame.hex().upper()}")
+            return
+        rtt_total += rtt
+        summary["rtt_max"] = max(summary["rtt_max"], rtt)
+        if expected is None:
+            tracing.end(span, "unchecked", reply=reply)
+            summary["unchecked"] += 1
+        elif reply == expected:
+            tracing.end(span, "ok", reply=reply)
+            summary["passed"] += 1
+        else:
+            tracing.end(span, "mismatch", reply=reply)
+            summary["failed"] += 1
+            log(
+                f"line {lineno}: expected {expected.hex().upper()}"
+                f" got {reply.hex().upper()}"
+            )
+
+    for entry in entries:
+        if entry[0] == "delay":
+            while inflight:
+                collect()
+            time.sleep(entry[2])
+            continue
+        _, lineno, frame, expected = entry
+        if len(inflight) >= window:
+            collect()
+        wait = gap - (time.perf_counter() - last_write)
+        if wait > 0:
+            time.sleep(wait)
+        span = tracing.begin(f"line {lineno}", port, bytes=frame)
+        transport.write(frame)
+        last_write = time.perf_counter()
+        inflight.append((lineno, frame, expected, last_write, span))
+        summary["sent"] += 1
+    while inflight:
+        collect()
+
+    summary["elapsed"] = time.perf_counter() - start
+    replies = summary["passed"] + summary["unchecked"] + summary["failed"]
+    summary["rtt_avg"] = rtt_total / replies if replies else 0.0
+    return summary
+
+
+def formatSummary(summary):
+    return (
+        f"{summary['sent']} frames: {summary['passed']} passed, "
+        f"{summary['failed']} failed, {summary['unchecked']} unchecked in "
+        f"{summary['elapsed'] * 1000:.1f} ms "
+        f"(rtt avg {summary['rtt_avg'] * 1000:.1f} ms, "
+        f"max {summary['rtt_max'] * 1000:.1f} ms)"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("macro")
+    parser.add_argument("port")
+    parser.add_argument("--window", type=int, default=4, help="frames in flight")
+    parser.add_argument("--gap", type=float, default=0.0, help="ms between frames")
+    parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace of the run")
+    parser.add_argument("--low-latency", action="store_true", help="use the Linux low-latency serial backend")
+    args = parser.parse_args(argv)
+    if args.trace:
+        tracing.enable()
+
+    from transport import openTransport
+
+    transport = openTransport(args.port, lowLatency=args.low_latency)
+    if transport is None:
+        print(f"{args.port}: could not open port")
+        return 1
+    transport.resetInput()
+    with open(args.macro) as f:
+        try:
+            summary = runMacro(transport, parseMacro(f), args.window, args.gap / 1000)
+        except ValueError as e:
+            print(f"macro error: {e}")
+            return 1
+        finally:
+            transport.close()
+    print(formatSummary(summary))
+    if args.trace:
+        tracing.save(args.trace)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,12 @@
+import startuptimer
 import sys, os
+
+# imports are only timed one by one when a startup report was asked for
+if any(arg.startswith("--startup-report") for arg in sys.argv):
+    startuptimer.traceImports()
+import argparse
+import time
+from collections import deque
 from datetime import datetime
 
 from PyQt5 import QtCore, QtWidgets, QtSerialPort, QtGui
@@ -21,35 +29,129 @@ from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtSerialPort import QSerialPortInfo
 
 import HM_TM5X
+import linkbench
+from batching import FrameBatcher
+import tracing
+from transport import DEFAULT_BAUD_RATE, SerialTransport
+from linkwatchdog import LinkWatchdog, replyTimeout
+from deferredsave import DeferredSaver, SAVE_FUNCTION
+
+startuptimer.mark("imports")
 
 basedir = os.path.dirname(__file__)
+MACRO_STOP_WAIT = 3000  # ms a running macro gets to finish when the window closes
+
+
+# Enumerating serial ports can take a while on machines with many USB-serial
+# devices, so it runs off the GUI thread and the menu is filled in afterwards
+class PortScanner(QtCore.QThread):
+    found = pyqtSignal(list)
+
+    def run(self):
+        start = time.perf_counter()
+        ports = sorted(info.portName() for info in QSerialPortInfo.availablePorts())
+        self.seconds = time.perf_counter() - start
+        self.found.emit(ports)
+
+
+# Runs a macro off the GUI thread, so that a long macro does not freeze the
+# window. QSerialPort must only be used from the thread that created it, so
+# the window closes its port and the runner opens it again for as long as the
+# macro runs: with the low-latency backend where there is one, otherwise with
+# a SerialTransport created on the runner's own thread. stop() ends the macro
+# after the frames already sent have been answered.
+class MacroRunner(QtCore.QThread):
+    line = pyqtSignal(str)
+
+    def __init__(self, f, portName, baudRate, parent=None):
+        super().__init__(parent)
+        self.f = f
+        self.portName = portName
+        self.baudRate = baudRate
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        import itertools
+        import macro
+        from transport import lowLatencyAvailable, openTransport
+
+        try:
+            transport = openTransport(self.portName, self.baudRate, lowLatency=lowLatencyAvailable())
+            if transport is None:
+                self.line.emit(f"macro: could not open {self.portName}")
+                return
+            try:
+                transport.resetInput()
+                entries = itertools.takewhile(lambda entry: not self.stopped, macro.parseMacro(self.f))
+                summary = macro.runMacro(transport, entries, log=self.line.emit)
+            finally:
+                transport.close()
+        except Exception as e:
+            self.line.emit(f"macro error: {e}")
+            return
+        finally:
+            self.f.close()
+        self.line.emit(macro.formatSummary(summary) + (" (stopped)" if self.stopped else ""))
 
 class MenuSettings(QMainWindow):
     portName = pyqtSignal(str)
     timestampSig = pyqtSignal(bool)
-
-    def __init__(self, parent, menu):
+    baudRateSig = pyqtSignal(int)
+    benchmarkSig = pyqtSignal()
+    statsSig = pyqtSignal()
+    fleetSig = pyqtSignal()
+    profileSig = pyqtSignal(bool)
+    deferredSaveSig = pyqtSignal(bool)
+
+    def __init__(self, parent, menu, baudRate=DEFAULT_BAUD_RATE):
         super().__init__(parent)
 
         self.port = ""
-        portMenu = menu.addMenu("Port Select")
-        portGroup = QActionGroup(parent)
-        portGroup.setExclusive(True)
-        info_list = QSerialPortInfo()
-        serial_list = info_list.availablePorts()
-        serial_ports = [port.portName() for port in serial_list]
-        serial_ports.sort()
-        for port in serial_ports:
-            txt = port
-            button_action = QAction(txt, self)
+        self.portMenu = menu.addMenu("Port Select")
+        self.portGroup = QActionGroup(parent)
+        self.portGroup.setExclusive(True)
+        self.refreshAction = QAction("Refresh", self)
+        self.refreshAction.triggered.connect(lambda checked: self.scanPorts())
+        self.scanner = PortScanner(self)
+        self.scanner.found.connect(self.fillPorts)
+        QtWidgets.QApplication.instance().aboutToQuit.connect(self.stopScanning)
+        self.scanned = False
+        self.scanPorts()
+
+        baudMenu = menu.addMenu("Baud Rate")
+        baudGroup = QActionGroup(parent)
+        baudGroup.setExclusive(True)
+        for rate in linkbench.BAUD_RATES:
+            button_action = QAction(str(rate), self)
             button_action.setCheckable(True)
-            if port == "COM1":
-                button_action.setChecked(True)
+            button_action.setChecked(rate == baudRate)
             button_action.triggered.connect(
-                lambda checked, txt=txt: self.chooseCOMPortClick(txt)
+                lambda checked, rate=rate: self.baudRateSig.emit(rate)
             )
-            portGroup.addAction(button_action)
-            portMenu.addAction(button_action)
+            baudGroup.addAction(button_action)
+            baudMenu.addAction(button_action)
+
+        toolsMenu = menu.addMenu("Tools")
+        benchmarkAction = QAction("Run Link Benchmark", self)
+        benchmarkAction.triggered.connect(lambda checked: self.benchmarkSig.emit())
+        toolsMenu.addAction(benchmarkAction)
+        statsAction = QAction("Show Decoder Statistics", self)
+        statsAction.triggered.connect(lambda checked: self.statsSig.emit())
+        toolsMenu.addAction(statsAction)
+        fleetAction = QAction("Fleet View...", self)
+        fleetAction.triggered.connect(lambda checked: self.fleetSig.emit())
+        toolsMenu.addAction(fleetAction)
+        self.profileAction = QAction("Profile Session", self)
+        self.profileAction.setCheckable(True)
+        self.profileAction.triggered.connect(lambda checked: self.profileSig.emit(checked))
+        toolsMenu.addAction(self.profileAction)
+        self.deferredSaveAction = QAction("Deferred Save", self)
+        self.deferredSaveAction.setCheckable(True)
+        self.deferredSaveAction.triggered.connect(lambda checked: self.deferredSaveSig.emit(checked))
+        toolsMenu.addAction(self.deferredSaveAction)
 
         # Settings Menu
         # settingsMenu = menu.addMenu("Settings")
@@ -62,6 +164,42 @@ class MenuSettings(QMainWindow):
         # sGroup.addAction(timestampAction)
         # settingsMenu.addAction(timestampAction)
 
+    def scanPorts(self):
+        if self.scanner.isRunning():
+            return
+        self.portMenu.clear()
+        searching = self.portMenu.addAction("Searching for ports...")
+        searching.setEnabled(False)
+        self.scanner.start()
+
+    # a scan cannot be interrupted, but the thread must not be destroyed while
+    # it still runs, so quitting waits for it to finish
+    def stopScanning(self):
+        self.scanner.wait()
+
+    def fillPorts(self, serial_ports):
+        if not self.scanned:
+            startuptimer.record("port scan (background)", self.scanner.seconds)
+            self.scanned = True
+        self.portMenu.clear()
+        for action in self.portGroup.actions():
+            self.portGroup.removeAction(action)
+        for port in serial_ports:
+            txt = port
+            button_action = QAction(txt, self)
+            button_action.setCheckable(True)
+            if port == self.port or (not self.port and port == "COM1"):
+                button_action.setChecked(True)
+            button_action.triggered.connect(
+                lambda checked, txt=txt: self.chooseCOMPortClick(txt)
+            )
+            self.portGroup.addAction(button_action)
+            self.portMenu.addAction(button_action)
+        if not serial_ports:
+            self.portMenu.addAction("No ports found").setEnabled(False)
+        self.portMenu.addSeparator()
+        self.portMenu.addAction(self.refreshAction)
+
     def chooseCOMPortClick(self, port):
         self.port = port
         self.portName.emit(port)
@@ -170,21 +308,63 @@ class ResetPopup(QtWidgets.QWidget):
         return res
 
 
+# A collapsed section whose contents are built by build() the first time it
+# is opened
+class LazySection(QWidget):
+    def __init__(self, title, build, parent=None):
+        super().__init__(parent)
+        self.title = title
+        self.build = build
+        self.content = None
+        self.header = QPushButton(
+            text=f"▸ {title}", checkable=True, toggled=self.toggle
+        )
+        self.header.setStyleSheet("text-align: left")
+        lay = QVBoxLayout(self)
+        lay.setContentsMargins(0, 0, 0, 0)
+        lay.addWidget(self.header)
+
+    def toggle(self, checked):
+        if checked and self.content is None:
+            self.content = self.build()
+            self.layout().addWidget(self.content)
+        if self.content is not None:
+            self.content.setVisible(checked)
+        self.header.setText(f"{'▾' if checked else '▸'} {self.title}")
+
+
 # noinspection PyArgumentList,PyUnresolvedReferences
 class MainWindow(QMainWindow):
-    def __init__(self):
+    # batchWindow is how long (ms) queued frames wait to be written together,
+    # 0 flushes at the end of the current event loop cycle, None writes each
+    # frame on its own
+    def __init__(self, baudRate=DEFAULT_BAUD_RATE, lowLatency=False, batchWindow=0):
         super(MainWindow, self).__init__()
 
-        self.lastFunctionSent = None
+        self.pending = deque()
+        self.lowLatency = lowLatency
+        self.batchWindow = batchWindow
         portname = "None"
         self.incoming_bytes = b''
 
         self.setStatusBar(QStatusBar(self))
+        self.deviceLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.deviceLabel)
+        self.deviceState = {}
 
         menu = self.menuBar()
-        self.portFinder = MenuSettings(self, menu)
+        self.portFinder = MenuSettings(self, menu, baudRate)
         self.portFinder.portName.connect(self.chooseCOMPort)
         self.portFinder.timestampSig.connect(self.toggleTimestamp)
+        self.portFinder.baudRateSig.connect(self.setBaudRate)
+        self.portFinder.benchmarkSig.connect(self.runLinkBenchmark)
+        self.portFinder.statsSig.connect(self.showDecoderStats)
+        self.portFinder.fleetSig.connect(self.showFleet)
+        self.portFinder.profileSig.connect(self.toggleProfiling)
+        self.profileDir = "."
+        self.startupReport = None
+        self.fleetWindow = None
+        self.macroRunner = None
         self.showTimestamp = False
 
         self.setWindowTitle("HM-TM5X Thermal Camera Programmer")
@@ -192,6 +372,8 @@ class MainWindow(QMainWindow):
         self.sendLE = QLineEdit()
         self.sendButton = QPushButton(text="Send", clicked=self.send)
         self.sendLE.returnPressed.connect(self.sendButton.click)
+        self.sendLE.setPlaceholderText("Hex frame, or @file to run a macro")
+        self.macroButton = QPushButton(text="Run Macro...", clicked=self.chooseMacro)
 
         self.outputTE = QTextEdit(readOnly=True)
         self.connectPortButton = QPushButton(
@@ -248,54 +430,16 @@ class MainWindow(QMainWindow):
             text="Set Mirror Mode", clicked=self.writeMirrorMode
         )
 
-        self.manualShutterCalibrationButton = QPushButton(
-            text="Manual Shutter Calibration", clicked=self.writeManualShutterCalibration
-        )
-
-        self.asc = QComboBox()
-        self.asc.addItems(["Auto Ctrl Off", "Auto Switching, Timing Ctrl",
-                           "Auto Switching, Temp Diff Ctrl", "Full-auto Ctrl (Default)"])
-        self.asc.setCurrentIndex(3)
-        self.writeASCButton = QPushButton(
-            text="Set Auto Shutter Ctrl", clicked=self.writeASC
-        )
-
-        self.writeVigButton = QPushButton(
-            text="Run Vignette Correction (Aim camera at uniform surface)", clicked=self.writeVignette
-        )
-
-        self.iddeLabel = QLabel("Image Detail Enhancement (50): ")
-        self.iddeLE = QLineEdit()
-        self.iddeButton = QPushButton(
-            text="Set Image Detail Enhancement (0-100)", clicked=self.writeIDDE
-        )
-        self.iddeLE.returnPressed.connect(self.iddeButton.click)
-
-        self.staticDenoisingLabel = QLabel("Static Denoising Level (50): ")
-        self.staticDenoisingLE = QLineEdit()
-        self.staticDenoisingButton = QPushButton(
-            text="Set Static Denoising Level (0-100)", clicked=self.writeStaticDenoising
-        )
-        self.staticDenoisingLE.returnPressed.connect(self.staticDenoisingButton.click)
-
-        self.dynamicDenoisingLabel = QLabel("Dynamic Denoising Level (50): ")
-        self.dynamicDenoisingLE = QLineEdit()
-        self.dynamicDenoisingButton = QPushButton(
-            text="Set Dynamic Denoising Level (0-100)", clicked=self.writeDynamicDenoising
-        )
-        self.dynamicDenoisingLE.returnPressed.connect(self.dynamicDenoisingButton.click)
-
         self.saveSettingsButton = QPushButton(
             text="Save Current Device Settings to Device", clicked=self.saveSettings
         )
 
-        self.factoryResetButton = QPushButton(text="Factory Reset Device", clicked=self.showDialog)
-
         lay = QVBoxLayout(self)
         hlay = QHBoxLayout()
         hlay.addWidget(self.connectPortButton)
         hlay.addWidget(self.sendLE)
         hlay.addWidget(self.sendButton)
+        hlay.addWidget(self.macroButton)
         lay.addLayout(hlay)
         # lay.addWidget(self.output_te)
         # lay.addWidget(self.clearButton)
@@ -329,15 +473,115 @@ class MainWindow(QMainWindow):
         lay.addLayout(hlay5)
         lay.addWidget(QFrame(frameShape=QFrame.HLine))
 
+        # rarely used sections are only built the first time they are opened
+        self.calibrationSection = LazySection("Calibration", self.buildCalibration)
+        lay.addWidget(self.calibrationSection)
+        self.enhancementSection = LazySection(
+            "Detail Enhancement && Denoising", self.buildEnhancement
+        )
+        lay.addWidget(self.enhancementSection)
+        lay.addWidget(QFrame(frameShape=QFrame.HLine))
+
+        lay.addWidget(self.saveSettingsButton)
+        lay.addWidget(QFrame(frameShape=QFrame.HLine))
+        self.resetSection = LazySection("Factory Reset", self.buildReset)
+        lay.addWidget(self.resetSection)
+
+        widget = QWidget()
+        widget.setLayout(lay)
+        self.setCentralWidget(widget)
+
+        self.serial = QtSerialPort.QSerialPort(
+            portname,
+            baudRate=baudRate,
+            readyRead=self.receive,
+        )
+        # frames written and not answered yet count against the batch cap,
+        # so the camera never has more than MAX_BATCH_FRAMES to take in
+        self.batcher = FrameBatcher(
+            self.serial.write, inflight=lambda: len(self.pending) - len(self.batcher)
+        )
+        self.flushTimer = QtCore.QTimer(
+            self, singleShot=True, interval=batchWindow or 0, timeout=self.flushWrites
+        )
+        self.watchdog = LinkWatchdog(self.serial, self.pending, self.resendPending, self)
+        self.watchdog.lost.connect(self.onLinkLost)
+        self.watchdog.unanswered.connect(self.flushWrites)
+        self.watchdog.recovered.connect(self.onLinkRecovered)
+        self.saver = DeferredSaver(
+            self.writeCommand, lambda: self.serial.isOpen() and self.linkUp, lambda line: self.updateText(line, False), parent=self
+        )
+        self.portFinder.deferredSaveSig.connect(self.setDeferredSave)
+        self.linkWidgets = [
+            self.brightnessButton,
+            self.brightnessLE,
+            self.contrastLE,
+            self.contrastButton,
+            self.writeMirrorModeButton,
+            self.saveSettingsButton,
+            self.writePaletteButton,
+            self.sendButton,
+            self.macroButton,
+            self.sendLE,
+        ]
+        self.enableButtons(False)
+
+    def buildCalibration(self):
+        self.manualShutterCalibrationButton = QPushButton(
+            text="Manual Shutter Calibration", clicked=self.writeManualShutterCalibration
+        )
+
+        self.asc = QComboBox()
+        self.asc.addItems(["Auto Ctrl Off", "Auto Switching, Timing Ctrl",
+                           "Auto Switching, Temp Diff Ctrl", "Full-auto Ctrl (Default)"])
+        self.asc.setCurrentIndex(3)
+        self.writeASCButton = QPushButton(
+            text="Set Auto Shutter Ctrl", clicked=self.writeASC
+        )
+
+        self.writeVigButton = QPushButton(
+            text="Run Vignette Correction (Aim camera at uniform surface)", clicked=self.writeVignette
+        )
+
+        lay = QVBoxLayout()
+        lay.setContentsMargins(0, 0, 0, 0)
         hlay6 = QHBoxLayout()
         hlay6.addWidget(QLabel("Auto Shutter Control: "))
         hlay6.addWidget(self.asc)
         hlay6.addWidget(self.writeASCButton)
         lay.addWidget(self.manualShutterCalibrationButton)
         lay.addLayout(hlay6)
-        lay.addWidget(QFrame(frameShape=QFrame.HLine))
-
         lay.addWidget(self.writeVigButton)
+        self.applyState(8)
+        return self.sectionWidget(
+            lay,
+            [self.manualShutterCalibrationButton, self.writeASCButton, self.writeVigButton],
+        )
+
+    def buildEnhancement(self):
+        self.iddeLabel = QLabel("Image Detail Enhancement (50): ")
+        self.iddeLE = QLineEdit()
+        self.iddeButton = QPushButton(
+            text="Set Image Detail Enhancement (0-100)", clicked=self.writeIDDE
+        )
+        self.iddeLE.returnPressed.connect(self.iddeButton.click)
+
+        self.staticDenoisingLabel = QLabel("Static Denoising Level (50): ")
+        self.staticDenoisingLE = QLineEdit()
+        self.staticDenoisingButton = QPushButton(
+            text="Set Static Denoising Level (0-100)", clicked=self.writeStaticDenoising
+        )
+        self.staticDenoisingLE.returnPressed.connect(self.staticDenoisingButton.click)
+
+        self.dynamicDenoisingLabel = QLabel("Dynamic Denoising Level (50): ")
+        self.dynamicDenoisingLE = QLineEdit()
+        self.dynamicDenoisingButton = QPushButton(
+            text="Set Dynamic Denoising Level (0-100)", clicked=self.writeDynamicDenoising
+        )
+        self.dynamicDenoisingLE.returnPressed.connect(self.dynamicDenoisingButton.click)
+
+        lay = QVBoxLayout()
+        lay.setContentsMargins(0, 0, 0, 0)
         hlay7 = QHBoxLayout()
         hlay7.addWidget(self.iddeLabel)
         hlay7.addWidget(self.iddeLE)
@@ -353,46 +597,171 @@ class MainWindow(QMainWindow):
         hlay9.addWidget(self.dynamicDenoisingLE)
         hlay9.addWidget(self.dynamicDenoisingButton)
         lay.addLayout(hlay9)
-        lay.addWidget(QFrame(frameShape=QFrame.HLine))
+        for function in (11, 12, 13):
+            self.applyState(function)
+        return self.sectionWidget(
+            lay,
+            [
+                self.iddeLE,
+                self.iddeButton,
+                self.staticDenoisingLE,
+                self.staticDenoisingButton,
+                self.dynamicDenoisingLE,
+                self.dynamicDenoisingButton,
+            ],
+        )
 
-        lay.addWidget(self.saveSettingsButton)
-        lay.addWidget(QFrame(frameShape=QFrame.HLine))
+    def buildReset(self):
+        self.factoryResetButton = QPushButton(text="Factory Reset Device", clicked=self.showDialog)
+        lay = QVBoxLayout()
+        lay.setContentsMargins(0, 0, 0, 0)
         lay.addWidget(self.factoryResetButton)
+        return self.sectionWidget(lay, [self.factoryResetButton])
 
+    # widgets that need an open port follow the current connection state
+    def sectionWidget(self, lay, linkWidgets):
+        self.linkWidgets += linkWidgets
+        for w in linkWidgets:
+            w.setDisabled(not self.linkUp)
         widget = QWidget()
         widget.setLayout(lay)
-        self.setCentralWidget(widget)
-
-        self.serial = QtSerialPort.QSerialPort(
-            portname,
-            baudRate=QtSerialPort.QSerialPort.Baud115200,
-            readyRead=self.receive,
-        )
-        self.enableButtons(False)
+        return widget
 
     def receive(self):
-        while self.serial.bytesAvailable():
-            b = self.serial.readAll().data()
-            self.incoming_bytes += b
-            if len(self.incoming_bytes) > 20:
-                self.incoming_bytes = b''
-
-        if b[-1] == 255:
-            text = self.incoming_bytes
-            # text = text.rstrip("\r\n")
-            if len(text) >= 20 and text[:2] == "0x":
-                data = HM_TM5X.handleReply(text, self.lastFunctionSent)
-                if data[:2] == "-1":
-                    self.updateText(data[3:], False)
-                else:
-                    self.updateText(data, False)
+        self.incoming_bytes += self.serial.readAll().data()
+        frames, self.incoming_bytes = HM_TM5X.splitFrames(self.incoming_bytes)
+        for frame in frames:
+            self.watchdog.replyReceived()
+            function, text, span = self.takePending(frame)
+            if function is None:
+                tracing.end(span, reply=frame)
+                self.updateText("0x" + frame.hex().upper(), False)
+                continue
+            data = HM_TM5X.decodeReply(frame, function)
+            if data[:2] == "-1":
+                tracing.end(span, "error", reply=frame, error=data[3:])
+                self.updateText(data[3:], False)
             else:
-                self.updateText(text, False)
+                tracing.end(span, reply=frame)
+                self.updateText(data, False)
+                if int(text[10:12], 16) == HM_TM5X.READ_FLAG:
+                    self.deviceState[function] = data if function <= 2 else frame[6]
+                    self.applyState(function)
+                elif function == SAVE_FUNCTION:
+                    self.saver.saveConfirmed()
+                else:
+                    self.saver.writeConfirmed(function, text)
+        if frames and len(self.batcher):
+            self.flushWrites()
+
+    # Replies carry the class/subclass of their request, which is used to find
+    # the command they answer. A reply that matches nothing is given to the
+    # oldest raw frame from the send box, if there is one.
+    # Returns (function, request text, span).
+    def takePending(self, frame):
+        address = frame[3:5].hex().upper()
+        for i, (function, text, span, sentAt) in enumerate(self.pending):
+            if text[6:10] == address:
+                del self.pending[i]
+                return function, text, span
+        if self.pending and self.pending[0][0] is None:
+            function, text, span, sentAt = self.pending.popleft()
+            return None, text, span
+        return None, None, None
+
+    # Reads the model, FPGA version and every setting in one burst; the
+    # requests go out together and the widgets follow as the replies arrive
+    def syncState(self):
+        self.deviceState = {}
+        self.writeCommand(1, HM_TM5X.readModel())
+        self.writeCommand(2, HM_TM5X.FPGAVersionNumber())
+        for name, (builder, function, max_val) in HM_TM5X.SETTINGS.items():
+            self.writeCommand(function, builder())
+        self.statusBar().showMessage("Reading device state", 1000)
+
+    # shows a value read from the camera in the widgets for that setting;
+    # widgets in sections that are not built yet pick it up when built
+    def applyState(self, function):
+        value = self.deviceState.get(function)
+        if value is None:
+            return
+        match function:
+            case 1 | 2:
+                model = self.deviceState.get(1, "")
+                fpga = self.deviceState.get(2)
+                self.deviceLabel.setText(f"{model}, FPGA {fpga}" if fpga else model)
+            case 8:
+                if hasattr(self, "asc"):
+                    self.asc.setCurrentIndex(value)
+            case 9:
+                self.brightnessLabel.setText(f"Brightness ({value}): ")
+            case 10:
+                self.contrastLabel.setText(f"Contrast ({value}): ")
+            case 11:
+                if hasattr(self, "iddeLabel"):
+                    self.iddeLabel.setText(f"Image Detail Enhancement ({value}): ")
+            case 12:
+                if hasattr(self, "staticDenoisingLabel"):
+                    self.staticDenoisingLabel.setText(f"Static Denoising Level ({value}): ")
+            case 13:
+                if hasattr(self, "dynamicDenoisingLabel"):
+                    self.dynamicDenoisingLabel.setText(f"Dynamic Denoising Level ({value}): ")
+            case 14:
+                self.palettes.setCurrentIndex(value)
+            case 15:
+                self.mirrorModes.setCurrentIndex(value)
+
+    # sends a frame built by HM_TM5X; function is the handleReply number used
+    # to decode the answer, None for raw frames
+    def writeCommand(self, function, text):
+        if text[:2] == "-1":
+            self.updateText(text[3:], False)
+            return
+        span = tracing.begin(
+            HM_TM5X.FUNCTION_NAMES.get(function, "raw"),
+            self.serial.portName(),
+            bytes=text,
+        )
+        self.pending.append((function, text, span, time.monotonic()))
+        frame = bytes.fromhex(text)
+        if self.batchWindow is None:
+            self.serial.write(frame)
+        elif not self.batcher.add(frame) and not self.flushTimer.isActive():
+            self.flushTimer.start()
+        self.updateText(text)
+
+    # frames queued since the last flush go out in a single write, as many
+    # as the frames still in flight leave room for
+    def flushWrites(self):
+        self.batcher.flush()
+
+    # forgets every command not answered yet, closing its trace span with
+    # outcome so that the trace has no unterminated requests
+    def dropPending(self, outcome):
+        for function, text, span, sentAt in self.pending:
+            tracing.end(span, outcome)
+        self.pending.clear()
+        self.batcher.clear()
+
+    # re-sends every command that was written but never answered, used by the
+    # watchdog after it reopened the port
+    def resendPending(self):
+        unconfirmed = list(self.pending)
+        self.pending.clear()
+        self.batcher.clear()
+        self.incoming_bytes = b''
+        for function, text, span, sentAt in unconfirmed:
+            tracing.end(span, "resent")
+            self.writeCommand(function, text)
 
     def send(self):
         text = self.sendLE.text()
         if text == "":
             return
+        if text[0] == "@":
+            self.sendLE.clear()
+            self.runMacro(text[1:].strip())
+            return
         if text[:2] == '0x':
             text = text[2:]
         try:
@@ -405,40 +774,79 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage("You must send a hexadecimal value", 1000)
             self.sendLE.clear()
             return
-        b = bytes.fromhex(text)
-        self.serial.write(b)
+        self.writeCommand(None, text.upper())
         self.sendLE.clear()
-        self.updateText(text)
+
+    def chooseMacro(self):
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(
+            self, "Run Macro", "", "Macro files (*.txt *.macro);;All files (*)"
+        )
+        if path:
+            self.runMacro(path)
+
+    # runs a macro on the open port from a MacroRunner thread; the port is
+    # handed over to the runner and the link widgets and watchdog are off
+    # until it is done
+    def runMacro(self, path):
+        if not self.serial.isOpen():
+            self.statusBar().showMessage("Connect to a port first", 1000)
+            return
+        if self.macroRunner is not None and self.macroRunner.isRunning():
+            return
+        try:
+            f = open(path)
+        except OSError as e:
+            self.statusBar().showMessage(f"Could not open macro: {e.strerror}", 3000)
+            return
+        self.updateText(f"macro {path}")
+        self.flushWrites()
+        if self.serial.bytesToWrite():
+            self.serial.waitForBytesWritten(100)
+        self.watchdog.disarm()
+        self.enableButtons(False)
+        self.connectPortButton.setEnabled(False)
+        self.dropPending("dropped")
+        self.incoming_bytes = b''
+        self.serial.close()
+        self.macroRunner = MacroRunner(f, self.serial.portName(), self.serial.baudRate(), self)
+        self.macroRunner.line.connect(self.macroLine)
+        self.macroRunner.finished.connect(self.macroFinished)
+        self.macroRunner.start()
+
+    def macroLine(self, line):
+        self.updateText(line, False)
+
+    # takes the port back from the runner; the macro may have changed any
+    # setting, so the camera's state is read again
+    def macroFinished(self):
+        self.connectPortButton.setEnabled(True)
+        self.serial.open(QtCore.QIODevice.ReadWrite)
+        if not self.serial.isOpen():
+            self.connectPortButton.setChecked(False)
+            return
+        self.enableButtons(True)
+        self.watchdog.arm()
+        self.syncState()
 
     def readModel(self):
-        self.lastFunctionSent = 1
         text = HM_TM5X.readModel()
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(1, text)
         self.statusBar().showMessage("Reading Model Name", 1000)
 
     def writePalette(self):
         val = self.palettes.currentIndex()
-        self.lastFunctionSent = 14
         text = HM_TM5X.palette(val, True)
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(14, text)
         self.statusBar().showMessage(
             f"Writing {self.palettes.itemText(val)} to Palette", 1000
         )
 
     def readPalette(self):
-        self.lastFunctionSent = 14
         text = HM_TM5X.palette(0)
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(14, text)
         self.statusBar().showMessage("Reading Palette", 1000)
 
     def writeBrightness(self):
-        self.lastFunctionSent = 9
         val = self.brightnessLE.text()
         if not val.isnumeric():
             self.statusBar().showMessage(
@@ -449,13 +857,10 @@ class MainWindow(QMainWindow):
         self.brightnessLabel.setText(f"Brightness ({val}): ")
         text = HM_TM5X.brightness(int(val), True)
         self.brightnessLE.clear()
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(9, text)
         self.statusBar().showMessage(f"Setting brightness to {val}", 1000)
 
     def writeContrast(self):
-        self.lastFunctionSent = 10
         val = self.contrastLE.text()
         if not val.isnumeric():
             self.statusBar().showMessage(
@@ -466,55 +871,40 @@ class MainWindow(QMainWindow):
         self.contrastLabel.setText(f"Contrast ({val}): ")
         text = HM_TM5X.contrast(int(val), True)
         self.contrastLE.clear()
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(10, text)
         self.statusBar().showMessage(f"Setting contrast to {val}", 1000)
 
     def writeMirrorMode(self):
         val = self.mirrorModes.currentIndex()
-        self.lastFunctionSent = 15
         text = HM_TM5X.imageMirroring(val, True)
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(15, text)
         self.statusBar().showMessage(
             f"Writing mirror mode as {self.mirrorModes.itemText(val)}", 1000
         )
 
     def writeASC(self):
         val = self.asc.currentIndex()
-        self.lastFunctionSent = 8
         text = HM_TM5X.autoShutterControl(val, True)
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(8, text)
         self.statusBar().showMessage(
             f"Writing Auto Shutter Control as {self.asc.itemText(val)}", 1000
         )
 
     def writeManualShutterCalibration(self):
-        self.lastFunctionSent = 5
         text = HM_TM5X.manualShutterCalibration()
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(5, text)
         self.statusBar().showMessage(
             f"Writing Manual Shutter Calibration", 1000
         )
 
     def writeVignette(self):
-        self.lastFunctionSent = 7
         text = HM_TM5X.vignettingCorrection()
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(7, text)
         self.statusBar().showMessage(
             f"Performing Vignette Correction", 1000
         )
 
     def writeIDDE(self):
-        self.lastFunctionSent = 11
         val = self.iddeLE.text()
         if not val.isnumeric():
             self.statusBar().showMessage(
@@ -525,13 +915,10 @@ class MainWindow(QMainWindow):
         self.iddeLabel.setText(f"Image Detail Enhancement ({val}): ")
         text = HM_TM5X.imageDetailDigitalEnhancement(int(val), True)
         self.iddeLE.clear()
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(11, text)
         self.statusBar().showMessage(f"Setting Image Detail Enhancement to {val}", 1000)
 
     def writeStaticDenoising(self):
-        self.lastFunctionSent = 12
         val = self.staticDenoisingLE.text()
         if not val.isnumeric():
             self.statusBar().showMessage(
@@ -542,13 +929,10 @@ class MainWindow(QMainWindow):
         self.staticDenoisingLabel.setText(f"Static Denoising Level ({val}): ")
         text = HM_TM5X.staticDenoisingLevel(int(val), True)
         self.staticDenoisingLE.clear()
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(12, text)
         self.statusBar().showMessage(f"Setting Static Denoising Level to {val}", 1000)
 
     def writeDynamicDenoising(self):
-        self.lastFunctionSent = 13
         val = self.dynamicDenoisingLE.text()
         if not val.isnumeric():
             self.statusBar().showMessage(
@@ -559,17 +943,19 @@ class MainWindow(QMainWindow):
         self.dynamicDenoisingLabel.setText(f"Dynamic Denoising Level ({val}): ")
         text = HM_TM5X.dynamicDenoisingLevel(int(val), True)
         self.dynamicDenoisingLE.clear()
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.writeCommand(13, text)
         self.statusBar().showMessage(f"Setting Dynamic Denoising Level to {val}", 1000)
 
     def saveSettings(self):
-        self.lastFunctionSent = 3
+        if self.saver.enabled:
+            self.saver.saveRequested()
+            self.statusBar().showMessage(
+                f"Settings will be saved after {self.saver.timer.interval() / 1000:g} s without changes", 3000
+            )
+            return
         text = HM_TM5X.saveCurrentSettings()
-        if text[:2] != -1:
-            self.serial.write(bytes.fromhex(text))
-        self.updateText(text)
+        self.saver.saveSent()
+        self.writeCommand(SAVE_FUNCTION, text)
         self.statusBar().showMessage(
             "Saving current device settings to device... please wait", 10000
         )
@@ -584,6 +970,8 @@ class MainWindow(QMainWindow):
         self.connectPortButton.setText("Disconnect" if checked else "Connect to port")
         if checked:
             if not self.serial.isOpen():
+                if self.lowLatency:
+                    self.tuneLatency()
                 self.serial.open(QtCore.QIODevice.ReadWrite)
                 if not self.serial.isOpen():
                     self.connectPortButton.setChecked(False)
@@ -592,44 +980,56 @@ class MainWindow(QMainWindow):
                         f"Connected to {self.portFinder.port}", 1000
                     )
                     self.enableButtons(True)
+                    self.watchdog.arm()
+                    self.syncState()
             else:
                 self.statusBar().showMessage("COM Port not selected or available", 1000)
                 self.connectPortButton.setChecked(False)
         else:
+            self.saveBeforeClosing()
+            self.watchdog.disarm()
+            self.dropPending("disconnected")
             self.enableButtons(False)
             self.serial.close()
+            self.deviceLabel.clear()
             self.statusBar().showMessage("Serial connection closed", 1000)
 
+    # QSerialPort keeps its own termios settings, but the adapter's latency
+    # timer and the tty's low-latency flag stay in place once set
+    def tuneLatency(self):
+        import lowlatency
+
+        report = lowlatency.tunePort(QSerialPortInfo(self.serial).systemLocation())
+        self.updateText(
+            f"latency timer {report['latency_timer_before']} -> "
+            f"{report['latency_timer_after']} ms, "
+            f"low latency flag {'set' if report['low_latency_flag'] else 'not set'}",
+            False,
+        )
+
+    def onLinkLost(self, reason):
+        self.saver.linkLost()
+        self.batcher.clear()
+        self.enableButtons(False)
+        self.updateText(f"link lost ({reason}), reconnecting", False)
+
+    # the camera may have been power cycled, so its state is read again
+    def onLinkRecovered(self, seconds):
+        self.enableButtons(True)
+        self.updateText(f"link recovered after {seconds:.2f} s", False)
+        self.saver.linkRecovered()
+        self.syncState()
+
     def enableButtons(self, val):
-        val = not val
-        self.brightnessButton.setDisabled(val)
-        self.brightnessLE.setDisabled(val)
-        self.contrastLE.setDisabled(val)
-        self.contrastButton.setDisabled(val)
-        self.writeASCButton.setDisabled(val)
-        self.factoryResetButton.setDisabled(val)
-        self.writeMirrorModeButton.setDisabled(val)
-        self.manualShutterCalibrationButton.setDisabled(val)
-        self.saveSettingsButton.setDisabled(val)
-        self.writePaletteButton.setDisabled(val)
-        self.sendButton.setDisabled(val)
-        self.sendLE.setDisabled(val)
-        self.iddeButton.setDisabled(val)
-        self.iddeLE.setDisabled(val)
-        self.staticDenoisingButton.setDisabled(val)
-        self.staticDenoisingLE.setDisabled(val)
-        self.writeVigButton.setDisabled(val)
-        self.dynamicDenoisingButton.setDisabled(val)
-        self.dynamicDenoisingLE.setDisabled(val)
+        self.linkUp = val
+        for w in self.linkWidgets:
+            w.setDisabled(not val)
 
     def showDialog(self):
         dialog = ResetPopup(self)
         if dialog.exec_():
-            self.lastFunctionSent = 4
             text = HM_TM5X.factoryReset()
-            if text[:2] != -1:
-                self.serial.write(bytes.fromhex(text))
-            self.updateText(text)
+            self.writeCommand(4, text)
             self.statusBar().showMessage(
                 "Resetting device to Factory settings... please wait", 10000
             )
@@ -647,12 +1047,117 @@ class MainWindow(QMainWindow):
         self.statusBar().showMessage(f"{newPort} selected", 1000)
         print(newPort)
 
+    def setBaudRate(self, rate):
+        self.serial.setBaudRate(rate)
+        self.statusBar().showMessage(f"Baud rate set to {rate}", 1000)
+
+    # bursts of reads at increasing rates on the open port; the replies are
+    # read directly so readyRead is blocked meanwhile
+    def runLinkBenchmark(self):
+        if not self.serial.isOpen():
+            self.statusBar().showMessage("Connect to a port first", 1000)
+            return
+        self.updateText(f"link benchmark at {self.serial.baudRate()} baud")
+        self.flushWrites()
+        transport = SerialTransport.wrap(self.serial)
+        self.serial.blockSignals(True)
+        try:
+            for result in linkbench.rateSweep(transport):
+                self.updateText(linkbench.formatResult(result), False)
+                QtWidgets.QApplication.processEvents()
+        finally:
+            transport.resetInput()
+            self.serial.blockSignals(False)
+
+    # runs from the first event loop iteration, once the window has been shown
+    def startupFinished(self):
+        startuptimer.mark("first show")
+        if self.startupReport:
+            print(startuptimer.report())
+            startuptimer.save(self.startupReport)
+        self.statusBar().showMessage(
+            f"Ready in {startuptimer.elapsed() * 1000:.0f} ms", 3000
+        )
+
+    def showDecoderStats(self):
+        stats = HM_TM5X.replyTableStats
+        self.updateText(
+            f"reply table: {stats['hits']} hits, {stats['misses']} misses", False
+        )
+
+    # the fleet view is only imported and built the first time it is opened
+    def showFleet(self):
+        if self.fleetWindow is None:
+            import fleetview
+
+            self.fleetWindow = fleetview.FleetWindow(self.serial.baudRate())
+            self.fleetWindow.setWindowIcon(self.windowIcon())
+        self.fleetWindow.show()
+        self.fleetWindow.raise_()
+
+    # cProfile and tracemalloc run between two clicks of Tools > Profile
+    # Session; the reports are written to profileDir when it is stopped
+    def toggleProfiling(self, checked):
+        import profiler
+
+        self.portFinder.profileAction.setChecked(checked)
+        if checked:
+            profiler.start()
+            self.statusBar().showMessage("Profiling started", 1000)
+            return
+        paths = profiler.stop(profiler.defaultPrefix(self.profileDir))
+        for path in paths:
+            self.updateText(f"profile written to {path}", False)
+
     def toggleTimestamp(self, enable):
         print(f"timestamp is {enable}")
         self.showTimestamp = enable
 
+    def setDeferredSave(self, enabled):
+        self.portFinder.deferredSaveAction.setChecked(enabled)
+        self.saver.setEnabled(enabled)
+        if not enabled and self.saver.dirty:
+            self.saver.commit()
+        self.statusBar().showMessage(f"Deferred save {'on' if enabled else 'off'}", 1000)
+
+    # With deferred saving on, a camera with unsaved changes is saved before
+    # its port closes. The reply is waited for here, reading the port
+    # directly, because nothing would be left to receive it afterwards.
+    def saveBeforeClosing(self):
+        if not self.saver.enabled or not self.saver.dirty or not self.linkUp:
+            return
+        self.saver.commit()
+        self.flushWrites()
+        transport = SerialTransport.wrap(self.serial, replyTimeout(SAVE_FUNCTION))
+        self.serial.blockSignals(True)
+        try:
+            while self.saver.sentGeneration is not None:
+                frame = HM_TM5X.readFrame(transport)
+                if not frame:
+                    self.updateText("no reply to the save before closing", False)
+                    break
+                self.incoming_bytes += frame
+                self.receive()
+        finally:
+            self.serial.blockSignals(False)
+        self.updateText(self.saver.summary(), False)
+
     def closeEvent(self, event):
+        if self.macroRunner is not None and self.macroRunner.isRunning():
+            self.macroRunner.finished.disconnect(self.macroFinished)
+            self.macroRunner.stop()
+            if not self.macroRunner.wait(MACRO_STOP_WAIT):
+                self.macroRunner.terminate()
+                self.macroRunner.wait()
+        self.saveBeforeClosing()
+        if self.portFinder.profileAction.isChecked():
+            self.toggleProfiling(False)
+        if self.fleetWindow is not None:
+            self.fleetWindow.close()
+        self.watchdog.disarm()
+        self.dropPending("disconnected")
         self.serial.close()
+        self.portFinder.stopScanning()
         self.statusBar().showMessage("Disconnected", 1000)
         print("COM Port closed")
 
@@ -677,8 +1182,38 @@ class MainWindow(QMainWindow):
 
 
 if __name__ == "__main__":
-    app = QtWidgets.QApplication(sys.argv)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace of all commands")
+    parser.add_argument("--baud", type=int, default=DEFAULT_BAUD_RATE, choices=linkbench.BAUD_RATES)
+    parser.add_argument("--low-latency", action="store_true", help="tune USB-serial adapters for low latency (Linux)")
+    parser.add_argument("--batch-window", type=int, default=0, metavar="MS", help="coalesce frames queued within this window into one write")
+    parser.add_argument("--no-batching", action="store_true", help="write every frame on its own")
+    parser.add_argument("--profile", type=float, metavar="SECONDS", help="profile the first SECONDS after startup")
+    parser.add_argument("--profile-dir", default=".", metavar="DIR", help="where profile reports are written")
+    parser.add_argument("--startup-report", metavar="FILE", help="write startup phase and import times as JSON")
+    parser.add_argument("--deferred-save", type=float, metavar="SECONDS", help="save settings once after this long without changes")
+    args, qt_args = parser.parse_known_args()
+    if args.trace:
+        tracing.enable()
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
     app.setWindowIcon(QtGui.QIcon(os.path.join(basedir, 'favicon.ico')))
-    w = MainWindow()
+    startuptimer.mark("QApplication")
+    w = MainWindow(args.baud, args.low_latency, None if args.no_batching else args.batch_window)
+    startuptimer.mark("MainWindow")
     w.show()
-    sys.exit(app.exec_())
+    QtCore.QTimer.singleShot(0, w.startupFinished)
+    w.profileDir = args.profile_dir
+    w.startupReport = args.startup_report
+    if args.deferred_save is not None:
+        w.saver.setQuietPeriod(args.deferred_save)
+        w.setDeferredSave(True)
+    if args.profile:
+        w.toggleProfiling(True)
+        QtCore.QTimer.singleShot(
+            int(args.profile * 1000),
+            lambda: w.portFinder.profileAction.isChecked() and w.toggleProfiling(False),
+        )
+    ret = app.exec_()
+    if args.trace:
+        tracing.save(args.trace)
+    sys.exit(ret)
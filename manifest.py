@@ -0,0 +1,320 @@
+"""Per-unit provisioning manifests
+
+A manifest maps every unit of an order, by serial number or label, to its
+own settings. It is a CSV file with a header row, or a JSON-lines file with
+one object per unit:
+
+    serial,palette,brightness,contrast,imageMirroring
+    SN0001,White Hot,60,40,0
+    SN0002,3,55,,central mirroring
+
+    {"serial": "SN0003", "palette": 3, "brightness": 60}
+
+Columns are the setting names of HM_TM5X.SETTINGS, and saveCurrentSettings
+(yes/no). A value is a number, 0x hex or the name of a value such as a
+palette. An empty cell leaves that setting alone. A unit is named by its
+serial, label or unit cell, the first one that is set.
+
+The port column names the serial port the unit is connected to, and the
+station column the fleet.py station that port belongs to, for stations
+with the same port names. fleet.py serve requires a port for every unit
+and provisions each unit only on its own port; no two units may share one.
+
+The file is read in chunks of CHUNK rows and every chunk is checked a column
+at a time against lookup tables built once from the HM_TM5X builders, so a
+value is valid exactly when its builder accepts it. Every error of the whole
+file is reported before anything is sent. Each unit comes out as a compiled
+provisioning script; units with the same settings share one script and
+profile, which must not be modified, and the steps of each (setting, value)
+are compiled only once.
+
+Usage:
+    python manifest.py check order.csv
+    python manifest.py check order.csv --placed
+    python fleet.py serve --manifest order.csv
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+from collections import namedtuple
+
+import HM_TM5X
+from provisioning import HEADER, MAGIC, VERSION, compileStep
+
+CHUNK = 4096  # rows validated together
+KEY_COLUMNS = ("serial", "label", "unit")
+PLACEMENT_COLUMNS = ("station", "port")
+SETTING_NAMES = list(HM_TM5X.SETTINGS)
+SAVE = "saveCurrentSettings"
+EMPTY = ("", None)
+CELL_TYPES = {str, int, bool, type(None)}  # JSON lists and objects are no value of any column
+MAX_ERRORS = 1000  # errors kept for the report, the rest are only counted
+
+Unit = namedtuple("Unit", "line key profile script station port")
+ManifestError = namedtuple("ManifestError", "line key column value message")
+
+
+# Returns setting name -> {accepted cell text: value} and
+# (setting name, value) -> compiled script step, for every value the
+# setting's builder accepts
+def buildTables():
+    values = {}
+    steps = {}
+    for name, (builder, function, max_val) in HM_TM5X.SETTINGS.items():
+        table = values[name] = {}
+        names = {frame[6]: text.lower() for frame, text in HM_TM5X.REPLY_TABLE.get(function, {}).items()}
+        for value in range(max_val + 1):
+            text = builder(value, True)
+            if text[:2] == "-1":
+                continue
+            steps[name, value] = compileStep(name, text)
+            for key in (str(value), f"0x{value:02x}", f"0x{value:02X}", names.get(value)):
+                if key:
+                    table.setdefault(key, value)
+    values[SAVE] = {"1": True, "yes": True, "y": True, "true": True, "0": False, "no": False, "n": False, "false": False}
+    steps[SAVE, True] = compileStep(SAVE, HM_TM5X.saveCurrentSettings())
+    return values, steps
+
+
+VALUES, STEPS = buildTables()
+
+
+def rangeText(name):
+    if name == SAVE:
+        return "yes or no"
+    return f"0-{HM_TM5X.SETTINGS[name][2]} or a value name"
+
+
+# Reads a manifest in chunks. Yields (header, [(line, row values), ...]),
+# the values in header order.
+def readChunks(path, chunk=CHUNK):
+    if path.endswith((".jsonl", ".ndjson")):
+        yield from readJsonChunks(path, chunk)
+        return
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = [column.strip() for column in next(reader, [])]
+        rows = []
+        for row in reader:
+            if not any(row):
+                continue
+            rows.append((reader.line_num, row))
+            if len(rows) == chunk:
+                yield header, rows
+                rows = []
+        if rows:
+            yield header, rows
+
+
+def readJsonChunks(path, chunk):
+    header = []
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line, text in enumerate(f, 1):
+            if not text.strip():
+                continue
+            try:
+                obj = json.loads(text)
+            except ValueError as e:
+                obj = {"": f"invalid JSON: {e}"}
+            if not isinstance(obj, dict):
+                obj = {"": "not a JSON object"}
+            for column in obj:
+                if column not in header:
+                    header.append(column)
+            rows.append((line, obj))
+            if len(rows) == chunk:
+                yield header, [(line, [obj.get(c) for c in header]) for line, obj in rows]
+                rows = []
+    if rows:
+        yield header, [(line, [obj.get(c) for c in header]) for line, obj in rows]
+
+
+# cell -> lookup key for cells that are not found as they are: text is
+# stripped and lower-cased, and JSON values become text the way they would
+# be written in a CSV file
+def normalize(cell):
+    if isinstance(cell, str):
+        return cell.strip().lower()
+    if isinstance(cell, bool):
+        return "true" if cell else "false"
+    if cell is None:
+        return ""
+    return str(cell)
+
+
+# Returns the first unit column and errors for the columns not checked before.
+# Column "" holds the reason a JSON line could not be read.
+def checkHeader(header, checked):
+    errors = []
+    for column in header:
+        known = column in VALUES or column in KEY_COLUMNS or column in PLACEMENT_COLUMNS
+        if column not in checked and not known and column:
+            errors.append(ManifestError(0, "", column, "", "unknown column"))
+        checked.add(column)
+    key = next((column for column in KEY_COLUMNS if column in header), None)
+    if key is None:
+        errors.append(ManifestError(0, "", "", "", f"no unit column, one of {', '.join(KEY_COLUMNS)}"))
+    return key, errors
+
+
+def cellTexts(column, count):
+    if column is None:
+        return [""] * count
+    return [str(cell).strip() if cell not in EMPTY else "" for cell in column]
+
+
+# Validates and compiles one chunk. Returns ([Unit], [ManifestError]).
+# `taken` maps (station, port) to the line of the unit placed there; with
+# `placed` every unit must name its port.
+def compileChunk(header, rows, keyColumn, save, seen, scripts, taken, placed=False):
+    errors = []
+    lines = [line for line, row in rows]
+    width = len(header)
+    cells = [row + [None] * (width - len(row)) if len(row) < width else row for line, row in rows]
+    columns = dict(zip(header, zip(*cells)))
+    # cells of the wrong type are reported and then treated as empty, before
+    # any of them reaches a lookup table
+    wrongType = set()
+    for column, found in columns.items():
+        if column and not CELL_TYPES.issuperset(map(type, found)):
+            found = list(found)
+            for i, cell in enumerate(found):
+                if type(cell) not in CELL_TYPES:
+                    errors.append(ManifestError(lines[i], "", column, cell, "must be a number or text"))
+                    found[i] = None
+                    wrongType.add(i)
+            columns[column] = found
+    # a unit is named by the first of its serial, label or unit cells that is set
+    keys = [""] * len(rows)
+    for column in KEY_COLUMNS:
+        if column in columns:
+            keys = [key or (str(cell).strip() if cell not in EMPTY else "") for key, cell in zip(keys, columns[column])]
+
+    unreadable = columns.get("", ())
+    for i, reason in enumerate(unreadable):
+        if reason is not None:
+            errors.append(ManifestError(lines[i], "", "", "", reason))
+    for i, key in enumerate(keys):
+        if unreadable and unreadable[i] is not None:
+            continue
+        if not key:
+            if i in wrongType:
+                continue
+            errors.append(ManifestError(lines[i], "", keyColumn, "", "no unit serial or label"))
+        elif key in seen:
+            errors.append(ManifestError(lines[i], key, keyColumn, key, f"also listed on line {seen[key]}"))
+        else:
+            seen[key] = lines[i]
+    stations = cellTexts(columns.get("station"), len(rows))
+    ports = cellTexts(columns.get("port"), len(rows))
+    for i, (station, port) in enumerate(zip(stations, ports)):
+        if not port:
+            if placed:
+                errors.append(ManifestError(lines[i], keys[i], "port", "", "no port to provision the unit on"))
+        elif (station, port) in taken:
+            errors.append(ManifestError(lines[i], keys[i], "port", port, f"also given on line {taken[station, port]}"))
+        else:
+            taken[station, port] = lines[i]
+    for i, row in enumerate(cells):
+        if len(row) > width:
+            errors.append(ManifestError(lines[i], keys[i], "", "", "more cells than columns"))
+
+    values = {}
+    for name in (*SETTING_NAMES, SAVE):
+        column = columns.get(name)
+        if column is None:
+            continue
+        table = VALUES[name]
+        found = list(map(table.get, column))
+        if None in found:
+            for i, (value, cell) in enumerate(zip(found, column)):
+                if value is not None:
+                    continue
+                key = normalize(cell)
+                found[i] = table.get(key)
+                if found[i] is None and key:
+                    errors.append(
+                        ManifestError(lines[i], keys[i], name, cell, f"must be {rangeText(name)}")
+                    )
+        values[name] = found
+
+    names = [name for name in SETTING_NAMES if name in values]
+    saves = [save if value is None else value for value in values.get(SAVE, [None] * len(rows))]
+    units = []
+    for i, settings in enumerate(zip(*(values[name] for name in names), saves)):
+        compiled = scripts.get(settings)
+        if compiled is None:
+            profile = {name: value for name, value in zip(names, settings) if value is not None}
+            steps = [STEPS[name, value] for name, value in profile.items()]
+            if settings[-1]:
+                profile[SAVE] = True
+                steps.append(STEPS[SAVE, True])
+            script = HEADER.pack(MAGIC, VERSION, len(steps)) + b"".join(steps)
+            compiled = scripts[settings] = (profile, script)
+        units.append(Unit(lines[i], keys[i], *compiled, stations[i], ports[i]))
+    errors.sort(key=lambda error: error.line)
+    return units, errors
+
+
+# Loads and checks a whole manifest. Returns ([Unit], [ManifestError], error
+# count); the units are only meant to be used when there are no errors.
+# With `placed` every unit must name the port it is connected to.
+def loadManifest(path, save=False, chunk=CHUNK, placed=False):
+    units = []
+    errors = []
+    count = 0
+    seen = {}  # unit key -> line
+    scripts = {}  # settings -> compiled script
+    checked = set()  # columns already checked
+    taken = {}  # (station, port) -> line
+    for header, rows in readChunks(path, chunk):
+        keyColumn, headerErrors = checkHeader(header, checked)
+        count += len(headerErrors)
+        errors += headerErrors[: max(0, MAX_ERRORS - len(errors))]
+        if keyColumn is None:
+            break
+        chunkUnits, chunkErrors = compileChunk(header, rows, keyColumn, save, seen, scripts, taken, placed)
+        units += chunkUnits
+        count += len(chunkErrors)
+        errors += chunkErrors[: max(0, MAX_ERRORS - len(errors))]
+    return units, errors, count
+
+
+def formatError(error):
+    where = f"line {error.line}" if error.line else "header"
+    unit = f" ({error.key})" if error.key else ""
+    column = f" {error.column}" if error.column else ""
+    value = f" {error.value!r}" if error.value not in EMPTY else ""
+    return f"{where}{unit}{column}{value}: {error.message}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    c = sub.add_parser("check", help="validate a manifest and report every error")
+    c.add_argument("manifest")
+    c.add_argument("--save", action="store_true", help="save settings on units without a saveCurrentSettings cell")
+    c.add_argument("--placed", action="store_true", help="require a port for every unit, as fleet.py serve does")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    units, errors, count = loadManifest(args.manifest, args.save, placed=args.placed)
+    elapsed = time.perf_counter() - start
+    for error in errors:
+        print(formatError(error))
+    if count > len(errors):
+        print(f"... and {count - len(errors)} more errors")
+    scripts = len({id(unit.script) for unit in units})
+    print(
+        f"{len(units)} units, {scripts} distinct scripts, {count} errors, "
+        f"checked in {elapsed * 1000:.0f} ms"
+    )
+    return 1 if count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,19 @@
+"""Command pacing and reconnect timing
+
+Shared by the provisioning tools and the GUI, which should not have to
+import a command line module for a handful of numbers.
+"""
+
+# step name -> (settle ms, reply timeout ms); palette switching and saving
+# take a while before the module answers, and the module is given some more
+# time to finish redrawing or writing its flash before the next command
+DEFAULT_PACING = (0, 500)
+PACING = {
+    "palette": (50, 2000),
+    "saveCurrentSettings": (200, 5000),
+}
+
+# reopening a port after the adapter or camera dropped out
+BACKOFF_START = 0.05  # seconds
+BACKOFF_MAX = 2.0
+RECOVERY_TIME = 10.0  # give up after this long without a working link
@@ -0,0 +1,112 @@
+"""On-demand CPU and allocation profiling
+
+start() turns on cProfile for the calling thread and tracemalloc, and
+stop() turns them off and writes the reports. Nothing is installed while no
+capture is running, so the hooks cost nothing when profiling is off.
+
+stop(prefix) writes:
+    PREFIX-cpu.txt     functions sorted by cumulative and by own time
+    PREFIX-cpu.prof    raw cProfile data for snakeviz or pstats
+    PREFIX-memory.txt  memory allocated and still held since start(), per
+                       module and per function
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+from bisect import bisect_right
+from datetime import datetime
+
+TOP = 40  # lines per report section
+
+_profile = None
+_snapshot = None
+_started = 0.0
+_owns_tracemalloc = False
+
+
+def isRunning():
+    return _profile is not None
+
+
+def start():
+    global _profile, _snapshot, _started, _owns_tracemalloc
+    if _profile is not None:
+        return
+    _owns_tracemalloc = not tracemalloc.is_tracing()
+    if _owns_tracemalloc:
+        tracemalloc.start()
+    _snapshot = tracemalloc.take_snapshot()
+    _started = time.perf_counter()
+    _profile = cProfile.Profile()
+    _profile.enable()
+
+
+def defaultPrefix(directory="."):
+    return os.path.join(directory, datetime.now().strftime("profile-%Y%m%d-%H%M%S"))
+
+
+# Stops the capture and returns the paths of the reports written
+def stop(prefix=None):
+    global _profile, _snapshot
+    if _profile is None:
+        return []
+    _profile.disable()
+    seconds = time.perf_counter() - _started
+    after = tracemalloc.take_snapshot()
+    if _owns_tracemalloc:
+        tracemalloc.stop()
+    profile, before = _profile, _snapshot
+    _profile = _snapshot = None
+
+    prefix = prefix or defaultPrefix()
+    paths = [prefix + "-cpu.txt", prefix + "-cpu.prof", prefix + "-memory.txt"]
+    stats = pstats.Stats(profile)
+    stats.dump_stats(paths[1])
+    with open(paths[0], "w") as f:
+        f.write(f"{seconds:.2f} s captured\n")
+        for key in ("cumulative", "tottime"):
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats(key).print_stats(TOP)
+            f.write(f"\n=== sorted by {key} ===\n{out.getvalue()}")
+    with open(paths[2], "w") as f:
+        f.write(memoryReport(before, after, stats, seconds))
+    return paths
+
+
+# Allocation growth between two snapshots. tracemalloc only knows lines, so
+# each line is credited to the profiled function that starts closest above it
+def memoryReport(before, after, stats, seconds):
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before = before.filter_traces(ignore)
+    after = after.filter_traces(ignore)
+    lines = [f"{seconds:.2f} s captured", "", "=== growth per module ==="]
+    for stat in after.compare_to(before, "filename")[:TOP]:
+        lines.append(formatGrowth(stat.traceback[0].filename, stat))
+
+    starts = {}
+    for filename, firstlineno, name in stats.stats:
+        starts.setdefault(filename, []).append((firstlineno, name))
+    for filename, functions in starts.items():
+        functions.sort()
+        starts[filename] = ([lineno for lineno, name in functions], [name for lineno, name in functions])
+    growth = {}
+    for stat in after.compare_to(before, "lineno"):
+        frame = stat.traceback[0]
+        linenos, names = starts.get(frame.filename, ([], []))
+        i = bisect_right(linenos, frame.lineno) - 1
+        name = names[i] if i >= 0 else "<module>"
+        key = f"{frame.filename}:{name}"
+        size, count = growth.get(key, (0, 0))
+        growth[key] = (size + stat.size_diff, count + stat.count_diff)
+    lines += ["", "=== growth per function ==="]
+    for key, (size, count) in sorted(growth.items(), key=lambda item: -abs(item[1][0]))[:TOP]:
+        lines.append(f"{size / 1024:+10.1f} KiB {count:+8d} blocks  {key}")
+    return "\n".join(lines) + "\n"
+
+
+def formatGrowth(name, stat):
+    return f"{stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8d} blocks  {name}"
@@ -0,0 +1,246 @@
+"""Shared-memory progress board
+
+A fixed-layout block of shared memory with one slot per device, holding its
+port name, state, current command, step, error count and last round-trip
+time. Each worker process writes only its own slots, straight into the
+block; a dashboard reads the whole board without pickling, pipes or locks.
+
+Every slot starts with a sequence number that its single writer makes odd
+while the slot is being written and even again afterwards. A reader retries
+a slot whose sequence number was odd or changed while it was copied, so it
+never sees half an update and never holds up the writer.
+
+Board layout:
+    |MAGIC "HMPB"|SLOT COUNT (2)|SLOT| ... |SLOT|
+    SLOT: |SEQ (4)|STATE|COMMAND|ERRORS (2)|STEP (2)|RTT (8, s)|PORT (32)| padded to 64
+
+Usage:
+    python progressboard.py watch hmtp-1234
+    python progressboard.py bench --devices 300 --processes 4
+"""
+
+import argparse
+import multiprocessing
+import struct
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import HM_TM5X
+from simulator import addresses
+
+MAGIC = b"HMPB"
+HEADER = struct.Struct("<4sH")
+SEQ = struct.Struct("<I")
+FIELDS = struct.Struct("<BBHHd")  # follows SEQ
+SLOT = struct.Struct("<IBBHHd32s")
+SLOT_SIZE = 64
+PORT_OFFSET = SEQ.size + FIELDS.size
+
+IDLE = 0
+RUNNING = 1
+DONE = 2
+FAILED = 3
+RECONNECTING = 4
+STATE_NAMES = ["idle", "running", "done", "failed", "reconnecting"]
+
+# request (class, subclass) -> HM_TM5X function number, the COMMAND of a slot
+FUNCTIONS = {
+    addresses(getattr(HM_TM5X, name)): function
+    for function, name in HM_TM5X.FUNCTION_NAMES.items()
+}
+
+SlotState = namedtuple("SlotState", "port state command errors step rtt")
+
+
+def commandOf(frame):
+    return FUNCTIONS.get((frame[3], frame[4]), 0)
+
+
+class ProgressBoard:
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.buf = shm.buf
+        magic, self.slots = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{shm.name} is not a progress board")
+        self.seqs = [0] * self.slots
+
+    @classmethod
+    def create(cls, slots, name=None):
+        shm = shared_memory.SharedMemory(name, create=True, size=HEADER.size + slots * SLOT_SIZE)
+        shm.buf[: shm.size] = bytes(shm.size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, slots)
+        return cls(shm, True)
+
+    # Processes started by the creator share its resource tracker. Any other
+    # process, such as a watcher, passes tracked=False so that its own tracker
+    # does not unlink the block when it exits.
+    @classmethod
+    def attach(cls, name, tracked=True):
+        if tracked:
+            return cls(shared_memory.SharedMemory(name), False)
+        try:
+            shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:  # Python < 3.13
+            from multiprocessing import resource_tracker
+
+            shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def offset(self, index):
+        return HEADER.size + index * SLOT_SIZE
+
+    def claim(self, index, port):
+        offset = self.offset(index)
+        seq = SEQ.unpack_from(self.buf, offset)[0]
+        SEQ.pack_into(self.buf, offset, (seq + 1) & 0xFFFFFFFF)
+        FIELDS.pack_into(self.buf, offset + SEQ.size, IDLE, 0, 0, 0, 0.0)
+        struct.pack_into("32s", self.buf, offset + PORT_OFFSET, port.encode()[:32])
+        self.seqs[index] = (seq + 2) & 0xFFFFFFFF
+        SEQ.pack_into(self.buf, offset, self.seqs[index])
+
+    # only the process that claimed a slot may write it
+    def write(self, index, state, command=0, errors=0, step=0, rtt=0.0):
+        offset = self.offset(index)
+        seq = self.seqs[index]
+        SEQ.pack_into(self.buf, offset, (seq + 1) & 0xFFFFFFFF)
+        FIELDS.pack_into(self.buf, offset + SEQ.size, state, command, errors, step, rtt)
+        self.seqs[index] = (seq + 2) & 0xFFFFFFFF
+        SEQ.pack_into(self.buf, offset, self.seqs[index])
+
+    def read(self, index):
+        offset = self.offset(index)
+        while True:
+            seq, state, command, errors, step, rtt, port = SLOT.unpack_from(self.buf, offset)
+            if not seq & 1 and SEQ.unpack_from(self.buf, offset)[0] == seq:
+                return SlotState(port.rstrip(b"\0").decode(), state, command, errors, step, rtt)
+
+    def snapshot(self):
+        return [self.read(i) for i in range(self.slots)]
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def formatBoard(rows):
+    counts = [0] * len(STATE_NAMES)
+    lines = []
+    for row in rows:
+        counts[row.state] += 1
+        command = HM_TM5X.FUNCTION_NAMES.get(row.command, "")
+        lines.append(
+            f"{row.port:<24}{STATE_NAMES[row.state]:<14}{command:<32}"
+            f"step {row.step:<4}errors {row.errors:<4}rtt {row.rtt * 1000:.2f} ms"
+        )
+    lines.append(", ".join(f"{n} {name}" for name, n in zip(STATE_NAMES, counts) if n))
+    return "\n".join(lines)
+
+
+def watch(name, interval=0.5):
+    board = ProgressBoard.attach(name, tracked=False)
+    try:
+        while True:
+            rows = board.snapshot()
+            print("\033[H\033[J" + formatBoard(rows), flush=True)
+            if all(row.port and row.state in (DONE, FAILED) for row in rows):
+                return 0
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        board.close()
+
+
+# One bench worker: replays a script on simulated cameras, reporting every
+# step on the board, until `duration` seconds have passed. Simulated cameras
+# need no settle time, and sleeping it would hide the board's own cost.
+def benchWorker(name, indexes, script, duration, counter):
+    from provisioning import loadScript, replayScript
+    from simulator import VirtualCamera
+
+    board = ProgressBoard.attach(name)
+    steps = [(request, reply, 0, timeout) for request, reply, settle, timeout in loadScript(script)]
+    cameras = {index: VirtualCamera(f"sim:bench{index}", latency=0) for index in indexes}
+    for index, camera in cameras.items():
+        board.claim(index, camera.portName)
+    errors = dict.fromkeys(indexes, 0)
+    updates = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for index, camera in cameras.items():
+
+            def progress(step, ok, rtt, index=index):
+                errors[index] += not ok
+                board.write(index, RUNNING, commandOf(steps[step][0]), errors[index], step + 1, rtt)
+
+            replayScript(camera, steps, progress=progress)
+            updates += len(steps)
+    for index in indexes:
+        board.write(index, DONE, 0, errors[index], len(steps), 0.0)
+    board.close()
+    with counter.get_lock():
+        counter.value += updates
+
+
+def bench(devices, processes, duration, monitor):
+    from provisioning import compileProfile
+
+    script = compileProfile({"palette": 3, "brightness": 60, "contrast": 40})
+    board = ProgressBoard.create(devices)
+    counter = multiprocessing.Value("q", 0)
+    workers = [
+        multiprocessing.Process(
+            target=benchWorker,
+            args=(board.name, range(p, devices, processes), script, duration, counter),
+        )
+        for p in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    snapshots = 0
+    while any(worker.is_alive() for worker in workers):
+        if monitor:
+            board.snapshot()
+            snapshots += 1
+        else:
+            time.sleep(0.01)
+    for worker in workers:
+        worker.join()
+    board.close()
+    return counter.value / duration, snapshots / duration
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    w = sub.add_parser("watch", help="show a board until every device is done")
+    w.add_argument("name")
+    w.add_argument("--interval", type=float, default=0.5)
+    b = sub.add_parser("bench", help="measure slot updates per second with and without a reader")
+    b.add_argument("--devices", type=int, default=300)
+    b.add_argument("--processes", type=int, default=4)
+    b.add_argument("--duration", type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    if args.command == "watch":
+        return watch(args.name, args.interval)
+    for monitor in (False, True):
+        updates, snapshots = bench(args.devices, args.processes, args.duration, monitor)
+        reader = f"reader at {snapshots:.0f} boards/s" if monitor else "no reader"
+        print(f"{args.devices} devices, {args.processes} processes, {reader}: {updates:.0f} updates/s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,403 @@
+"""Precompiled provisioning scripts
+
+A settings profile is compiled once into a binary script holding the exact
+request frames, the acknowledgement expected for each one and pacing hints.
+Replaying a script against a camera is then only writing and comparing bytes.
+
+Profile (JSON):
+    {"palette": 3, "brightness": 60, "saveCurrentSettings": true}
+
+Script layout (little endian):
+    |MAGIC "HMTP"|VERSION|STEP COUNT (2)|STEP| ... |STEP|
+    STEP: |REQUEST LEN|REPLY LEN|SETTLE MS (2)|TIMEOUT MS (2)|REQUEST|REPLY|
+
+Usage:
+    python provisioning.py compile profile.json golden.hmtp
+    python provisioning.py replay golden.hmtp /dev/ttyUSB0 /dev/ttyUSB1
+    python provisioning.py replay golden.hmtp PORT... --journal run.hmjn
+    python provisioning.py replay golden.hmtp PORT... --processes 8 --hub-budget 400
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+
+import HM_TM5X
+import tracing
+from pacing import BACKOFF_MAX, BACKOFF_START, DEFAULT_PACING, PACING, RECOVERY_TIME
+
+MAGIC = b"HMTP"
+VERSION = 1
+HEADER = struct.Struct("<4sBH")
+STEP = struct.Struct("<BBHH")
+
+# class and subclass of saveCurrentSettings, journaled as SAVED when acked
+SAVE_ADDRESSES = bytes.fromhex(HM_TM5X.saveCurrentSettings())[3:5]
+
+
+def compileSteps(profile: dict):
+    steps = []
+    for name in profile:
+        if name != "saveCurrentSettings" and name not in HM_TM5X.SETTINGS:
+            raise ValueError(f"unknown setting in profile: {name}")
+    for name, (builder, function, max_val) in HM_TM5X.SETTINGS.items():
+        if name not in profile:
+            continue
+        val = profile[name]
+        if not isinstance(val, int) or isinstance(val, bool):
+            raise ValueError(f"{name} must be an integer, given {val!r}")
+        text = builder(val, True)
+        if text[:2] == "-1":
+            raise ValueError(f"{name}: {text[3:]}")
+        steps.append((name, text))
+    if profile.get("saveCurrentSettings", False):
+        steps.append(("saveCurrentSettings", HM_TM5X.saveCurrentSettings()))
+    return steps
+
+
+# one STEP of a script: the request, its acknowledgement and pacing
+def compileStep(name, text):
+    request = bytes.fromhex(text)
+    reply = bytes.fromhex(HM_TM5X.ackReply(text))
+    settle, timeout = PACING.get(name, DEFAULT_PACING)
+    return STEP.pack(len(request), len(reply), settle, timeout) + request + reply
+
+
+def compileProfile(profile: dict):
+    steps = compileSteps(profile)
+    out = bytearray(HEADER.pack(MAGIC, VERSION, len(steps)))
+    for name, text in steps:
+        out += compileStep(name, text)
+    return bytes(out)
+
+
+# returns a list of (request, reply, settle seconds, timeout seconds)
+def loadScript(blob):
+    magic, version, count = HEADER.unpack_from(blob, 0)
+    if magic != MAGIC:
+        raise ValueError("not a provisioning script")
+    if version != VERSION:
+        raise ValueError(f"unsupported script version {version}")
+    steps = []
+    offset = HEADER.size
+    for _ in range(count):
+        request_len, reply_len, settle, timeout = STEP.unpack_from(blob, offset)
+        offset += STEP.size
+        request = bytes(blob[offset : offset + request_len])
+        offset += request_len
+        reply = bytes(blob[offset : offset + reply_len])
+        offset += reply_len
+        steps.append((request, reply, settle / 1000, timeout / 1000))
+    if offset != len(blob):
+        raise ValueError("trailing bytes after last step")
+    return steps
+
+
+# progress(step, ok, rtt) is called after every step when given. A step
+# whose reply arrives damaged (bad framing or checksum) is sent once more;
+# every step writes a fixed value, so repeating it is harmless.
+def replayScript(transport, steps, first=0, progress=None):
+    start = time.perf_counter()
+    port = getattr(transport, "portName", "")
+    transport.resetInput()
+    retries = 0
+    for i in range(first, len(steps)):
+        request, reply, settle, timeout = steps[i]
+        transport.timeout = timeout
+        span = tracing.begin(f"step {i}", port, bytes=request)
+        sent = time.perf_counter()
+        transport.write(request)
+        got = transport.read(len(reply))
+        if got and got != reply and not HM_TM5X.isValidFrame(got):
+            tracing.end(span, "corrupted", reply=got)
+            retries += 1
+            transport.resetInput()
+            span = tracing.begin(f"step {i} retry", port, bytes=request)
+            sent = time.perf_counter()
+            transport.write(request)
+            got = transport.read(len(reply))
+        tracing.end(span, "ok" if got == reply else "mismatch", reply=got)
+        if progress is not None:
+            progress(i, got == reply, time.perf_counter() - sent)
+        if got != reply:
+            return {
+                "ok": False,
+                "step": i,
+                "expected": reply.hex().upper(),
+                "got": got.hex().upper(),
+                "elapsed": time.perf_counter() - start,
+                "retries": retries,
+            }
+        if settle:
+            time.sleep(settle)
+    return {"ok": True, "step": len(steps), "elapsed": time.perf_counter() - start, "retries": retries}
+
+
+# Reopens the port with exponential backoff until a camera answers readModel.
+# Returns False once RECOVERY_TIME has passed without a working link.
+def reconnect(transport):
+    deadline = time.monotonic() + RECOVERY_TIME
+    backoff = BACKOFF_START
+    request = bytes.fromhex(HM_TM5X.readModel())
+    while time.monotonic() < deadline:
+        transport.close()
+        time.sleep(backoff)
+        backoff = min(backoff * 2, BACKOFF_MAX)
+        if not transport.open():
+            continue
+        transport.resetInput()
+        transport.write(request)
+        frames, rest = HM_TM5X.splitFrames(HM_TM5X.readFrame(transport))
+        if len(frames) == 1 and frames[0][3:5] == request[3:5]:
+            return True
+    return False
+
+
+# Like replayScript, but a step that got no reply at all is treated as a link
+# dropout: the port is reopened and the script resumes at that step.
+# onReconnect(step) is called before every attempt to reopen the port.
+def replayWithRecovery(transport, steps, progress=None, first=0, onReconnect=None):
+    start = time.perf_counter()
+    reconnects = retries = 0
+    while True:
+        result = replayScript(transport, steps, first, progress)
+        retries += result["retries"]
+        if result["ok"] or result["got"]:
+            break
+        if onReconnect is not None:
+            onReconnect(result["step"])
+        if not reconnect(transport):
+            break
+        reconnects += 1
+        first = result["step"]
+    result["elapsed"] = time.perf_counter() - start
+    result["reconnects"] = reconnects
+    result["retries"] = retries
+    return result
+
+
+# wraps a progress callback so that every acknowledged step is journaled
+def journaled(journal, port, steps, progress=None):
+    from journal import ACKED, SAVED
+
+    def report(step, ok, rtt):
+        if ok:
+            journal.record(SAVED if steps[step][0][3:5] == SAVE_ADDRESSES else ACKED, port, step)
+        if progress is not None:
+            progress(step, ok, rtt)
+
+    return report
+
+
+# Opens a port and replays the script on it from step `first`; None if the
+# port cannot be opened. Every confirmed step goes into the journal if given,
+# and every frame waits for its hub's budget if a HubScheduler is given.
+def replayPort(port, steps, lowLatency=False, progress=None, journal=None, first=0, scheduler=None, onReconnect=None):
+    from transport import openTransport
+
+    if journal is not None:
+        from journal import CONNECTED, DONE, FAILED
+
+    transport = openTransport(port, lowLatency=lowLatency)
+    if transport is None:
+        if journal is not None:
+            journal.record(FAILED, port, first)
+        return None
+    if scheduler is not None:
+        transport = scheduler.wrap(transport, port)
+    if journal is not None:
+        journal.record(CONNECTED, port, first)
+        progress = journaled(journal, port, steps, progress)
+    result = replayWithRecovery(transport, steps, progress, first, onReconnect)
+    transport.close()
+    if journal is not None:
+        journal.record(DONE if result["ok"] else FAILED, port, result["step"])
+    result["first"] = first
+    return result
+
+
+# Runs in a worker process of replay --processes: replays the script on each
+# (board slot, port, first step) in turn and reports every step on the
+# progress board
+def replayWorker(boardName, jobs, blob, lowLatency=False, journalPath=None, hubBudget=None, topology=None):
+    from progressboard import DONE, FAILED, RECONNECTING, RUNNING, ProgressBoard, commandOf
+
+    board = ProgressBoard.attach(boardName)
+    steps = loadScript(blob)
+    journal = None
+    if journalPath:
+        from journal import Journal
+
+        journal = Journal(journalPath)
+    scheduler = None
+    if hubBudget:
+        from hubscheduler import HubScheduler
+
+        scheduler = HubScheduler(hubBudget, topology)
+    results = []
+    for index, port, first in jobs:
+        board.claim(index, port)
+        errors = 0
+        last_rtt = 0.0
+
+        def progress(step, ok, rtt):
+            nonlocal errors, last_rtt
+            errors += not ok
+            last_rtt = rtt
+            board.write(index, RUNNING, commandOf(steps[step][0]), errors, step + 1, rtt)
+
+        def reconnecting(step):
+            board.write(index, RECONNECTING, commandOf(steps[step][0]), errors, step, last_rtt)
+
+        result = replayPort(port, steps, lowLatency, progress, journal, first, scheduler, reconnecting)
+        state = DONE if result and result["ok"] else FAILED
+        board.write(index, state, 0, errors, result["step"] if result else 0, last_rtt)
+        results.append((port, result))
+    if journal is not None:
+        journal.close()
+    board.close()
+    return results
+
+
+# Splits the (port, first step) jobs over worker processes that share one
+# progress board and prints the board's totals while they run. Each process
+# gets an equal share of every hub's budget.
+def replayParallel(blob, jobs, processes, lowLatency=False, journalPath=None, hubBudget=None, topology=None):
+    import multiprocessing
+
+    from progressboard import DONE, FAILED, ProgressBoard
+
+    board = ProgressBoard.create(len(jobs), f"hmtp-{os.getpid()}")
+    print(f"progress board {board.name}, watch with: python progressboard.py watch {board.name}")
+    slots = [(index, port, first) for index, (port, first) in enumerate(jobs)]
+    chunks = [slots[p::processes] for p in range(processes)]
+    share = hubBudget / processes if hubBudget else None
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            pending = pool.starmap_async(
+                replayWorker,
+                [
+                    (board.name, chunk, blob, lowLatency, journalPath, share, topology)
+                    for chunk in chunks
+                    if chunk
+                ],
+            )
+            while not pending.ready():
+                pending.wait(1.0)
+                rows = board.snapshot()
+                done = sum(row.state in (DONE, FAILED) for row in rows)
+                print(f"{done}/{len(jobs)} ports finished", flush=True)
+            return [result for chunk in pending.get() for result in chunk]
+    finally:
+        board.close()
+
+
+def formatReplay(port, result):
+    if result is None:
+        return f"{port}: could not open port"
+    if result.get("skipped"):
+        return f"{port}: already done according to the journal"
+    resumed = f" resumed at step {result['first']}," if result.get("first") else ""
+    if result["ok"]:
+        return (
+            f"{port}:{resumed} ok in {result['elapsed'] * 1000:.1f} ms "
+            f"({result['reconnects']} reconnects, {result['retries']} retries)"
+        )
+    return (
+        f"{port}:{resumed} step {result['step']} failed, expected {result['expected']}"
+        f" got {result['got'] or 'nothing'}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    c = sub.add_parser("compile", help="compile a JSON profile into a script")
+    c.add_argument("profile")
+    c.add_argument("output")
+    r = sub.add_parser("replay", help="replay a script on one or more ports")
+    r.add_argument("script")
+    r.add_argument("ports", nargs="+")
+    r.add_argument("--processes", type=int, default=1, help="split the ports over worker processes")
+    r.add_argument("--trace", metavar="FILE", help="write a Chrome trace of the run")
+    r.add_argument("--low-latency", action="store_true", help="use the Linux low-latency serial backend")
+    r.add_argument("--journal", metavar="FILE", help="record confirmed steps here and resume from them")
+    r.add_argument("--hub-budget", type=float, metavar="FRAMES", help="request frames per second per USB hub")
+    r.add_argument("--topology", metavar="FILE", help="PORT HUB pairs for ports sysfs does not know")
+    args = parser.parse_args(argv)
+
+    if args.command == "compile":
+        with open(args.profile) as f:
+            profile = json.load(f)
+        try:
+            blob = compileProfile(profile)
+        except ValueError as e:
+            print(f"compile error: {e}")
+            return 1
+        with open(args.output, "wb") as f:
+            f.write(blob)
+        print(f"{len(loadScript(blob))} steps, {len(blob)} bytes written to {args.output}")
+        return 0
+
+    with open(args.script, "rb") as f:
+        blob = f.read()
+    steps = loadScript(blob)
+    topology = None
+    if args.topology:
+        from hubscheduler import loadTopology
+
+        topology = loadTopology(args.topology)
+    states = {}
+    if args.journal:
+        from journal import Journal
+
+        try:
+            states = Journal.prepare(args.journal, blob)
+        except ValueError as e:
+            print(e)
+            return 1
+    skipped = [port for port in args.ports if port in states and states[port].done]
+    jobs = [(port, states[port].resume if port in states else 0) for port in args.ports if port not in skipped]
+    if states:
+        resumed = sum(first > 0 for port, first in jobs)
+        print(f"journal: {len(skipped)} ports already done, {resumed} resumed")
+    results = [(port, {"ok": True, "skipped": True}) for port in skipped]
+    if args.processes > 1:
+        if args.trace:
+            print("--trace cannot be combined with --processes")
+            return 1
+        results += replayParallel(
+            blob, jobs, args.processes, args.low_latency, args.journal, args.hub_budget, topology
+        )
+    else:
+        if args.trace:
+            tracing.enable()
+        journal = Journal(args.journal) if args.journal else None
+        scheduler = None
+        if args.hub_budget:
+            from hubscheduler import HubScheduler
+
+            scheduler = HubScheduler(args.hub_budget, topology)
+        try:
+            results += [
+                (port, replayPort(port, steps, args.low_latency, None, journal, first, scheduler))
+                for port, first in jobs
+            ]
+        finally:
+            if journal is not None:
+                journal.close()
+                print(f"journal: {journal.records} records in {journal.syncs} fsyncs")
+        if args.trace:
+            tracing.save(args.trace)
+    failures = 0
+    for port, result in results:
+        print(formatReplay(port, result))
+        failures += not (result and result["ok"])
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Simulated HM-TM5X cameras
+
+VirtualCamera answers frames the way the module does: setting writes are
+stored and acknowledged, setting reads return the stored value, and the
+model name and FPGA version reads return fixed values. It has the same
+write / read / resetInput / open / close methods as the serial transports,
+so the headless tools run against it unchanged; transport.openTransport()
+returns one for port names starting with "sim:". A suffix such as
+"sim:cam0@20" makes the camera take 20 ms to answer each frame.
+"""
+
+import time
+from collections import deque
+
+import HM_TM5X
+
+SIM_PREFIX = "sim:"
+DEFAULT_LATENCY = 0.002  # seconds per reply
+MODEL = b"TM5X-SIM"
+FPGA_VERSION = bytes((1, 0, 0))
+
+# settings that do not default to 0
+DEFAULTS = {
+    "autoShutterControl": 3,
+    "brightness": 50,
+    "contrast": 50,
+    "imageDetailDigitalEnhancement": 50,
+    "staticDenoisingLevel": 50,
+    "dynamicDenoisingLevel": 50,
+}
+
+
+def addresses(builder):
+    frame = bytes.fromhex(builder())
+    return frame[3], frame[4]
+
+
+READ_ONLY = {
+    addresses(HM_TM5X.readModel): MODEL,
+    addresses(HM_TM5X.FPGAVersionNumber): FPGA_VERSION,
+}
+WRITE_ONLY = {
+    addresses(builder)
+    for builder in (
+        HM_TM5X.saveCurrentSettings,
+        HM_TM5X.factoryReset,
+        HM_TM5X.manualShutterCalibration,
+        HM_TM5X.manualBackgroundCorrection,
+        HM_TM5X.vignettingCorrection,
+    )
+}
+FACTORY_RESET = addresses(HM_TM5X.factoryReset)
+SAVE_SETTINGS = addresses(HM_TM5X.saveCurrentSettings)
+
+
+# (class, subclass) -> value of every writable setting
+def defaultState():
+    return {
+        addresses(builder): DEFAULTS.get(name, 0)
+        for name, (builder, function, max_val) in HM_TM5X.SETTINGS.items()
+    }
+
+
+# "sim:cam0@20" -> ("sim:cam0", 0.02)
+def parsePortName(portName):
+    name, _, latency = portName.partition("@")
+    return name, (int(latency) / 1000 if latency else DEFAULT_LATENCY)
+
+
+class VirtualCamera:
+    def __init__(self, portName, latency=None, timeout=0.5):
+        self.portName, default_latency = parsePortName(portName)
+        self.latency = default_latency if latency is None else latency
+        self.timeout = timeout
+        self.state = defaultState()
+        self.opened = False
+        self.saves = 0
+        self.received = b""  # start of a frame still being written
+        self.outbox = deque()  # (ready time, reply frame)
+        self.replyAt = 0.0
+        self.rx = b""
+
+    def open(self):
+        self.opened = True
+        return True
+
+    def close(self):
+        self.opened = False
+
+    def isOpen(self):
+        return self.opened
+
+    def respond(self, frame):
+        key = (frame[3], frame[4])
+        if frame[2] != HM_TM5X.DEVICE_ADDR or HM_TM5X.checksum(frame) != frame[-2]:
+            return HM_TM5X.buildFrame(key[0], key[1], HM_TM5X.ERROR_RETURN)
+        if key in READ_ONLY:
+            payload = READ_ONLY[key]
+        elif key in self.state:
+            if frame[5] == HM_TM5X.WRITE_FLAG:
+                self.state[key] = frame[6]
+                payload = b"\x01"
+            else:
+                payload = bytes((self.state[key],))
+        elif key in WRITE_ONLY:
+            if key == FACTORY_RESET:
+                self.state = defaultState()
+            elif key == SAVE_SETTINGS:
+                self.saves += 1
+            payload = b"\x01"
+        else:
+            return HM_TM5X.buildFrame(key[0], key[1], HM_TM5X.ERROR_RETURN)
+        return HM_TM5X.buildFrame(key[0], key[1], HM_TM5X.NORMAL_RETURN, payload)
+
+    # frames are answered one after another, each taking `latency`
+    def write(self, data):
+        frames, self.received = HM_TM5X.splitFrames(self.received + bytes(data))
+        now = time.monotonic()
+        for frame in frames:
+            self.replyAt = max(self.replyAt, now) + self.latency
+            self.outbox.append((self.replyAt, self.respond(frame)))
+        return len(data)
+
+    # returns up to size bytes, fewer if the timeout runs out first
+    def read(self, size):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            now = time.monotonic()
+            while self.outbox and self.outbox[0][0] <= now:
+                self.rx += self.outbox.popleft()[1]
+            if len(self.rx) >= size or now >= deadline:
+                break
+            wake = self.outbox[0][0] if self.outbox else deadline
+            time.sleep(max(min(wake, deadline) - now, 0))
+        data, self.rx = self.rx[:size], self.rx[size:]
+        return data
+
+    def resetInput(self):
+        now = time.monotonic()
+        self.rx = b""
+        while self.outbox and self.outbox[0][0] <= now:
+            self.outbox.popleft()
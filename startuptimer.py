@@ -0,0 +1,211 @@
+"""Startup phase timing
+
+Imported first by main.py so that the clock starts as early as possible.
+mark() closes the current phase and starts the next one; record() adds a
+phase that ran on the side, such as the background port scan.
+
+traceImports() times every module imported from then on, each including
+the modules it imports itself, and save() writes the phases and imports to
+a JSON startup report. bench launches the application repeatedly, measures
+the wall-clock time from starting the process until it has written its
+report, i.e. until the window is up and usable, and can append the results
+to a history file so that launch time is tracked from build to build.
+
+Usage:
+    python main.py --startup-report startup.json
+    python startuptimer.py bench --runs 5 --history startup-history.jsonl
+    python startuptimer.py bench -- "dist/HM-TM5X Thermal Camera Programmer/HM-TM5X Thermal Camera Programmer"
+"""
+
+import sys
+import time
+
+_start = time.perf_counter()
+_last = _start
+phases = []
+imports = []  # (nesting depth, module, seconds including its own imports)
+_original_import = None
+
+
+def mark(name):
+    global _last
+    now = time.perf_counter()
+    phases.append((name, now - _last))
+    _last = now
+
+
+def record(name, seconds):
+    phases.append((name, seconds))
+
+
+def elapsed():
+    return time.perf_counter() - _start
+
+
+def report():
+    lines = [f"{name:<32}{seconds * 1000:8.1f} ms" for name, seconds in phases]
+    lines.append(f"{'ready':<32}{(_last - _start) * 1000:8.1f} ms")
+    return "\n".join(lines)
+
+
+# Wraps __import__ so that the first import of every absolute module is
+# timed. Only used for startup reports, it is never installed otherwise.
+def traceImports():
+    global _original_import
+    import builtins
+
+    if _original_import is not None:
+        return
+    _original_import = builtins.__import__
+    depth = 0
+
+    def timedImport(name, globals=None, locals=None, fromlist=(), level=0):
+        nonlocal depth
+        module = sys.modules.get(name)
+        # "from package import a, b" may load submodules of a loaded package
+        new = [item for item in fromlist or () if not hasattr(module, item)] if module else []
+        if level or module is not None and not new:
+            return _original_import(name, globals, locals, fromlist, level)
+        depth += 1
+        start = time.perf_counter()
+        try:
+            return _original_import(name, globals, locals, fromlist, level)
+        finally:
+            depth -= 1
+            label = f"{name} ({', '.join(new)})" if new else name
+            imports.append((depth, label, time.perf_counter() - start))
+
+    builtins.__import__ = timedImport
+
+
+def stopTracingImports():
+    global _original_import
+    import builtins
+
+    if _original_import is not None:
+        builtins.__import__ = _original_import
+        _original_import = None
+
+
+def save(path):
+    import json
+    import os
+
+    stopTracingImports()
+    data = {
+        "ready": _last - _start,
+        "phases": [{"name": name, "seconds": seconds} for name, seconds in phases],
+        "imports": [
+            {"module": name, "depth": depth, "seconds": seconds}
+            for depth, name, seconds in sorted(imports, key=lambda i: -i[2])
+        ],
+        "frozen": bool(getattr(sys, "frozen", False)),
+    }
+    # written under another name first so that a reader never sees half of it
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+# Starts the command with --startup-report, waits for the report and stops
+# the application again. Returns (launch-to-usable seconds, report).
+def launchOnce(command, reportPath, timeout):
+    import json
+    import os
+    import subprocess
+
+    if os.path.exists(reportPath):
+        os.remove(reportPath)
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command + ["--startup-report", reportPath],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while not os.path.exists(reportPath):
+            if process.poll() is not None:
+                raise RuntimeError(f"{command[0]} exited with {process.returncode} before it was ready")
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError(f"{command[0]} was not ready after {timeout} s")
+            time.sleep(0.002)
+        launched = time.perf_counter() - start
+        with open(reportPath) as f:
+            return launched, json.load(f)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def bench(command, runs, timeout=30.0):
+    import os
+    import statistics
+    import tempfile
+
+    with tempfile.TemporaryDirectory(prefix="startup-") as directory:
+        reportPath = os.path.join(directory, "report.json")
+        results = [launchOnce(command, reportPath, timeout) for _ in range(runs)]
+    launches = [launched for launched, data in results]
+    phaseNames = [phase["name"] for phase in results[0][1]["phases"]]
+    return {
+        "time": time.time(),
+        "command": command,
+        "runs": runs,
+        "launch_median": statistics.median(launches),
+        "launch_min": min(launches),
+        "ready_median": statistics.median(data["ready"] for launched, data in results),
+        "phases": {
+            name: statistics.median(
+                next((p["seconds"] for p in data["phases"] if p["name"] == name), 0.0)
+                for launched, data in results
+            )
+            for name in phaseNames
+        },
+        "imports": results[-1][1]["imports"][:10],
+    }
+
+
+def formatBench(result):
+    lines = [
+        f"launch to usable: median {result['launch_median'] * 1000:.0f} ms, "
+        f"best {result['launch_min'] * 1000:.0f} ms over {result['runs']} runs "
+        f"({result['ready_median'] * 1000:.0f} ms of it after the interpreter started)"
+    ]
+    lines += [f"  {name:<30}{seconds * 1000:8.1f} ms" for name, seconds in result["phases"].items()]
+    lines.append("slowest imports:")
+    lines += [
+        f"  {'  ' * i['depth']}{i['module']:<{30 - 2 * i['depth']}}{i['seconds'] * 1000:8.1f} ms"
+        for i in result["imports"]
+    ]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    import argparse
+    import json
+    import os
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("bench", help="measure launch-to-usable time of the application")
+    b.add_argument("--runs", type=int, default=5)
+    b.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for one launch")
+    b.add_argument("--history", metavar="FILE", help="append the result as a JSON line")
+    b.add_argument("app", nargs="*", help="command to launch, main.py with this Python if not given")
+    args = parser.parse_args(argv)
+
+    command = args.app or [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")]
+    try:
+        result = bench(command, args.runs, args.timeout)
+    except RuntimeError as e:
+        print(e)
+        return 1
+    print(formatBench(result))
+    if args.history:
+        with open(args.history, "a") as f:
+            f.write(json.dumps(result) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,307 @@
+"""Columnar device state store
+
+Keeps the state of many cameras as one typed array per setting instead of a
+dict of strings per camera. Every setting fits in one unsigned byte (levels
+are 0-100 and named values are small indices), so a camera costs one byte
+per setting plus a float timestamp of its last update and a byte of status
+flags, 17 bytes in all besides its port name. UNKNOWN marks a setting that
+has not been read yet.
+
+Fleet-wide queries run over whole columns in C: count() and histogram() count
+the bytes of a column, mask() and between() translate a column into
+a bytes mask of 0 and 1 through a 256-entry table, and masks are combined
+with both(). DeviceRow is a two-slot view for reading or writing a single
+camera by attribute.
+
+Usage:
+    store = DeviceStore()
+    i = store.add("/dev/ttyUSB0")
+    store.set(i, "palette", 0)
+    store.count("palette", "White Hot"), store.mean("brightness")
+    store.where(both(store.mask("palette", "White Hot"), store.flagged(ONLINE)))
+
+    python statestore.py bench --devices 100000
+"""
+
+import argparse
+import random
+import sys
+import time
+from array import array
+from collections import Counter
+
+import HM_TM5X
+
+UNKNOWN = 0xFF  # no setting goes above 100
+
+# status flags
+ONLINE = 1
+FAILED = 2
+UNSAVED = 4  # written since the last saveCurrentSettings
+
+SETTING_NAMES = list(HM_TM5X.SETTINGS)
+# handleReply function number -> setting name
+FUNCTIONS = {function: name for name, (builder, function, max_val) in HM_TM5X.SETTINGS.items()}
+
+# settings whose values have names -> names in value order
+CHOICES = {}
+for name, (builder, function, max_val) in HM_TM5X.SETTINGS.items():
+    replies = sorted(HM_TM5X.REPLY_TABLE.get(function, {}).items(), key=lambda item: item[0][6])
+    if replies and not replies[0][1].isdigit():
+        CHOICES[name] = [text for frame, text in replies]
+
+
+# a setting value given as a number or as one of its names -> number
+def valueOf(name, value):
+    if isinstance(value, str):
+        if name not in CHOICES or value not in CHOICES[name]:
+            raise ValueError(f"{value!r} is not a value of {name}")
+        return CHOICES[name].index(value)
+    return int(value)
+
+
+def displayOf(name, value):
+    if value == UNKNOWN:
+        return ""
+    if name in CHOICES and value < len(CHOICES[name]):
+        return CHOICES[name][value]
+    return str(value)
+
+
+# a mask with a 1 for every byte of `data` whose table entry is set
+def translate(data, selected):
+    table = bytes(1 if b in selected else 0 for b in range(256))
+    return data.translate(table)
+
+
+# the devices selected by every one of the masks
+def both(*masks):
+    length = len(masks[0])
+    combined = int.from_bytes(masks[0], "little")
+    for mask in masks[1:]:
+        combined &= int.from_bytes(mask, "little")
+    return combined.to_bytes(length, "little")
+
+
+# A view of one camera in a store, e.g. store.row("COM3").brightness = 50
+class DeviceRow:
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def port(self):
+        return self.store.ports[self.index]
+
+    @property
+    def updated(self):
+        return self.store.updated[self.index]
+
+    @property
+    def flags(self):
+        return self.store.flags[self.index]
+
+    def asDict(self):
+        return {name: getattr(self, name) for name in SETTING_NAMES}
+
+    def __repr__(self):
+        return f"DeviceRow({self.port!r}, {self.asDict()})"
+
+
+def _settingProperty(name):
+    def get(row):
+        value = row.store.columns[name][row.index]
+        return None if value == UNKNOWN else value
+
+    def put(row, value):
+        row.store.set(row.index, name, value)
+
+    return property(get, put)
+
+
+for _name in SETTING_NAMES:
+    setattr(DeviceRow, _name, _settingProperty(_name))
+
+
+class DeviceStore:
+    def __init__(self):
+        self.ports = []
+        self.indexes = {}  # port name -> row index
+        self.columns = {name: array("B") for name in SETTING_NAMES}
+        self.updated = array("d")  # time.time() of the last change
+        self.flags = array("B")
+
+    def __len__(self):
+        return len(self.ports)
+
+    # Returns the row index of the port, adding it if it is new
+    def add(self, port):
+        if port in self.indexes:
+            return self.indexes[port]
+        index = len(self.ports)
+        self.ports.append(port)
+        self.indexes[port] = index
+        for column in self.columns.values():
+            column.append(UNKNOWN)
+        self.updated.append(0.0)
+        self.flags.append(0)
+        return index
+
+    def row(self, key):
+        return DeviceRow(self, self.indexes[key] if isinstance(key, str) else key)
+
+    def set(self, index, name, value, now=None):
+        value = valueOf(name, value)
+        if not 0 <= value <= HM_TM5X.SETTINGS[name][2]:
+            raise ValueError(f"{value} is out of range for {name}")
+        self.columns[name][index] = value
+        self.updated[index] = time.time() if now is None else now
+
+    # stores a read reply by its handleReply function number; other functions
+    # are not settings and are ignored
+    def setFunction(self, index, function, value, now=None):
+        if function in FUNCTIONS:
+            self.set(index, FUNCTIONS[function], value, now)
+
+    def setFlag(self, index, flag, on=True):
+        if on:
+            self.flags[index] |= flag
+        else:
+            self.flags[index] &= ~flag & 0xFF
+
+    def count(self, name, value):
+        return self.columns[name].tobytes().count(valueOf(name, value))
+
+    def countFlag(self, flag):
+        return self.flagged(flag).count(1)
+
+    # mean of the values read so far, None if there are none
+    def mean(self, name):
+        column = self.columns[name]
+        unknown = column.tobytes().count(UNKNOWN)
+        if unknown == len(column):
+            return None
+        return (sum(column) - unknown * UNKNOWN) / (len(column) - unknown)
+
+    # display text -> number of cameras, for the values that occur
+    def histogram(self, name):
+        counts = Counter(self.columns[name].tobytes())
+        counts.pop(UNKNOWN, None)
+        return {displayOf(name, value): n for value, n in sorted(counts.items())}
+
+    def mask(self, name, *values):
+        return translate(self.columns[name].tobytes(), {valueOf(name, v) for v in values})
+
+    def between(self, name, low, high):
+        return translate(self.columns[name].tobytes(), range(low, high + 1))
+
+    def flagged(self, flag):
+        return translate(self.flags.tobytes(), {b for b in range(256) if b & flag})
+
+    def stale(self, before):
+        return bytes(t < before for t in self.updated)
+
+    # row indexes selected by a mask
+    def where(self, mask):
+        indexes = []
+        i = mask.find(1)
+        while i >= 0:
+            indexes.append(i)
+            i = mask.find(1, i + 1)
+        return indexes
+
+    def bytesPerDevice(self):
+        columns = [*self.columns.values(), self.updated, self.flags]
+        return sum(column.itemsize for column in columns)
+
+
+# Fills a store and the same state as dicts of strings, as the parsers return
+# it, and compares their memory and query times
+def bench(devices, seed=None):
+    import gc
+    import tracemalloc
+
+    rng = random.Random(seed)
+    values = [
+        {name: rng.randint(0, max_val) for name, (b, f, max_val) in HM_TM5X.SETTINGS.items()}
+        for _ in range(devices)
+    ]
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    store = DeviceStore()
+    for i, settings in enumerate(values):
+        index = store.add(f"sim:{i}")
+        for name, value in settings.items():
+            store.set(index, name, value, now=0.0)
+    store.ports = store.indexes = None  # the port names cost the same either way
+    storeBytes = tracemalloc.get_traced_memory()[0] - base
+    base = tracemalloc.get_traced_memory()[0]
+    dicts = [
+        {name: displayOf(name, value) for name, value in settings.items()} for settings in values
+    ]
+    dictBytes = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    # best of a few runs with the collector off, like timeit, so that neither a
+    # collection nor the first touch of fresh memory lands in one query
+    def timed(fn, repeat=5):
+        best = None
+        gc.disable()
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = fn()
+                took = time.perf_counter() - start
+                best = took if best is None else min(best, took)
+        finally:
+            gc.enable()
+        return result, best
+
+    queries = [
+        (
+            "count White Hot",
+            lambda: store.count("palette", "White Hot"),
+            lambda: sum(d["palette"] == "White Hot" for d in dicts),
+        ),
+        (
+            "mean brightness",
+            lambda: store.mean("brightness"),
+            lambda: sum(int(d["brightness"]) for d in dicts) / len(dicts),
+        ),
+        (
+            "contrast 40-60 on Black Hot",
+            lambda: len(store.where(both(store.between("contrast", 40, 60), store.mask("palette", "Black Hot")))),
+            lambda: sum(40 <= int(d["contrast"]) <= 60 and d["palette"] == "Black Hot" for d in dicts),
+        ),
+    ]
+    lines = [
+        f"{devices} devices: store {storeBytes / devices:.1f} bytes/device "
+        f"({store.bytesPerDevice()} in columns), dicts {dictBytes / devices:.1f} bytes/device"
+    ]
+    for title, fast, slow in queries:
+        a, fastTime = timed(fast)
+        b, slowTime = timed(slow)
+        if a != b:
+            raise AssertionError(f"{title}: store gives {a}, dicts give {b}")
+        lines.append(
+            f"{title}: {fastTime * 1000:.2f} ms vs {slowTime * 1000:.2f} ms "
+            f"({slowTime / fastTime:.0f}x) = {a}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("bench", help="compare memory and query times with dicts of strings")
+    b.add_argument("--devices", type=int, default=100000)
+    b.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+    print(bench(args.devices, args.seed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
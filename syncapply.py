@@ -0,0 +1,263 @@
+"""Synchronised apply across a camera rig
+
+Switches a setting such as the palette or mirroring on every camera of a rig
+at effectively the same moment. Sending the command to one port after the
+other spreads the switch over the whole run; here the request and expected
+acknowledgement are built once up front, every port is opened and primed
+with a readModel round trip, and only then are the writes released together.
+
+Serial ports are opened with the low-latency backend, which exposes the
+file descriptor and, unlike QSerialPort, can be used from any thread. The
+writes are released in one of two ways:
+  loop     one thread writes the frame to every port's file descriptor back
+           to back and then collects the replies of all ports with poll().
+  threads  one thread per port, all waiting on a barrier. Also works with
+           simulated cameras.
+  sequential  one port after the other, for comparison.
+
+Each setting is one round: the next round starts once every camera has
+answered the previous one. The report gives, per round, the skew between
+the first and the last write and between the first and the last
+acknowledgement, which is what the rig sees.
+
+Usage:
+    python syncapply.py /dev/ttyUSB0 /dev/ttyUSB1 --set palette="Black Hot"
+    python syncapply.py $(cat ports.txt) --set palette=3 --set imageMirroring=1 --report skew.json
+    python syncapply.py sim:a sim:b sim:c --set palette=2 --mode threads
+"""
+
+import argparse
+import json
+import os
+import select
+import sys
+import threading
+import time
+
+import HM_TM5X
+from pacing import DEFAULT_PACING, PACING
+
+PRIME_TIMEOUT = 0.5  # seconds
+BARRIER_TIMEOUT = 2.0  # seconds the threads of a round wait for each other
+
+
+# [(name, value)] -> [(name, request frame, acknowledgement)], checked and
+# built the way order manifests are
+def prepareFrames(settings):
+    from manifest import VALUES, normalize, rangeText
+
+    frames = []
+    for name, text in settings:
+        if name not in HM_TM5X.SETTINGS:
+            raise ValueError(f"unknown setting {name}")
+        value = VALUES[name].get(normalize(text))
+        if value is None:
+            raise ValueError(f"{name} must be {rangeText(name)}, given {text!r}")
+        builder, function, max_val = HM_TM5X.SETTINGS[name]
+        request = builder(value, True)
+        frames.append((name, bytes.fromhex(request), bytes.fromhex(HM_TM5X.ackReply(request))))
+    return frames
+
+
+def parseSetting(text):
+    name, sep, value = text.partition("=")
+    if not sep:
+        raise ValueError(f"expected NAME=VALUE, given {text!r}")
+    return name.strip(), value
+
+
+# Checks that a camera answers on every port before anything is released.
+# Runs the ports in parallel and returns the ports that did not answer.
+def prime(transports):
+    request = bytes.fromhex(HM_TM5X.readModel())
+    silent = []
+
+    def check(port, transport):
+        transport.timeout = PRIME_TIMEOUT
+        transport.resetInput()
+        transport.write(request)
+        frames, rest = HM_TM5X.splitFrames(HM_TM5X.readFrame(transport))
+        if len(frames) != 1 or frames[0][3:5] != request[3:5]:
+            silent.append(port)
+
+    threads = [threading.Thread(target=check, args=item) for item in transports.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return silent
+
+
+# Writes the request to every descriptor back to back, then collects the
+# acknowledgements. Returns {port: (sent, acked or None, ok)}.
+def releaseLoop(transports, request, ack, timeout):
+    ports = {transport.fd: port for port, transport in transports.items()}
+    for transport in transports.values():
+        transport.resetInput()
+    poller = select.poll()
+    for fd in ports:
+        poller.register(fd, select.POLLIN)
+    received = dict.fromkeys(ports, b"")
+    sent = {}
+    for fd, port in ports.items():
+        os.write(fd, request)
+        sent[port] = time.perf_counter()
+    results = {}
+    deadline = time.perf_counter() + timeout
+    while len(results) < len(ports):
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        for fd, event in poller.poll(remaining * 1000):
+            now = time.perf_counter()
+            port = ports[fd]
+            received[fd] += os.read(fd, len(ack) - len(received[fd]))
+            if len(received[fd]) == len(ack):
+                results[port] = (sent[port], now, received[fd] == ack)
+                poller.unregister(fd)
+    for port in transports:
+        results.setdefault(port, (sent[port], None, False))
+    return results
+
+
+# One thread per port, released together by a barrier. A port that fails
+# breaks the barrier, and so does one that never gets to it, so that no
+# thread waits forever; the round then fails on every port not yet sent.
+def releaseThreads(transports, request, ack, timeout):
+    barrier = threading.Barrier(len(transports), timeout=BARRIER_TIMEOUT)
+    results = {}
+
+    def apply(port, transport):
+        try:
+            transport.timeout = timeout
+            transport.resetInput()
+            barrier.wait()
+            sent = time.perf_counter()
+            transport.write(request)
+            reply = HM_TM5X.readFrame(transport)
+        except threading.BrokenBarrierError:
+            results[port] = (time.perf_counter(), None, False)
+            return
+        except OSError:
+            barrier.abort()
+            results[port] = (time.perf_counter(), None, False)
+            return
+        acked = time.perf_counter()
+        results[port] = (sent, acked if reply else None, reply == ack)
+
+    threads = [threading.Thread(target=apply, args=item) for item in transports.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# One port after the other, each waiting for its acknowledgement; how
+# commands went out before, kept to compare against
+def releaseSequential(transports, request, ack, timeout):
+    results = {}
+    for port, transport in transports.items():
+        transport.timeout = timeout
+        transport.resetInput()
+        sent = time.perf_counter()
+        transport.write(request)
+        reply = HM_TM5X.readFrame(transport)
+        results[port] = (sent, time.perf_counter() if reply else None, reply == ack)
+    return results
+
+
+RELEASE = {"loop": releaseLoop, "threads": releaseThreads, "sequential": releaseSequential}
+
+
+# Applies every (name, request, ack) in turn on all transports at once,
+# giving the cameras the setting's settle time before the next round.
+# Returns one report dict per setting, times in seconds from its first write.
+def applySync(transports, frames, mode="loop"):
+    release = RELEASE[mode]
+    rounds = []
+    for i, (name, request, ack) in enumerate(frames):
+        settle, timeout = PACING.get(name, DEFAULT_PACING)
+        results = release(transports, request, ack, timeout / 1000)
+        start = min(sent for sent, acked, ok in results.values())
+        acks = [acked for sent, acked, ok in results.values() if acked is not None]
+        sends = [sent for sent, acked, ok in results.values()]
+        rounds.append(
+            {
+                "setting": name,
+                "write_skew": max(sends) - min(sends),
+                "ack_skew": max(acks) - min(acks) if acks else None,
+                "failed": sorted(port for port, (sent, acked, ok) in results.items() if not ok),
+                "ports": {
+                    port: {"sent": sent - start, "ack": None if acked is None else acked - start, "ok": ok}
+                    for port, (sent, acked, ok) in results.items()
+                },
+            }
+        )
+        if settle and i < len(frames) - 1:
+            time.sleep(settle / 1000)
+    return rounds
+
+
+def formatRounds(rounds, verbose=False):
+    lines = []
+    for r in rounds:
+        if verbose:
+            for port, p in sorted(r["ports"].items(), key=lambda item: item[1]["ack"] or float("inf")):
+                ack = f"ack {p['ack'] * 1000:7.2f} ms" if p["ack"] is not None else "no ack"
+                lines.append(f"  {port}: sent {p['sent'] * 1000:6.2f} ms, {ack}" + ("" if p["ok"] else "  FAILED"))
+        ack_skew = f"{r['ack_skew'] * 1000:.2f} ms" if r["ack_skew"] is not None else "-"
+        lines.append(
+            f"{r['setting']}: {len(r['ports'])} cameras, write skew {r['write_skew'] * 1000:.2f} ms, "
+            f"ack skew {ack_skew}, {len(r['failed'])} failed"
+        )
+        lines += [f"  {port}: no acknowledgement" for port in r["failed"]]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("ports", nargs="+")
+    parser.add_argument("--set", action="append", required=True, metavar="NAME=VALUE", help="setting to apply, repeatable")
+    parser.add_argument("--mode", choices=sorted(RELEASE), help="how writes are released, loop if every port allows it")
+    parser.add_argument("--report", metavar="FILE", help="write the timings of every port as JSON")
+    parser.add_argument("--verbose", action="store_true", help="print the timings of every port")
+    args = parser.parse_args(argv)
+
+    try:
+        frames = prepareFrames([parseSetting(text) for text in args.set])
+    except ValueError as e:
+        print(e)
+        return 1
+    mode = args.mode or ("threads" if any(port.startswith("sim:") for port in args.ports) else "loop")
+
+    from transport import openTransport
+
+    transports = {}
+    try:
+        for port in args.ports:
+            transport = openTransport(port, lowLatency=True)
+            if transport is None:
+                print(f"{port}: could not open port")
+                return 1
+            if mode == "loop" and not hasattr(transport, "fd"):
+                print(f"{port}: --mode loop needs serial ports, use --mode threads")
+                return 1
+            transports[port] = transport
+        silent = prime(transports)
+        if silent:
+            print(f"no camera answering on {', '.join(silent)}, nothing applied")
+            return 1
+        rounds = applySync(transports, frames, mode)
+    finally:
+        for transport in transports.values():
+            transport.close()
+    print(formatRounds(rounds, args.verbose))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(rounds, f, indent=2)
+    return 1 if any(r["failed"] for r in rounds) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
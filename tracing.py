@@ -0,0 +1,86 @@
+"""Optional command tracing in Chrome trace-event format
+
+Every command opens a span with begin() that is closed with end() once its
+reply is decoded. While tracing is disabled begin() returns None straight
+away and end(None) returns immediately, so the hooks can stay in place.
+Frames may be passed to the hooks as bytes; they are only turned into hex
+when the trace is saved. The file written by save() opens in
+chrome://tracing or ui.perfetto.dev.
+"""
+
+import os
+import threading
+import time
+
+_events = None
+_next_id = 0
+_lock = threading.Lock()
+
+
+def enable():
+    global _events
+    if _events is None:
+        _events = []
+
+
+def disable():
+    global _events
+    _events = None
+
+
+def isEnabled():
+    return _events is not None
+
+
+def _now():
+    return time.perf_counter_ns() / 1000  # trace-event timestamps are in us
+
+
+def begin(name, port="", **args):
+    global _next_id
+    if _events is None:
+        return None
+    with _lock:
+        _next_id += 1
+        span = (_next_id, name, port)
+    args["port"] = port
+    _events.append(_event("b", span, args))
+    return span
+
+
+def end(span, outcome="ok", **args):
+    if span is None or _events is None:
+        return
+    args["outcome"] = outcome
+    _events.append(_event("e", span, args))
+
+
+def _event(phase, span, args):
+    span_id, name, port = span
+    return {
+        "name": name,
+        "cat": port or "serial",
+        "ph": phase,
+        "id": span_id,
+        "ts": _now(),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": args,
+    }
+
+
+# json is only imported here, which keeps it off the application's startup
+def save(path):
+    import json
+
+    if _events is None:
+        return 0
+    with open(path, "w") as f:
+        json.dump({"traceEvents": _events, "displayTimeUnit": "ms"}, f, default=_hex)
+    return len(_events)
+
+
+def _hex(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex().upper()
+    raise TypeError(f"cannot trace {type(value).__name__}")
@@ -0,0 +1,114 @@
+"""Blocking serial transport for headless tools
+
+Wraps QSerialPort's blocking API so scripts can talk to a camera without an
+event loop. Anything with the same write(data) / read(size) methods can be
+used in its place.
+"""
+
+import time
+
+from PyQt5 import QtCore
+from PyQt5.QtSerialPort import QSerialPort
+
+from simulator import SIM_PREFIX
+
+DEFAULT_BAUD_RATE = 115200
+DEFAULT_TIMEOUT = 0.5  # seconds
+
+_app = None
+
+
+# QSerialPort needs an application object even when no event loop runs
+def ensureApplication():
+    global _app
+    if QtCore.QCoreApplication.instance() is None:
+        _app = QtCore.QCoreApplication([])
+
+
+class SerialTransport:
+    def __init__(self, portName, baudRate=DEFAULT_BAUD_RATE, timeout=DEFAULT_TIMEOUT):
+        ensureApplication()
+        self.portName = portName
+        self.timeout = timeout
+        self.port = QSerialPort(portName)
+        self.port.setBaudRate(baudRate)
+
+    # borrow a port that is already set up, e.g. the one owned by MainWindow
+    @classmethod
+    def wrap(cls, port, timeout=DEFAULT_TIMEOUT):
+        transport = cls.__new__(cls)
+        transport.portName = port.portName()
+        transport.timeout = timeout
+        transport.port = port
+        return transport
+
+    def open(self):
+        return self.port.open(QtCore.QIODevice.ReadWrite)
+
+    def close(self):
+        self.port.close()
+
+    def isOpen(self):
+        return self.port.isOpen()
+
+    def write(self, data):
+        n = self.port.write(data)
+        self.port.waitForBytesWritten(int(self.timeout * 1000))
+        return n
+
+    # returns up to size bytes, fewer if the timeout runs out first
+    def read(self, size):
+        buf = b""
+        deadline = time.monotonic() + self.timeout
+        while len(buf) < size:
+            if not self.port.bytesAvailable():
+                remaining = int((deadline - time.monotonic()) * 1000)
+                if remaining <= 0 or not self.port.waitForReadyRead(remaining):
+                    break
+            buf += bytes(self.port.read(size - len(buf)))
+        return buf
+
+    def resetInput(self):
+        self.port.clear(QSerialPort.Input)
+
+
+# Runs target(*args) on a QThread. A SerialTransport opened on a plain
+# threading.Thread works, but its socket notifiers need a QThread.
+class PortThread(QtCore.QThread):
+    def __init__(self, target, args=()):
+        ensureApplication()
+        super().__init__()
+        self.target = target
+        self.args = args
+
+    def run(self):
+        self.target(*self.args)
+
+    def join(self):
+        self.wait()
+
+
+# The low-latency backend needs termios and fcntl, which Windows lacks
+def lowLatencyAvailable():
+    try:
+        import lowlatency  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# Opens the transport used by the headless tools; lowLatency selects the Linux
+# termios backend from lowlatency.py and "sim:" port names a simulated camera.
+# Returns None if the port cannot be opened.
+def openTransport(portName, baudRate=DEFAULT_BAUD_RATE, timeout=DEFAULT_TIMEOUT, lowLatency=False):
+    if portName.startswith(SIM_PREFIX):
+        from simulator import VirtualCamera
+
+        transport = VirtualCamera(portName, timeout=timeout)
+    elif lowLatency:
+        from lowlatency import LowLatencySerial
+
+        transport = LowLatencySerial(portName, baudRate, timeout)
+    else:
+        transport = SerialTransport(portName, baudRate, timeout)
+    return transport if transport.open() else None